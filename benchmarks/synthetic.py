@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+# coding: utf-8
+"""
+Generate a synthetic site and time loading, analyzing, rendering and writing
+it, printing the results as JSON together with the memory used by the loaded
+site.
+
+The load, analyze, render and memory phases run with persistent caches
+disabled, so that they measure the work done on a site seen for the first
+time. The build is then run twice, into new output directories so that all
+pages are rendered both times:
+
+* `build_cold`: with `--full` and an empty cache directory
+* `build_warm`: with the persistent caches filled by `build_cold`
+
+Run it from the root of the source tree, for example:
+
+    python3 benchmarks/synthetic.py --pages 10000 --tags 500
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+THEME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example", "theme")
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua").split()
+
+CODE = '''```python
+def example_{idx}(value):
+    """
+    Example function number {idx}
+    """
+    for i in range(value):
+        print("{{}}: {{}}".format(i, value * {idx}))
+    return value
+```'''
+
+
+def max_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_front_matter(style, meta):
+    if style == "toml":
+        import toml
+        return "+++\n" + toml.dumps(meta) + "+++\n"
+    elif style == "yaml":
+        import yaml
+        return "---\n" + yaml.dump(meta) + "---\n"
+    else:
+        return json.dumps(meta, indent=4) + "\n"
+
+
+def page_relpath(args, idx):
+    """
+    Place pages in a directory tree args.depth levels deep
+    """
+    dirs = []
+    n = idx
+    for level in range(args.depth):
+        dirs.append("d{}".format(n % args.fanout))
+        n //= args.fanout
+    return os.path.join("blog", *dirs, "post{}.md".format(idx))
+
+
+def generate_site(args, root):
+    """
+    Generate a synthetic site in root, returning the path to its settings.py.
+
+    Content already in root, as left by a previous run with --keep, is
+    replaced.
+    """
+    rnd = random.Random(args.seed)
+    content = os.path.join(root, "content")
+    if os.path.exists(content):
+        shutil.rmtree(content)
+    os.makedirs(content)
+
+    with open(os.path.join(root, "settings.py"), "wt") as out:
+        print("SITE_NAME = 'Synthetic site'", file=out)
+        print("THEME = {!r}".format(THEME), file=out)
+        print("CONTENT = 'content'", file=out)
+        print("TIMEZONE = 'UTC'", file=out)
+
+    with open(os.path.join(content, "tags.taxonomy"), "wt") as out:
+        out.write('+++\nitem_name = "tag"\ntemplate_tags = "tags.html"\ntemplate_tag = "tag.html"\n'
+                  'template_archive = "tag-archive.html"\ntemplate_atom = "tag.atom"\ntemplate_rss = "tag.rss"\n+++\n')
+
+    with open(os.path.join(content, "index.j2.html"), "wt") as out:
+        out.write('{% extends "base.html" %}{% from "inline_page.html" import inline_page %}\n'
+                  '{% block content %}{% for page in site_pages(path="blog/*", limit=10) %}'
+                  '{{inline_page(page)}}{% endfor %}{% endblock %}\n')
+
+    tags = ["tag{}".format(i) for i in range(args.tags)]
+    styles = ("toml", "yaml", "json")
+    start = datetime.datetime(2010, 1, 1)
+    for idx in range(args.pages):
+        relpath = page_relpath(args, idx)
+        abspath = os.path.join(content, relpath)
+        os.makedirs(os.path.dirname(abspath), exist_ok=True)
+        meta = {
+            "date": (start + datetime.timedelta(hours=idx)).strftime("%Y-%m-%d %H:%M:%S+00:00"),
+            "tags": rnd.sample(tags, min(len(tags), args.tags_per_page)),
+        }
+        body = ["# Post {}".format(idx), ""]
+        for p in range(args.paragraphs):
+            body.append(" ".join(rnd.choice(WORDS) for i in range(60)))
+            body.append("")
+        if idx > 0:
+            body.append("See also [the previous post](/{}).".format(page_relpath(args, idx - 1)[:-3]))
+            body.append("")
+        for c in range(args.code_blocks):
+            body.append(CODE.format(idx=idx * args.code_blocks + c))
+            body.append("")
+        with open(abspath, "wt") as out:
+            out.write(write_front_matter(styles[idx % len(styles)], meta))
+            out.write("\n")
+            out.write("\n".join(body))
+
+    for idx in range(args.assets):
+        abspath = os.path.join(content, "assets", "asset{}.bin".format(idx))
+        os.makedirs(os.path.dirname(abspath), exist_ok=True)
+        with open(abspath, "wb") as out:
+            out.write(rnd.getrandbits(8 * 1024 * args.asset_size).to_bytes(1024 * args.asset_size, "little"))
+
+    return os.path.join(root, "settings.py")
+
+
+def phase_result(elapsed, count):
+    return {
+        "seconds": elapsed,
+        "count": count,
+        "per_second": count / elapsed if elapsed else None,
+        "max_rss_kib": max_rss_kib(),
+    }
+
+
+def model_memory(build):
+    """
+    Measure the memory allocated to hold a loaded and analyzed site
+    """
+    from staticsite.site import Site
+
+    tracemalloc.start()
+    try:
+        site = Site()
+        site.load_cache(None)
+        site.load_theme(build.theme_root)
+        # Only count what is allocated for the contents
+        base = tracemalloc.get_traced_memory()[0]
+        site.load_content(build.content_root)
+        site.analyze()
+        allocated = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "bytes": allocated,
+        "count": len(site.pages),
+        "bytes_per_page": allocated / len(site.pages) if site.pages else None,
+    }
+
+
+def make_build(args, settings_path, output_root, *extra_args):
+    from staticsite.build import Build
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    Build.make_subparser(subparsers)
+    cmd_args = ["build", settings_path, "-o", output_root, "--jobs", str(args.jobs)] + list(extra_args)
+    return Build(parser.parse_args(cmd_args))
+
+
+def run_build(build):
+    """
+    Build a freshly loaded site, as ssite build would
+    """
+    start = time.perf_counter()
+    site = build.load_site()
+    build.write(site)
+    return phase_result(time.perf_counter() - start, len(site.pages))
+
+
+def run_benchmark(args, settings_path, output_root):
+    from staticsite.site import Site
+
+    build = make_build(args, settings_path, output_root + "-cold", "--full")
+
+    results = {}
+
+    # Load and analyze the site without persistent caches, timing each phase
+    site = Site()
+    site.load_cache(None)
+    site.load_theme(build.theme_root)
+
+    start = time.perf_counter()
+    site.load_content(build.content_root)
+    results["load"] = phase_result(time.perf_counter() - start, len(site.pages))
+
+    start = time.perf_counter()
+    site.analyze()
+    results["analyze"] = phase_result(time.perf_counter() - start, len(site.pages))
+
+    # Render all pages in memory, grouped by type
+    by_type = defaultdict(list)
+    for page in site.pages.values():
+        by_type[(page.RENDER_PREFERRED_ORDER, page.TYPE)].append(page)
+    results["render"] = {}
+    for (order, type), pages in sorted(by_type.items()):
+        start = time.perf_counter()
+        for page in pages:
+            for relpath, rendered in page.render():
+                rendered.content()
+        results["render"][type] = phase_result(time.perf_counter() - start, len(pages))
+
+    # Memory used by the site model, once loaded and analyzed
+    results["memory"] = model_memory(build)
+
+    # Full build starting from an empty cache directory
+    if build.cache_root is not None and os.path.exists(build.cache_root):
+        shutil.rmtree(build.cache_root)
+    results["build_cold"] = run_build(build)
+
+    # Build into a new output directory, so that all pages are rendered again,
+    # reusing what build_cold stored in the persistent caches
+    if os.path.exists(output_root + "-warm"):
+        shutil.rmtree(output_root + "-warm")
+    results["build_warm"] = run_build(make_build(args, settings_path, output_root + "-warm"))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark staticsite on a synthetic site.")
+    parser.add_argument("--pages", type=int, default=1000, help="number of markdown pages (default: %(default)s)")
+    parser.add_argument("--tags", type=int, default=100, help="number of distinct tags (default: %(default)s)")
+    parser.add_argument("--tags-per-page", type=int, default=3, help="number of tags in each page (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=3, help="depth of the directory tree of pages (default: %(default)s)")
+    parser.add_argument("--fanout", type=int, default=10, help="subdirectories in each directory (default: %(default)s)")
+    parser.add_argument("--paragraphs", type=int, default=5, help="paragraphs of text in each page (default: %(default)s)")
+    parser.add_argument("--code-blocks", type=int, default=1, help="code blocks in each page (default: %(default)s)")
+    parser.add_argument("--assets", type=int, default=10, help="number of static assets (default: %(default)s)")
+    parser.add_argument("--asset-size", type=int, default=1024, help="size of each asset in KiB (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="processes used by the build phase (default: %(default)s)")
+    parser.add_argument("--keep", metavar="DIR", help="generate the site in DIR and keep it, instead of using a temporary directory; a site already in DIR is generated again")
+    args = parser.parse_args()
+
+    if args.keep:
+        root = os.path.abspath(args.keep)
+        tmpdir = None
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        root = tmpdir.name
+
+    try:
+        start = time.perf_counter()
+        settings_path = generate_site(args, root)
+        generate_time = time.perf_counter() - start
+        results = run_benchmark(args, settings_path, os.path.join(root, "web"))
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    json.dump({
+        "params": {k: v for k, v in vars(args).items() if k != "keep"},
+        "generate_seconds": generate_time,
+        "phases": results,
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
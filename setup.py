@@ -5,7 +5,7 @@ import sys
 
 setup(
     name = "staticsite",
-    requires=[ 'unidecode', 'markdown', 'toml', 'yaml', 'jinja2', 'dateutil', 'livereload' ],
+    requires=[ 'unidecode', 'markdown (<3)', 'toml', 'yaml', 'jinja2', 'dateutil', 'livereload' ],
     version = "0.3",
     description = "Static site generator",
     author = ["Enrico Zini"],
@@ -8,9 +8,11 @@ import shutil
 
 
 class Asset(Page):
+    __slots__ = ()
+
     TYPE = "asset"
 
-    def __init__(self, site, root_abspath, relpath):
+    def __init__(self, site, root_abspath, relpath, st=None):
         dirname, basename = os.path.split(relpath)
         if basename == "index.html":
             linkpath = dirname
@@ -22,15 +24,19 @@ class Asset(Page):
             root_abspath=root_abspath,
             src_relpath=relpath,
             src_linkpath=linkpath,
-            dst_relpath=relpath,
-            dst_link=os.path.join(settings.SITE_ROOT, linkpath))
-        self.title = os.path.basename(relpath)
+            src_stat=st)
+
+    @property
+    def dst_relpath(self):
+        return self.src_relpath
+
+    @property
+    def title(self):
+        return os.path.basename(self.src_relpath)
 
     def read_metadata(self):
-        dt = pytz.utc.localize(datetime.datetime.fromtimestamp(os.path.getmtime(self.src_abspath)))
+        dt = pytz.utc.localize(datetime.datetime.fromtimestamp(self.src_stat.st_mtime))
         self.meta["date"] = dt
 
     def render(self):
-        return {
-            self.dst_relpath: RenderedFile(self.src_abspath),
-        }
+        yield self.dst_relpath, RenderedFile(self.src_abspath)
@@ -0,0 +1,226 @@
+# coding: utf-8
+
+from .serve import source_changes
+import asyncio
+import functools
+import urllib.parse
+import concurrent.futures
+import logging
+
+log = logging.getLogger()
+
+
+def call_application(application, environ):
+    """
+    Call a WSGI application, returning its status, headers and the iterable
+    with its body
+    """
+    response = []
+
+    def start_response(status, headers):
+        response.append(status)
+        response.append(headers)
+
+    body = application(environ, start_response)
+    return response[0], response[1], body
+
+
+def close_body(body):
+    """
+    Close a WSGI body iterable, if it can be closed
+    """
+    close = getattr(body, "close", None)
+    if close is not None:
+        close()
+
+
+class AsyncServer:
+    """
+    HTTP server for Serve, based on asyncio.
+
+    Requests are handled concurrently, and files already rendered are served
+    without waiting. Pages are rendered by a pool of `workers` threads.
+
+    Source files are polled for changes, and a burst of changes is applied
+    only once they stop for debounce seconds. Changes are applied while no
+    page is being rendered, since they modify the site: requests that need
+    rendering wait for them to be done.
+    """
+    def __init__(self, serve, host="localhost", port=8000, poll_interval=0.5, debounce=0.2, workers=None):
+        self.serve = serve
+        self.host = host
+        self.port = port
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.worker = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.server = None
+        self.watcher = None
+        # Keeps rendering and refreshing from running at the same time
+        self.gate = None
+        self.refreshing = False
+        self.rendering = 0
+
+    async def start(self):
+        self.gate = asyncio.Condition()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.watcher = asyncio.ensure_future(self.watch())
+
+    async def stop(self):
+        self.watcher.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        self.worker.shutdown()
+
+    async def serve_forever(self):
+        await self.start()
+        log.info("Serving on http://%s:%d", self.host, self.port)
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def watch(self):
+        """
+        Poll the sources for changes, and apply them to the site
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            # Errors are logged, and do not stop watching for changes
+            try:
+                sources = await loop.run_in_executor(None, self.serve.scan_sources)
+                if not any(source_changes(self.serve.sources, sources)): continue
+
+                # Wait for the changes to settle, so that a burst of saves
+                # causes only one reload
+                while True:
+                    await asyncio.sleep(self.debounce)
+                    settled = await loop.run_in_executor(None, self.serve.scan_sources)
+                    if not any(source_changes(sources, settled)): break
+                    sources = settled
+
+                await self.apply(sources)
+            except Exception:
+                log.exception("cannot check the sources for changes")
+
+    async def apply(self, sources):
+        """
+        Apply changes to the site, once no page is being rendered
+        """
+        loop = asyncio.get_running_loop()
+        # Stop new renders from starting, and wait for the running ones
+        async with self.gate:
+            self.refreshing = True
+            await self.gate.wait_for(lambda: self.rendering == 0)
+        try:
+            await loop.run_in_executor(self.worker, self.serve.update, sources)
+        finally:
+            async with self.gate:
+                self.refreshing = False
+                self.gate.notify_all()
+
+    async def respond(self, environ):
+        """
+        Return the status, headers and body of the response to a request
+        """
+        if environ["REQUEST_METHOD"] not in ("GET", "HEAD"):
+            return "405 Method Not Allowed", [("Content-Type", "text/plain"), ("Allow", "GET, HEAD")], [b"Method not allowed"]
+
+        pages = self.serve.pages
+        dst_relpath, rendered = pages.cached(environ["PATH_INFO"])
+        if rendered is not None:
+            return call_application(functools.partial(pages.respond, dst_relpath, rendered), environ)
+
+        loop = asyncio.get_running_loop()
+        async with self.gate:
+            await self.gate.wait_for(lambda: not self.refreshing)
+            self.rendering += 1
+        try:
+            return await loop.run_in_executor(self.worker, call_application, self.serve.application, environ)
+        except Exception:
+            log.exception("%s: cannot render page", environ["PATH_INFO"])
+            return "500 Internal Server Error", [("Content-Type", "text/plain")], [b"Internal server error"]
+        finally:
+            async with self.gate:
+                self.rendering -= 1
+                self.gate.notify_all()
+
+    async def write_response(self, writer, method, status, headers, body, keep_alive):
+        """
+        Send a response, writing its body one chunk at a time
+        """
+        code = int(status.split(None, 1)[0])
+        # These responses never have a body
+        has_body = code >= 200 and code not in (204, 304)
+
+        lines = ["HTTP/1.1 " + status]
+        lines.extend("{}: {}".format(name, value) for name, value in headers if value is not None)
+        if has_body and not any(name.lower() == "content-length" for name, value in headers):
+            # Only short generated responses come without a length
+            body = [b"".join(body)]
+            lines.append("Content-Length: {}".format(len(body[0])))
+        if not keep_alive:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin1"))
+        if has_body and method != "HEAD":
+            for chunk in body:
+                writer.write(chunk)
+                await writer.drain()
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        """
+        Handle an HTTP/1.1 connection
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line: break
+                try:
+                    method, target, version = request_line.decode("latin1").split()
+                except ValueError:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""): break
+                    name, sep, value = line.decode("latin1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                # Read the request body, which is not used, so that the next
+                # request on the connection starts where it should
+                if "transfer-encoding" in headers:
+                    writer.write(b"HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                try:
+                    content_length = int(headers.get("content-length", "0"))
+                    if content_length < 0: raise ValueError("negative Content-Length")
+                except ValueError:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                if content_length:
+                    await reader.readexactly(content_length)
+
+                url = urllib.parse.urlsplit(target)
+                environ = {
+                    "REQUEST_METHOD": method,
+                    "PATH_INFO": urllib.parse.unquote(url.path),
+                    "QUERY_STRING": url.query,
+                    "SERVER_PROTOCOL": version,
+                }
+                for name, value in headers.items():
+                    environ["HTTP_" + name.upper().replace("-", "_")] = value
+
+                status, response_headers, body = await self.respond(environ)
+                try:
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    await self.write_response(writer, method, status, response_headers, body, keep_alive)
+                finally:
+                    close_body(body)
+                if not keep_alive: break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -3,16 +3,40 @@
 import json
 import os
 import re
+import sys
 import time
 import shutil
-from collections import defaultdict
+import tempfile
+import contextlib
+import multiprocessing
+from collections import defaultdict, Counter
 from .commands import SiteCommand, CmdlineError
 from .core import settings
 from .utils import timings
+from .buildcache import BuildCache
+from .manifest import Manifest, MANIFEST_NAME
+from . import profile
 import logging
 
 log = logging.getLogger()
 
+# Build command and site shared with the child processes of
+# Build.write_multi_process
+_worker_state = None
+
+def _write_pages_worker(linkpaths):
+    build, site = _worker_state
+    return build.write_pages(site, [site.pages[x] for x in linkpaths])
+
+def link_or_copy(src, dst):
+    """
+    Hardlink src to dst, or copy it if they are on different file systems
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
 class Build(SiteCommand):
     "build the site into the web/ directory of the project"
 
@@ -21,102 +45,379 @@ class Build(SiteCommand):
         self.output_root = os.path.join(self.root, settings.OUTPUT)
 
     def run(self):
+        if self.args.profile or self.args.profile_dump:
+            self.run_profiled()
+        else:
+            self.build()
+
+    def build(self):
         site = self.load_site()
-        self.write(site)
+        if self.args.staged:
+            self.write_staged(site)
+        else:
+            self.write(site)
 
-    def clear_outdir(self, outdir):
-        for f in os.listdir(outdir):
-            abs = os.path.join(outdir, f)
-            if os.path.isdir(abs):
-                shutil.rmtree(abs)
-            else:
-                os.unlink(abs)
+    def run_profiled(self):
+        """
+        Build the site collecting profiling information
+        """
+        if self.args.jobs > 1:
+            log.warn("profiling renders pages in a single process")
+            self.args.jobs = 1
 
-    def write(self, site):
+        profiler = profile.enable()
+
+        if self.args.profile_dump:
+            import cProfile
+            prof = cProfile.Profile()
+            prof.enable()
+            try:
+                self.build()
+            finally:
+                prof.disable()
+                prof.dump_stats(self.args.profile_dump)
+        else:
+            self.build()
+
+        if self.args.profile:
+            profiler.report(sys.stdout, top=self.args.profile)
+
+    def write_staged(self, site):
         """
-        Generate output
+        Generate output in a new directory next to the output directory, then
+        atomically replace the output directory with a symlink to it.
+
+        Unless doing a full build, the new directory starts as a copy of the
+        previous build made with hardlinks, so that only what changed needs to
+        be written.
+
+        The directory of the previous build is removed only if it was created
+        by a previous staged build.
         """
-        # Clear the target directory, but keep the root path so that a web
-        # server running on it does not find itself running nowhere
-        if os.path.exists(self.output_root):
-            with timings("Cleaned output directory in %fs"):
-                self.clear_outdir(self.output_root)
+        output_root = self.output_root.rstrip("/")
+        parent, name = os.path.split(output_root)
+        os.makedirs(parent, exist_ok=True)
 
-        with timings("Built site in %fs"):
-            # cpu_count = os.cpu_count()
-            # if cpu_count > 1:
-            #     self.write_multi_process(site, cpu_count)
-            # else:
-            #     self.write_single_process(site)
-
-            # I tried trivial parallelisation with child processes but the benefits
-            # do not seem significant:
-            #
-            #     real  0m5.111s
-            #     user  0m8.096s
-            #     sys   0m0.644s
-            #
-            # compared with:
-            #
-            #     real  0m6.251s
-            #     user  0m5.760s
-            #     sys   0m0.468s
-            self.write_single_process(site)
-
-    def write_multi_process(self, site, child_count):
-        log.info("Generating pages using %d child processes", child_count)
+        previous = os.path.realpath(output_root) if os.path.exists(output_root) else None
 
-        pages = list(site.pages.values())
+        staging = tempfile.mkdtemp(dir=parent, prefix=name + ".")
+        os.chmod(staging, 0o755)
+        self.output_root = staging
+        try:
+            if previous is not None and not self.args.full:
+                with timings("Seeded staging directory from the previous build in %fs"):
+                    self.seed_staging(previous, staging)
+            self.write(site)
+        except:
+            shutil.rmtree(staging)
+            raise
+        finally:
+            self.output_root = output_root
 
-        # From http://code.activestate.com/recipes/576785-partition-an-iterable-into-n-lists/
-        chunks = [pages[i::child_count] for i in range(child_count)]
+        # Replace the output directory with a symlink to the new build
+        if os.path.isdir(output_root) and not os.path.islink(output_root):
+            # A directory cannot be atomically replaced with a symlink: move
+            # it out of the way first, with a name that does not look like a
+            # staged build, and keep it. Builds after this one will be atomic
+            kept = output_root + ".orig"
+            count = 1
+            while os.path.lexists(kept):
+                kept = "{}.orig-{}".format(output_root, count)
+                count += 1
+            os.rename(output_root, kept)
+            log.warn("%s: replacing directory with a symlink to the staged build, and moving the directory to %s",
+                     output_root, kept)
+            previous = None
+        newlink = os.path.join(parent, "." + name + ".new")
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(newlink)
+        os.symlink(os.path.basename(staging), newlink)
+        os.replace(newlink, output_root)
+        log.info("%s: now points to %s", output_root, staging)
 
-        print(len(pages))
-        for c in chunks:
-            print(len(c))
+        if previous is None:
+            return
+        if self.is_staging(previous, parent, name):
+            shutil.rmtree(previous)
+        else:
+            log.warn("%s: previous output directory %s was not created by ssite build --staged: leaving it in place",
+                     output_root, previous)
 
-        import sys
-        pids = set()
-        for chunk in chunks:
-            pid = os.fork()
-            if pid == 0:
-                self.write_pages(chunk)
-                sys.exit(0)
+    def seed_staging(self, previous, staging):
+        """
+        Fill the empty directory staging with hardlinks to the files in
+        previous
+        """
+        # copytree can only copy into an existing directory from Python 3.8,
+        # so copy the contents of previous one by one
+        with os.scandir(previous) as entries:
+            for entry in entries:
+                dst = os.path.join(staging, entry.name)
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), dst)
+                elif entry.is_dir():
+                    shutil.copytree(entry.path, dst, symlinks=True, copy_function=link_or_copy)
+                else:
+                    link_or_copy(entry.path, dst)
+
+    def is_staging(self, abspath, parent, name):
+        """
+        Check if abspath is a directory created by write_staged to build the
+        output directory `name` in `parent`
+        """
+        dirname, basename = os.path.split(abspath)
+        if dirname != os.path.realpath(parent):
+            return False
+        # The prefix given to mkdtemp, followed by its random characters
+        return re.match(re.escape(name) + r"\.[a-z0-9_]{8}$", basename) is not None and os.path.isdir(abspath)
+
+    def write(self, site):
+        """
+        Generate output
+        """
+        self.build_cache = BuildCache(site, self.output_root)
+        self.manifest = Manifest(self.output_root)
+        if not self.args.full:
+            self.build_cache.load()
+            self.manifest.load()
+        else:
+            # Render markdown and highlight code again instead of reusing
+            # what previous builds cached
+            for name in ("markdown", "highlight"):
+                site.caches.get(name).clear()
+            site.caches.commit()
+
+        # Skip the pages whose previous output can be reused
+        pages = []
+        for page in site.pages.values():
+            if self.build_cache.is_fresh(page):
+                for relpath in self.build_cache.entries[page.src_linkpath]["outputs"]:
+                    self.manifest.carry_over(relpath, page)
             else:
-                pids.add(pid)
+                pages.append(page)
 
-        while pids:
-            (pid, status) = os.wait()
-            pids.discard(pid)
+        # Output files are only replaced if their contents changed, and the
+        # output directory is never cleared, so that unchanged files keep
+        # their modification times, and a web server running on it does not
+        # find itself running nowhere
+        with timings("Built site in %fs"):
+            if self.args.jobs > 1 and len(pages) > 1:
+                sums, counts, files = self.write_multi_process(site, pages, self.args.jobs)
+            else:
+                sums, counts, files = self.write_single_process(site, pages)
 
-    def write_single_process(self, site):
-        sums, counts = self.write_pages(site.pages.values())
         for type in sorted(sums.keys()):
             log.info("%s: %d in %.3fs (%.1f per minute)", type, counts[type], sums[type], counts[type]/sums[type] * 60)
+        skipped = len(site.pages) - len(pages)
+        if skipped:
+            log.info("%d unchanged pages skipped", skipped)
+        log.info("%d output files written, %d unchanged", files["written"], files["unchanged"])
+        if files["reused"]:
+            log.info("%d output files of rendered pages reused from the previous build", files["reused"])
+
+        with timings("Removed stale output files in %fs"):
+            if self.build_cache.previous is None:
+                # We do not know what was generated by the previous build:
+                # look for stale files in the whole output directory
+                self.remove_unknown_outputs()
+            else:
+                self.remove_outputs(self.build_cache.stale_outputs())
+
+        self.manifest.save()
+        self.build_cache.save()
+
+    def remove_outputs(self, relpaths):
+        """
+        Remove the given files from the output directory, together with the
+        directories that they leave empty
+        """
+        for relpath in relpaths:
+            abspath = os.path.join(self.output_root, relpath)
+            try:
+                os.unlink(abspath)
+            except FileNotFoundError:
+                continue
+            log.debug("%s: removed stale output file", relpath)
+            dirname = os.path.dirname(abspath)
+            while dirname != self.output_root:
+                try:
+                    os.rmdir(dirname)
+                except OSError:
+                    break
+                dirname = os.path.dirname(dirname)
+
+    def remove_unknown_outputs(self):
+        """
+        Remove from the output directory all files that have not been
+        generated by this build
+        """
+        outputs = set(self.manifest.outputs.keys())
+        outputs.add(MANIFEST_NAME)
+
+        for root, dnames, fnames in os.walk(self.output_root, topdown=False):
+            for f in fnames:
+                abspath = os.path.join(root, f)
+                relpath = os.path.relpath(abspath, self.output_root)
+                if relpath in outputs: continue
+                log.debug("%s: removed stale output file", relpath)
+                os.unlink(abspath)
+            if root != self.output_root and not os.listdir(root):
+                os.rmdir(root)
+
+    def write_multi_process(self, site, pages, child_count):
+        """
+        Render pages using a pool of child processes.
+
+        Children are forked after the site has been loaded, so they do not need
+        to load it again.
+        """
+        global _worker_state
+
+        chunks = self.schedule_chunks(pages, child_count * 4)
+        log.info("Generating pages using %d child processes", child_count)
 
-    def write_pages(self, pages):
         sums = defaultdict(float)
         counts = defaultdict(int)
+        files = Counter()
+
+        _worker_state = (self, site)
+        try:
+            with multiprocessing.get_context("fork").Pool(child_count) as pool:
+                for chunk_sums, chunk_counts, chunk_files, records in pool.imap_unordered(_write_pages_worker, chunks):
+                    for type, elapsed in chunk_sums.items():
+                        sums[type] += elapsed
+                    for type, count in chunk_counts.items():
+                        counts[type] += count
+                    files.update(chunk_files)
+                    self.merge_records(site, records)
+        finally:
+            _worker_state = None
+
+        return sums, counts, files
+
+    def schedule_chunks(self, pages, chunk_count):
+        """
+        Split pages into lists of linkpaths with a similar estimated rendering
+        cost.
 
-        # group by type
-        by_type = defaultdict(list)
-        for page in pages:
-            by_type[(page.RENDER_PREFERRED_ORDER, page.TYPE)].append(page)
+        The most expensive chunks come first, so that the cheap ones can fill
+        in the gaps at the end.
+        """
+        costs = sorted(((self.build_cache.estimated_cost(p), p) for p in pages), key=lambda x: x[0], reverse=True)
+        total = sum(c for c, p in costs)
+        if total <= 0:
+            # Nothing is known about how long pages take: split them by count
+            costs = [(1, p) for c, p in costs]
+            total = len(costs)
+        target = total / chunk_count
+
+        chunks = []
+        chunk = []
+        chunk_cost = 0
+        for cost, page in costs:
+            chunk.append(page.src_linkpath)
+            chunk_cost += cost
+            if chunk_cost >= target:
+                chunks.append(chunk)
+                chunk = []
+                chunk_cost = 0
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def write_single_process(self, site, pages):
+        sums, counts, files, records = self.write_pages(site, pages)
+        self.merge_records(site, records)
+        return sums, counts, files
+
+    def merge_records(self, site, records):
+        """
+        Store in the build cache and in the manifest the information about
+        rendered pages returned by write_pages
+        """
+        for linkpath, outputs, deps, elapsed in records:
+            page = site.pages[linkpath]
+            self.build_cache.update(page, deps, elapsed)
+            for relpath, entry in outputs.items():
+                if entry is None:
+                    self.manifest.carry_over(relpath, page)
+                else:
+                    self.manifest.outputs[relpath] = entry
+
+    def write_pages(self, site, pages):
+        """
+        Render and write pages.
 
-        # Render collecting timing statistics
-        for (order, type), pgs in sorted(by_type.items(), key=lambda x:x[0][0]):
+        Outputs that the build cache considers reusable are not written.
+
+        Returns the time spent and the number of pages rendered for each page
+        type, the count of "written", "unchanged" and "reused" output files,
+        and a list of (linkpath, outputs, dependencies, time) for each page.
+        outputs maps the relative path of each output file to its manifest
+        entry, and dependencies maps it to the set of dependencies recorded
+        while generating it. Both map reused outputs to None.
+        """
+        sums = defaultdict(float)
+        counts = defaultdict(int)
+        files = Counter()
+        records = []
+
+        # Render in the preferred order, collecting timing statistics
+        for page in sorted(pages, key=lambda p: p.RENDER_PREFERRED_ORDER):
+            reusable = self.build_cache.reusable_outputs(page)
             start = time.perf_counter()
-            for page in pgs:
-                contents = page.render()
-                for relpath, rendered in contents.items():
-                    dst = self.output_abspath(relpath)
-                    rendered.write(dst)
-            end = time.perf_counter()
-            sums[type] = end - start
-            counts[type] = len(pgs)
-        return sums, counts
+            outputs = {}
+            output_deps = {}
+            with profile.profiler.timer("page", page.src_linkpath or "/"):
+                # Outputs are rendered as they are written, so the time spent
+                # generating each output file includes rendering it.
+                # Dependencies are tracked separately for each output, so that
+                # the next build can generate again only the ones that changed
+                output_start = start
+                rendered_outputs = iter(page.render())
+                while True:
+                    with site.track_dependencies() as deps:
+                        try:
+                            relpath, rendered = next(rendered_outputs)
+                        except StopIteration:
+                            break
+                        if relpath in reusable:
+                            files["reused"] += 1
+                            outputs[relpath] = output_deps[relpath] = None
+                            output_start = time.perf_counter()
+                            continue
+                        dst = self.output_abspath(relpath)
+                        with profile.profiler.timer("output", relpath):
+                            written = rendered.write(dst, self.manifest.previous.get(relpath, None))
+                    if written:
+                        files["written"] += 1
+                    else:
+                        files["unchanged"] += 1
+                    output_end = time.perf_counter()
+                    outputs[relpath] = self.manifest.describe(relpath, page, output_end - output_start)
+                    output_deps[relpath] = deps
+                    output_start = output_end
+            elapsed = time.perf_counter() - start
+            sums[page.TYPE] += elapsed
+            counts[page.TYPE] += 1
+            records.append((page.src_linkpath, outputs, output_deps, elapsed))
+
+        # Save what was cached while rendering
+        site.caches.commit()
+
+        return sums, counts, files, records
 
     def output_abspath(self, relpath):
         abspath = os.path.join(self.output_root, relpath)
         os.makedirs(os.path.dirname(abspath), exist_ok=True)
         return abspath
+
+    @classmethod
+    def make_subparser(cls, subparsers):
+        parser = super().make_subparser(subparsers)
+        parser.add_argument("--full", action="store_true", help="ignore the results of the previous build and the cached markdown rendering, render all pages again and remove all other files from the output directory")
+        parser.add_argument("--staged", action="store_true", help="build into a new directory next to the output directory, then atomically replace the output directory with a symlink to it")
+        parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N", help="render pages using N processes (default: 1)")
+        parser.add_argument("--profile", type=int, nargs="?", const=20, metavar="N", help="print the time spent rendering pages, outputs, templates, markdown and writing, showing the N slowest of each (default: 20)")
+        parser.add_argument("--profile-dump", metavar="FILE", help="save cProfile statistics to FILE, to be examined with pstats")
+        return parser
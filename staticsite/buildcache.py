@@ -0,0 +1,327 @@
+# coding: utf-8
+import os
+import json
+import hashlib
+from collections import defaultdict
+from .core import settings
+import logging
+
+log = logging.getLogger()
+
+# Incremental builds.
+#
+# After rendering a page, the build cache stores a fingerprint of its inputs
+# (source file, front matter, theme and settings), the list of files it
+# generated, and for each file the dependencies recorded with
+# Site.record_dependency() while it was being rendered. A dependency is a tuple
+# whose first element is its kind, and the rest are the arguments needed to
+# recompute it:
+#
+# ("link", root, target)
+#     a link to target was resolved starting from the directory root
+# ("site_pages", path, limit, sort)
+#     the page queried the site with site_pages()
+# ("meta_index", name, value)
+#     the page used the list of pages with value in the taxonomy field name
+# ("taxonomies",)
+#     the page used the list of taxonomies
+# ("taxonomy", linkpath)
+#     the page used the items of the taxonomy at linkpath
+# ("taxonomy_item", linkpath, name)
+#     the page used the pages of the item name of the taxonomy at linkpath
+# ("dir", linkpath)
+#     the page used the contents of the directory index at linkpath
+#
+# At the next build, a page is rendered again if its fingerprint changed.
+# Otherwise, only its output files whose dependencies now evaluate to
+# something different, or that are missing, are generated again.
+
+
+def fingerprint(value):
+    """
+    Compute a short string that changes if value changes.
+
+    value needs to be serializable as JSON; values that JSON does not support,
+    like datetimes, are converted to strings.
+    """
+    data = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(abspath):
+    """
+    Compute a fingerprint of a file using its size and modification time
+    """
+    try:
+        st = os.stat(abspath)
+    except FileNotFoundError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def theme_fingerprint(theme_root):
+    """
+    Compute a fingerprint of all the templates in a theme
+    """
+    res = []
+    for root, dnames, fnames in os.walk(theme_root):
+        if root == theme_root and "static" in dnames:
+            # Static assets are pages on their own
+            dnames.remove("static")
+        dnames.sort()
+        for f in sorted(fnames):
+            abspath = os.path.join(root, f)
+            res.append((os.path.relpath(abspath, theme_root), file_fingerprint(abspath)))
+    return fingerprint(res)
+
+
+class Fingerprints:
+    """
+    Compute fingerprints of pages and of dependencies, memoizing them.
+
+    Memoized values become invalid when the site changes: clear() needs to be
+    called then.
+    """
+    def __init__(self, site):
+        self.site = site
+        self.clear()
+
+    def clear(self):
+        # Memoized fingerprints of pages and dependencies
+        self._page_fingerprints = {}
+        self._dependency_fingerprints = {}
+
+    def page_fingerprint(self, page):
+        """
+        Fingerprint of the inputs of a page: its source file and its metadata
+        """
+        res = self._page_fingerprints.get(page.src_linkpath, None)
+        if res is None:
+            try:
+                st = page.src_stat
+            except FileNotFoundError:
+                st = None
+            # Like `now` in templates, the generation time is not considered
+            # an input, or pages using it would never be up to date
+            meta = {k: (None if v is self.site.generation_time else v) for k, v in page.meta.items()}
+            res = fingerprint({
+                "type": page.TYPE,
+                "src": (st.st_size, st.st_mtime_ns) if st is not None else None,
+                "meta": meta,
+            })
+            self._page_fingerprints[page.src_linkpath] = res
+        return res
+
+    def dependency_fingerprint(self, dep):
+        """
+        Fingerprint of the current value of a dependency
+        """
+        res = self._dependency_fingerprints.get(dep, None)
+        if res is None:
+            kind = dep[0]
+            if kind == "link":
+                page = self.site.resolve_link(dep[1], dep[2])
+                value = page.dst_link if page is not None else None
+            elif kind == "site_pages":
+                value = [self.page_fingerprint(p) for p in self.site.theme.find_pages(*dep[1:])]
+            elif kind == "meta_index":
+                value = [self.page_fingerprint(p) for p in self.site.pages_with(dep[1], dep[2])]
+            elif kind == "taxonomies":
+                value = [t.src_linkpath for t in self.site.taxonomies]
+            elif kind == "taxonomy_item":
+                taxonomy = self.site.pages.get(dep[1], None)
+                item = taxonomy.items.get(dep[2], None) if taxonomy is not None else None
+                if item is None:
+                    value = None
+                else:
+                    # Membership and metadata of the item pages, in the order
+                    # in which they are rendered
+                    value = [(p.src_linkpath, self.page_fingerprint(p)) for p in item.pages_by_date]
+            elif kind == "taxonomy":
+                taxonomy = self.site.pages.get(dep[1], None)
+                if taxonomy is None:
+                    value = None
+                else:
+                    value = sorted(
+                        (name, sorted(self.page_fingerprint(p) for p in item.pages))
+                        for name, item in taxonomy.items.items())
+            elif kind == "dir":
+                page = self.site.pages.get(dep[1], None)
+                if page is None or page.TYPE != "dir":
+                    value = None
+                else:
+                    # Rendering sorts subdirs in place, so their order
+                    # depends on whether the index was rendered already
+                    value = [self.page_fingerprint(p) for p in page.pages]
+                    value.extend(sorted(self.page_fingerprint(p) for p in page.subdirs))
+                    if page.src_relpath:
+                        parent = self.site.pages.get(os.path.dirname(page.src_relpath), None)
+                        if parent is not None:
+                            value.append(self.page_fingerprint(parent))
+            else:
+                raise ValueError("unknown dependency kind {}".format(kind))
+            self._dependency_fingerprints[dep] = res = fingerprint(value)
+        return res
+
+
+class BuildCache(Fingerprints):
+    """
+    Information about the previous build, used to only render the pages whose
+    inputs have changed
+    """
+    def __init__(self, site, output_root):
+        super().__init__(site)
+        self.output_root = output_root
+        self.cache = site.caches.get("build")
+
+        # Fingerprint of what is used by all pages
+        self.global_fingerprint = fingerprint({
+            "format": 2,
+            "settings": settings.as_dict(),
+            "theme": theme_fingerprint(site.theme.root),
+        })
+
+        # Page entries from the previous build, or None if no information
+        # about the previous build is available
+        self.previous = None
+
+        # True if the entries of the previous build can still be used
+        self.previous_valid = False
+
+        # Page entries for this build
+        self.entries = {}
+
+        # Map the linkpaths of pages that need rendering to the set of their
+        # outputs that can be reused from the previous build
+        self.reusable = {}
+
+        # Average rendering time per output for each page type, computed on
+        # demand by estimated_cost()
+        self._type_costs = None
+
+    def load(self):
+        """
+        Load information about the previous build
+        """
+        state = self.cache.get("build", None)
+        if state is None:
+            return
+        self.previous = state["pages"]
+        self.previous_valid = state["fingerprint"] == self.global_fingerprint
+        if not self.previous_valid:
+            log.info("Settings or theme changed since the last build: rendering all pages")
+
+    def save(self):
+        """
+        Save information about this build
+        """
+        self.cache.put("build", {
+            "fingerprint": self.global_fingerprint,
+            "pages": self.entries,
+        })
+        self.cache.commit()
+
+    def is_fresh(self, page):
+        """
+        Check if all the outputs of the previous build for this page can be
+        reused.
+
+        If they can, carry the page information over to this build. If only
+        some can, remember them: see reusable_outputs().
+        """
+        if not self.previous_valid:
+            return False
+
+        entry = self.previous.get(page.src_linkpath, None)
+        if entry is None:
+            return False
+
+        if entry["fingerprint"] != self.page_fingerprint(page):
+            return False
+
+        reusable = set()
+        for relpath, deps in entry["outputs"].items():
+            if not all(self.dependency_fingerprint(dep) == value for dep, value in deps.items()):
+                continue
+            if not os.path.exists(os.path.join(self.output_root, relpath)):
+                continue
+            reusable.add(relpath)
+
+        targets = page.target_relpaths()
+        if not reusable.issuperset(targets):
+            if reusable:
+                self.reusable[page.src_linkpath] = reusable
+            return False
+
+        # Outputs that the page does not generate anymore are left out, and
+        # will be removed as stale
+        self.entries[page.src_linkpath] = dict(entry, outputs={relpath: entry["outputs"][relpath] for relpath in targets})
+        return True
+
+    def reusable_outputs(self, page):
+        """
+        Return the set of relative paths of the outputs of a page that needs
+        rendering, whose previous version can be kept
+        """
+        return self.reusable.get(page.src_linkpath, frozenset())
+
+    def update(self, page, outputs, elapsed=None):
+        """
+        Record information about a page that has just been rendered in
+        `elapsed` seconds.
+
+        outputs maps the relative path of each output file to the
+        dependencies recorded while generating it, or to None if the output
+        was reused from the previous build.
+        """
+        previous = self.previous.get(page.src_linkpath, None) if self.previous else None
+        entry_outputs = {}
+        for relpath, deps in outputs.items():
+            if deps is None:
+                entry_outputs[relpath] = previous["outputs"][relpath]
+            else:
+                entry_outputs[relpath] = {dep: self.dependency_fingerprint(dep) for dep in deps}
+        self.entries[page.src_linkpath] = {
+            "type": page.TYPE,
+            "fingerprint": self.page_fingerprint(page),
+            "outputs": entry_outputs,
+            "time": elapsed,
+        }
+
+    def estimated_cost(self, page):
+        """
+        Estimate the time needed to render a page, based on the previous build
+        """
+        if self.previous:
+            entry = self.previous.get(page.src_linkpath, None)
+            if entry is not None and entry.get("time") is not None:
+                return entry["time"]
+
+        # Fall back to the average time per output of pages of the same type,
+        # times the number of outputs of this page
+        if self._type_costs is None:
+            sums = defaultdict(float)
+            counts = defaultdict(int)
+            for entry in (self.previous or {}).values():
+                if entry.get("time") is None: continue
+                sums[entry["type"]] += entry["time"]
+                counts[entry["type"]] += len(entry["outputs"]) or 1
+            self._type_costs = {t: sums[t] / counts[t] for t in sums}
+        return self._type_costs.get(page.TYPE, 0.001) * len(page.target_relpaths())
+
+    def stale_outputs(self):
+        """
+        Return the relative paths of the outputs of the previous build that
+        are not generated anymore
+        """
+        if not self.previous:
+            return set()
+
+        res = set()
+        for entry in self.previous.values():
+            res.update(entry["outputs"])
+
+        for entry in self.entries.values():
+            res.difference_update(entry["outputs"])
+
+        return res
@@ -0,0 +1,162 @@
+# coding: utf-8
+import os
+import pickle
+import sqlite3
+import threading
+import logging
+
+log = logging.getLogger()
+
+
+class Caches:
+    """
+    Persistent caches stored in the cache directory of a project.
+
+    Each cache is a separate key/value store identified by name. If root is
+    None, caching is disabled and all caches behave as if they were always
+    empty.
+    """
+    def __init__(self, root=None):
+        # Absolute path to the cache directory, or None if caching is disabled
+        self.root = root
+
+        # Map names to the caches that have been opened
+        self.caches = {}
+
+        # Caches can be opened and committed by threads rendering in parallel
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Return the cache with the given name, opening it if needed
+        """
+        with self._lock:
+            res = self.caches.get(name, None)
+            if res is None:
+                if self.root is None:
+                    res = DisabledCache()
+                else:
+                    os.makedirs(self.root, exist_ok=True)
+                    res = Cache(os.path.join(self.root, name + ".sqlite"))
+                self.caches[name] = res
+            return res
+
+    def commit(self):
+        with self._lock:
+            caches = list(self.caches.values())
+        for cache in caches:
+            cache.commit()
+
+
+class Cache:
+    """
+    Key/value store backed by a sqlite database.
+
+    Keys are strings, values are anything that can be pickled.
+
+    Values stored with put() are only written to the database by commit(), so
+    that the database is kept locked only briefly, even if several processes
+    write to it while building.
+    """
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self._db = None
+        self._pid = None
+        # Pickled values stored since the last commit, by key
+        self._pending = {}
+        # Serializes use of the connection by threads rendering in parallel
+        self._lock = threading.RLock()
+
+    @property
+    def db(self):
+        # sqlite connections cannot be shared with forked child processes, so
+        # each process opens its own. They can be used by threads other than
+        # the one that opened them, like the worker thread of ssite serve, or
+        # threads rendering pages in parallel
+        with self._lock:
+            if self._pid != os.getpid():
+                # Pending values of the parent process are its own to commit
+                self._pending = {}
+                self._db = sqlite3.connect(self.pathname, timeout=60, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+                self._pid = os.getpid()
+            return self._db
+
+    def get(self, key, default=None):
+        with self._lock:
+            db = self.db
+            data = self._pending.get(key, None)
+            if data is None:
+                row = db.execute("SELECT value FROM cache WHERE key=?", (key,)).fetchone()
+                if row is None:
+                    return default
+                data = row[0]
+        try:
+            return pickle.loads(data)
+        except Exception:
+            log.warn("%s: ignoring unreadable cache entry %s", self.pathname, key)
+            return default
+
+    def put(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            # Make sure the connection belongs to this process
+            self.db
+            self._pending[key] = data
+
+    def delete(self, key):
+        with self._lock:
+            db = self.db
+            self._pending.pop(key, None)
+            db.execute("DELETE FROM cache WHERE key=?", (key,))
+
+    def items(self):
+        """
+        Generate all (key, value) pairs in the cache
+        """
+        with self._lock:
+            self.commit()
+            rows = self.db.execute("SELECT key, value FROM cache").fetchall()
+        for key, value in rows:
+            try:
+                yield key, pickle.loads(value)
+            except Exception:
+                log.warn("%s: ignoring unreadable cache entry %s", self.pathname, key)
+
+    def clear(self):
+        with self._lock:
+            db = self.db
+            self._pending = {}
+            db.execute("DELETE FROM cache")
+
+    def commit(self):
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                if self._pending:
+                    self._db.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                                         self._pending.items())
+                    self._pending = {}
+                self._db.commit()
+
+
+class DisabledCache:
+    """
+    Cache that never stores anything
+    """
+    def get(self, key, default=None):
+        return default
+
+    def put(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def items(self):
+        return ()
+
+    def clear(self):
+        pass
+
+    def commit(self):
+        pass
@@ -30,5 +30,8 @@ class Check(SiteCommand):
                 if not isinstance(date, datetime.datetime):
                     log.info("%s: meta date %r is not an instance of datetime", page.src_relpath, date)
 
+        # Save what was cached while checking
+        site.caches.commit()
+
         for type, count in sorted(counts.items()):
             print("{} {} pages".format(count, type))
@@ -59,6 +59,16 @@ class SiteCommand:
         if not os.path.exists(self.theme_root):
             raise CmdlineError("Theme directory {} does not exist".format(self.theme_root))
 
+        if settings.CACHE:
+            self.cache_root = os.path.join(self.root, settings.CACHE)
+        else:
+            self.cache_root = None
+
+        if settings.THEME_COMPILED:
+            self.theme_compiled_root = os.path.join(self.root, settings.THEME_COMPILED)
+        else:
+            self.theme_compiled_root = None
+
     def setup_logging(self, args):
         FORMAT = "%(asctime)-15s %(levelname)s %(message)s"
         if args.debug:
@@ -74,7 +84,8 @@ class SiteCommand:
 
         # Read and analyze site contents
         with timings("Read site in %fs"):
-            site.load_theme(self.theme_root)
+            site.load_cache(self.cache_root)
+            site.load_theme(self.theme_root, self.theme_compiled_root)
             site.load_content(self.content_root)
 
         with timings("Analysed site tree in %fs"):
@@ -0,0 +1,24 @@
+# coding: utf-8
+
+from .commands import SiteCommand, CmdlineError
+from .site import Site
+from .utils import timings
+import logging
+
+log = logging.getLogger()
+
+class CompileTheme(SiteCommand):
+    "compile the templates of the theme ahead of time, so that they do not need to be parsed at each run"
+
+    NAME = "compile-theme"
+
+    def run(self):
+        if self.theme_compiled_root is None:
+            raise CmdlineError("THEME_COMPILED is not set in the site settings")
+
+        site = Site()
+        site.load_theme(self.theme_root)
+
+        with timings("Compiled theme in %fs"):
+            count = site.theme.compile_templates(self.theme_compiled_root)
+        log.info("%s: %d templates compiled", self.theme_compiled_root, count)
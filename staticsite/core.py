@@ -1,10 +1,13 @@
 # coding: utf-8
 import os
 import sys
+import copy
 import logging
 import shutil
+import hashlib
 import mimetypes
 from . import content
+from . import profile
 
 log = logging.getLogger()
 
@@ -59,6 +62,49 @@ settings = Settings()
 
 
 
+def intern_path(path):
+    """
+    Return path, sharing the same string object with other pages that use
+    the same path.
+
+    This saves memory when the same path is used as the source of a page and
+    as the link of another one, or as the key in Site.pages.
+    """
+    if path is None:
+        return None
+    return sys.intern(path)
+
+
+def intern_meta(meta):
+    """
+    Intern the keys of a metadata dict, and the strings in its list values
+    (like tags), which tend to be repeated across a lot of pages
+    """
+    res = {}
+    for key, val in meta.items():
+        if isinstance(val, list):
+            val = [sys.intern(x) if isinstance(x, str) else x for x in val]
+        res[sys.intern(key)] = val
+    return res
+
+
+class SourceStat:
+    """
+    The parts of an os.stat() result that are used by pages, stored in less
+    memory than the full os.stat_result
+    """
+    __slots__ = ("st_size", "st_mtime_ns", "st_ino")
+
+    def __init__(self, st):
+        self.st_size = st.st_size
+        self.st_mtime_ns = st.st_mtime_ns
+        self.st_ino = st.st_ino
+
+    @property
+    def st_mtime(self):
+        return self.st_mtime_ns / 1000000000
+
+
 class Archetype:
     def __init__(self, site, relpath):
         self.site = site
@@ -103,7 +149,18 @@ class Page:
     `meta`:
         a dictionary with the page metadata. See the README for documentation
         about its contents.
+    `src_stat`:
+        SourceStat with size, modification time and inode of the source file,
+        taken when the site was scanned, or None if the page has no source
+        file
+
+    Sites can have a lot of pages, so pages use `__slots__`, and `dst_relpath`
+    and `dst_link` are computed from `src_linkpath` when they are not given
+    explicitly. Subclasses need to declare `__slots__` for their own members.
     """
+    __slots__ = ("site", "root_abspath", "src_relpath", "src_linkpath", "_dst_relpath", "_dst_link", "meta",
+                 "_src_stat")
+
     # In what pass must pages of this type be analyzed.
     ANALYZE_PASS = 1
 
@@ -117,20 +174,40 @@ class Page:
     # taxonomies.
     RENDER_PREFERRED_ORDER = 1
 
-    def __init__(self, site, root_abspath, src_relpath, src_linkpath, dst_relpath, dst_link):
+    def __init__(self, site, root_abspath, src_relpath, src_linkpath, dst_relpath=None, dst_link=None, src_stat=None):
         self.site = site
         self.root_abspath = root_abspath
-        self.src_relpath = src_relpath
-        self.src_linkpath = src_linkpath
-        self.dst_relpath = dst_relpath
-        self.dst_link = dst_link
+        self.src_relpath = intern_path(src_relpath)
+        self.src_linkpath = intern_path(src_linkpath)
+        self._dst_relpath = dst_relpath
+        self._dst_link = dst_link
+        self._src_stat = SourceStat(src_stat) if src_stat is not None else None
         self.meta = {}
         log.debug("%s: new page, src_link: %s", src_relpath, src_linkpath)
 
+    @property
+    def dst_relpath(self):
+        return self._dst_relpath
+
+    @property
+    def dst_link(self):
+        if self._dst_link is not None:
+            return self._dst_link
+        return os.path.join(settings.SITE_ROOT, self.src_linkpath)
+
     @property
     def src_abspath(self):
         return os.path.join(self.root_abspath, self.src_relpath)
 
+    @property
+    def src_stat(self):
+        if self._src_stat is None:
+            src = self.src_abspath
+            if src is None:
+                return None
+            self._src_stat = SourceStat(os.stat(src))
+        return self._src_stat
+
     @property
     def date_as_iso8601(self):
         from dateutil.tz import tzlocal
@@ -149,31 +226,29 @@ class Page:
             tz_str = 'Z'
         return ts.strftime("%Y-%m-%d %H:%M:%S") + tz_str
 
-    def resolve_link(self, target):
-        dirname, basename = os.path.split(target)
-        if basename == "index.html":
-            #log.debug("%s: resolve %s using %s", self.src_relpath, target, dirname)
-            target = dirname
-        #else:
-            #log.debug("%s: resolve %s using %s", self.src_relpath, target, target)
-
-        # Absolute URLs are resolved as is
-        if target.startswith("/"):
-            if target == "/":
-                target_relpath = ""
-            else:
-                target_relpath = os.path.normpath(target.lstrip("/"))
-            #log.debug("%s: resolve absolute path using %s", self.src_relpath, target_relpath)
-            return self.site.pages.get(target_relpath, None)
+    def load_front_matter(self, parse):
+        """
+        Return the result of parse(src_abspath).
 
+        The result is stored in the persistent "frontmatter" cache, and reused
+        as long as the size, modification time and inode of the source file
+        stay the same. It needs to be something that can be pickled.
+        """
+        src = self.src_abspath
+        st = self.src_stat
+        identity = (st.st_size, st.st_mtime_ns, st.st_ino)
+        cache = self.site.caches.get("frontmatter")
+        cached = cache.get(src, None)
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+        res = parse(src)
+        cache.put(src, (identity, res))
+        return res
+
+    def resolve_link(self, target):
         root = os.path.dirname(self.src_relpath)
-        while True:
-            target_relpath = os.path.normpath(os.path.join(root, target))
-            res = self.site.pages.get(target_relpath, None)
-            if res is not None: return res
-            if not root or root == "/":
-                return None
-            root = os.path.dirname(root)
+        self.site.record_dependency("link", root, target)
+        return self.site.resolve_link(root, target)
 
     def read_metadata(self):
         """
@@ -184,6 +259,28 @@ class Page:
     def check(self, checker):
         pass
 
+    def render(self):
+        """
+        Generate (relpath, rendered) pairs for all the files that this page
+        generates.
+
+        Rendering can be done lazily, as each pair is requested.
+        """
+        return ()
+
+    def render_target(self, relpath):
+        """
+        Return the rendered object for only one of the files that this page
+        generates, or None if the page does not generate relpath.
+
+        Pages with many outputs should reimplement this to avoid preparing
+        all of them.
+        """
+        for target_relpath, rendered in self.render():
+            if target_relpath == relpath:
+                return rendered
+        return None
+
     def target_relpaths(self):
         return [self.dst_relpath]
 
@@ -198,40 +295,258 @@ class RenderedFile:
     def __init__(self, abspath):
         self.abspath = abspath
 
-    def write(self, dst):
-        shutil.copy2(self.abspath, dst)
+    def write(self, dst, previous=None):
+        """
+        Publish the file as dst using settings.ASSET_PUBLISH, unless dst is
+        already up to date.
+
+        previous is the manifest entry of dst in the previous build, if known,
+        which tells how dst was published.
+        """
+        from .utils import publish_file, is_published
+        published_with = previous.get("publish", None) if previous is not None else None
+        with profile.profiler.timer("write", "assets"):
+            if is_published(self.abspath, dst, settings.ASSET_PUBLISH, published_with):
+                return False
+
+            tmp = dst + ".tmp"
+            publish_file(self.abspath, tmp, settings.ASSET_PUBLISH)
+            os.replace(tmp, dst)
+            return True
 
     def content(self):
         with open(self.abspath, "rb") as fd:
             return fd.read()
 
 
+def same_contents(abspath1, abspath2):
+    """
+    Check if two files have the same contents, without reading them fully in
+    memory
+    """
+    with open(abspath1, "rb") as fd1:
+        with open(abspath2, "rb") as fd2:
+            while True:
+                buf1 = fd1.read(64 * 1024)
+                buf2 = fd2.read(64 * 1024)
+                if buf1 != buf2:
+                    return False
+                if not buf1:
+                    return True
+
+
+class RenderedTemplate:
+    """
+    Output of a Jinja2 template, rendered only when it is written.
+
+    The template is rendered in chunks, and written to the destination file as
+    it is generated, so that the whole rendered page is never kept in memory.
+    """
+    def __init__(self, template, **kwargs):
+        self.template = template
+        self.kwargs = kwargs
+
+    def write(self, dst, previous=None):
+        """
+        Write the rendered template to dst, unless dst already has the same
+        contents
+        """
+        tmp = dst + ".tmp"
+        chunks = self.template.generate(**self.kwargs)
+        try:
+            with open(tmp, "wb") as out:
+                for chunk in profile.profiler.iterate("template", self.template.name or "(content page)", chunks):
+                    out.write(chunk.encode("utf-8"))
+        except:
+            # Do not leave partial output behind
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+
+        with profile.profiler.timer("write", "templates"):
+            try:
+                if os.path.getsize(dst) == os.path.getsize(tmp) and same_contents(tmp, dst):
+                    os.unlink(tmp)
+                    return False
+            except FileNotFoundError:
+                pass
+
+            os.replace(tmp, dst)
+            return True
+
+    def content(self):
+        return self.template.render(**self.kwargs).encode("utf-8")
+
+
 class RenderedString:
     def __init__(self, s):
         self.buf = s.encode("utf-8")
 
-    def write(self, dst):
-        with open(dst, "wb") as out:
+    def write(self, dst, previous=None):
+        """
+        Write the string to dst, unless dst already has the same contents
+        """
+        try:
+            if os.path.getsize(dst) == len(self.buf):
+                with open(dst, "rb") as fd:
+                    if fd.read() == self.buf:
+                        return False
+        except FileNotFoundError:
+            pass
+
+        tmp = dst + ".tmp"
+        with open(tmp, "wb") as out:
             out.write(self.buf)
+        os.replace(tmp, dst)
+        return True
 
     def content(self):
         return self.buf
 
 
+class RenderedOutput:
+    """
+    Contents of an output file rendered by PageFS, with what is needed to tell
+    when it needs to be rendered again
+    """
+    __slots__ = ("page", "fingerprint", "dependencies", "etag", "content")
+
+    def __init__(self, page, fingerprint, dependencies, content):
+        # Page that rendered the file
+        self.page = page
+        # Fingerprint of the page when it rendered the file
+        self.fingerprint = fingerprint
+        # Map the dependencies recorded while rendering to their fingerprints
+        self.dependencies = dependencies
+        self.etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        self.content = content
+
+    @property
+    def size(self):
+        return len(self.content)
+
+    def body(self):
+        return [self.content]
+
+    def close(self):
+        pass
+
+
+class ServedFile:
+    """
+    Static file served by PageFS directly from disk.
+
+    The file is opened when the ServedFile is created, and its ETag is
+    computed from size, modification time and inode of what was opened.
+    """
+    __slots__ = ("fd", "size", "etag")
+
+    def __init__(self, abspath):
+        self.fd = open(abspath, "rb")
+        st = os.fstat(self.fd.fileno())
+        self.size = st.st_size
+        self.etag = '"{:x}-{:x}-{:x}"'.format(st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def body(self):
+        """
+        Generate the contents of the file in chunks, closing it at the end
+        """
+        try:
+            while True:
+                buf = self.fd.read(64 * 1024)
+                if not buf: break
+                yield buf
+        finally:
+            self.close()
+
+    def close(self):
+        self.fd.close()
+
+
 class PageFS:
     """
     VFS-like abstraction that maps the names of files that pages would render
     with the corresponding pages.
 
-    This can be used to render pages on demand.
+    This can be used to render pages on demand. Rendered files are kept in
+    memory, and are only rendered again after invalidate() finds that their
+    page or what they used changed. Static assets are not kept in memory, and
+    are served from disk.
     """
     def __init__(self):
         self.paths = {}
+        # Map dst_relpath to RenderedOutput
+        self.rendered = {}
+        # Fingerprints of the pages and dependencies of the site
+        self.fingerprints = None
 
     def add_site(self, site):
+        from .buildcache import Fingerprints
+        self.fingerprints = Fingerprints(site)
         for page in site.pages.values():
-            for relpath in page.target_relpaths():
-                self.add_page(page, relpath)
+            self.add_targets(page)
+
+    def copy(self):
+        """
+        Return a PageFS with the same paths and rendered files, that can be
+        changed without affecting this one
+        """
+        from .buildcache import Fingerprints
+        res = PageFS()
+        res.paths = dict(self.paths)
+        res.rendered = dict(self.rendered)
+        res.fingerprints = Fingerprints(self.fingerprints.site)
+        return res
+
+    def add_targets(self, page):
+        """
+        Add all the files generated by page
+        """
+        for relpath in page.target_relpaths():
+            self.add_page(page, relpath)
+
+    def remove_page(self, page):
+        """
+        Remove all the files generated by page
+        """
+        for relpath in page.target_relpaths():
+            if self.paths.get(relpath, None) is page:
+                del self.paths[relpath]
+                self.rendered.pop(relpath, None)
+
+    def invalidate(self, templates=False):
+        """
+        Forget the rendered files whose page or dependencies changed.
+
+        Call this after the site has changed. If templates is True, the theme
+        changed, and all rendered files are forgotten.
+        """
+        self.fingerprints.clear()
+        if templates:
+            self.rendered.clear()
+            return
+
+        for relpath, rendered in list(self.rendered.items()):
+            page = self.paths.get(relpath, None)
+            if page is None:
+                del self.rendered[relpath]
+                continue
+            if page is not rendered.page:
+                # The page was loaded again: keep what it rendered if its
+                # source and metadata did not change
+                if self.fingerprints.page_fingerprint(page) != rendered.fingerprint:
+                    del self.rendered[relpath]
+                    continue
+                # The RenderedOutput can be shared with a copy of this PageFS
+                rendered = copy.copy(rendered)
+                rendered.page = page
+                self.rendered[relpath] = rendered
+            for dep, value in rendered.dependencies.items():
+                if self.fingerprints.dependency_fingerprint(dep) != value:
+                    del self.rendered[relpath]
+                    break
 
     def add_page(self, page, dst_relpath=None):
         if dst_relpath is None:
@@ -253,11 +568,50 @@ class PageFS:
 
         return None, None
 
+    def cached(self, path):
+        """
+        Return the dst_relpath and RenderedOutput for path if it is already in
+        memory, else None, None
+        """
+        dst_relpath, page = self.get_page(os.path.normpath(path).lstrip("/"))
+        if page is None: return None, None
+        rendered = self.rendered.get(dst_relpath, None)
+        if rendered is None or rendered.page is not page: return None, None
+        return dst_relpath, rendered
+
+    def render(self, page, dst_relpath):
+        """
+        Render dst_relpath, or reuse it if it was rendered already.
+
+        Returns the RenderedOutput, a ServedFile for static assets, or None if
+        page does not render dst_relpath
+        """
+        rendered = self.rendered.get(dst_relpath, None)
+        if rendered is not None and rendered.page is page:
+            return rendered
+
+        with page.site.track_dependencies() as deps:
+            output = page.render_target(dst_relpath)
+            if output is None: return None
+            if isinstance(output, RenderedFile):
+                return ServedFile(output.abspath)
+            content = output.content()
+
+        # Save what was cached while rendering
+        page.site.caches.commit()
+
+        rendered = RenderedOutput(
+            page, self.fingerprints.page_fingerprint(page),
+            {dep: self.fingerprints.dependency_fingerprint(dep) for dep in deps},
+            content)
+        self.rendered[dst_relpath] = rendered
+        return rendered
+
     def serve_path(self, path, environ, start_response):
         """
         Render a page on the fly and serve it.
 
-        Call start_response with the page headers and return the bytes() with
+        Call start_response with the page headers and return an iterable with
         the page contents.
 
         start_response is the start_response from WSGI
@@ -267,15 +621,31 @@ class PageFS:
         dst_relpath, page = self.get_page(os.path.normpath(path).lstrip("/"))
         if page is None: return None
 
-        for relpath, rendered in page.render().items():
-            if relpath == dst_relpath:
-                break
-        else:
-            return None
+        rendered = self.render(page, dst_relpath)
+        if rendered is None: return None
+
+        return self.respond(dst_relpath, rendered, environ, start_response)
+
+    def respond(self, dst_relpath, rendered, environ, start_response):
+        """
+        Serve a RenderedOutput or a ServedFile, answering with 304 Not Modified
+        if the client already has it
+        """
+        headers = [
+            ("ETag", rendered.etag),
+            # Browsers check with the server before using their copy
+            ("Cache-Control", "no-cache"),
+        ]
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH", None)
+        if if_none_match is not None:
+            etags = [x.strip() for x in if_none_match.split(",")]
+            if rendered.etag in etags or "*" in etags or "W/" + rendered.etag in etags:
+                rendered.close()
+                start_response("304 Not Modified", headers)
+                return [b""]
 
-        content = rendered.content()
         start_response("200 OK", [
-            ("Content-Type", mimetypes.guess_type(relpath)[0]),
-            ("Content-Length", str(len(content))),
-        ])
-        return [content]
+            ("Content-Type", mimetypes.guess_type(dst_relpath)[0]),
+            ("Content-Length", str(rendered.size)),
+        ] + headers)
+        return rendered.body()
@@ -1,6 +1,6 @@
 # coding: utf-8
 
-from .core import Page, settings, RenderedString
+from .core import Page, settings, RenderedTemplate
 import os
 import re
 from collections import defaultdict
@@ -13,6 +13,8 @@ class DirPage(Page):
     """
     A directory index
     """
+    __slots__ = ("pages", "subdirs")
+
     TYPE = "dir"
     ANALYZE_PASS = 3
     RENDER_PREFERRED_ORDER = 2
@@ -22,9 +24,7 @@ class DirPage(Page):
             site=site,
             root_abspath=None,
             src_relpath=relpath,
-            src_linkpath=relpath,
-            dst_relpath=os.path.join(relpath, "index.html"),
-            dst_link=os.path.join(settings.SITE_ROOT, relpath))
+            src_linkpath=relpath)
 
         self.pages = list(pages)
         self.subdirs = []
@@ -38,6 +38,10 @@ class DirPage(Page):
         parent.subdirs.append(self)
         parent.attach_to_parent()
 
+    @property
+    def dst_relpath(self):
+        return os.path.join(self.src_linkpath, "index.html")
+
     @property
     def src_abspath(self):
         return None
@@ -60,17 +64,25 @@ class DirPage(Page):
         self.meta["title"] = os.path.basename(self.src_relpath) or settings.SITE_NAME
 
     def render(self):
-        self.subdirs.sort(key=lambda x:x.meta["title"])
+        yield self.dst_relpath, self.render_index()
+
+    def render_target(self, relpath):
+        if relpath != self.dst_relpath:
+            return None
+        return self.render_index()
+
+    def render_index(self):
+        self.site.record_dependency("dir", self.src_linkpath)
+        # Sort into a copy, since other threads may be rendering this page
+        subdirs = sorted(self.subdirs, key=lambda x:x.meta["title"])
         parent_page = None
         if self.src_relpath:
             parent = os.path.dirname(self.src_relpath)
             parent_page = self.site.pages.get(parent, None)
 
-        body = self.site.theme.dir_template.render(
+        return RenderedTemplate(
+            self.site.theme.dir_template,
             parent_page=parent_page,
             page=self,
-            pages=self.subdirs + self.pages,
+            pages=subdirs + self.pages,
         )
-        return {
-            self.dst_relpath: RenderedString(body)
-        }
@@ -21,6 +21,21 @@ THEME = "/usr/share/doc/staticsite/example/theme/"
 # Directory where the static site will be written by build
 OUTPUT = "web"
 
+# How static assets are published in the output directory: "copy",
+# "hardlink", "reflink" (copy sharing data blocks, on file systems that
+# support it) or "symlink". If the method cannot be used, for example because
+# the output directory is on a different file system, assets are copied
+ASSET_PUBLISH = "copy"
+
+# Directory where staticsite keeps persistent caches between runs.
+# Set to None to disable caching
+CACHE = ".staticsite-cache"
+
+# Directory where `ssite compile-theme` compiles the templates of the theme.
+# If it exists, templates are loaded from it unless their sources changed.
+# Set to None to always load templates from their sources
+THEME_COMPILED = ".staticsite-theme"
+
 # Time zone used for timestamps on the site
 TIMEZONE = "UTC"
 
@@ -1,6 +1,6 @@
 # coding: utf-8
 
-from .core import Archetype, Page, RenderedString, settings
+from .core import Archetype, Page, RenderedTemplate, settings
 import os
 import re
 from collections import defaultdict
@@ -17,24 +17,25 @@ class J2Pages:
     def __init__(self, site):
         self.site = site
 
-    def try_load_page(self, root_abspath, relpath):
+    def try_load_page(self, root_abspath, relpath, st=None):
         basename = os.path.basename(relpath)
         if ".j2." not in basename: return None
         try:
-            return J2Page(self, root_abspath, relpath)
+            return J2Page(self, root_abspath, relpath, st)
         except IgnorePage:
             return None
 
 
 class J2Page(Page):
+    __slots__ = ()
+
     TYPE = "jinja2"
 
     RENDER_PREFERRED_ORDER = 2
 
-    def __init__(self, j2env, root_abspath, relpath):
+    def __init__(self, j2env, root_abspath, relpath, st=None):
         dirname, basename = os.path.split(relpath)
         dst_basename = basename.replace(".j2", "")
-        dst_relpath = os.path.join(dirname, dst_basename)
 
         if dst_basename == "index.html":
             linkpath = dirname
@@ -46,8 +47,12 @@ class J2Page(Page):
             root_abspath=root_abspath,
             src_relpath=relpath,
             src_linkpath=linkpath,
-            dst_relpath=dst_relpath,
-            dst_link=os.path.join(settings.SITE_ROOT, linkpath))
+            src_stat=st)
+
+    @property
+    def dst_relpath(self):
+        dirname, basename = os.path.split(self.src_relpath)
+        return os.path.join(dirname, basename.replace(".j2", ""))
 
     def read_metadata(self):
         self.meta["date"] = self.site.generation_time
@@ -56,13 +61,8 @@ class J2Page(Page):
         with open(self.src_abspath, "rt") as fd:
             template_body = fd.read()
         try:
-            template = self.site.theme.jinja2.from_string(template_body)
+            template = self.site.theme.template_from_string(template_body)
         except:
             log.exception("%s: cannot load template", self.src_relpath)
             raise IgnorePage
-        body = template.render(
-            page=self,
-        )
-        return {
-            self.dst_relpath: RenderedString(body),
-        }
+        yield self.dst_relpath, RenderedTemplate(template, page=self)
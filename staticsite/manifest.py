@@ -0,0 +1,106 @@
+# coding: utf-8
+import os
+import json
+import hashlib
+import logging
+from .core import settings
+
+log = logging.getLogger()
+
+# Name of the manifest file in the output directory
+MANIFEST_NAME = ".staticsite-manifest.json"
+
+
+def file_sha256(abspath):
+    """
+    Compute the sha256 hexdigest of the contents of a file
+    """
+    h = hashlib.sha256()
+    with open(abspath, "rb") as fd:
+        while True:
+            buf = fd.read(1024 * 1024)
+            if not buf: break
+            h.update(buf)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Description of all the files in a build, saved as JSON in the output
+    directory.
+
+    For each output file, relative to the output directory, it records:
+
+    * `hash`: sha256 hexdigest of the contents
+    * `size`: size in bytes
+    * `mtime_ns`: modification time in nanoseconds
+    * `src`: relative path of the source of the page that generated it
+    * `type`: type of the page that generated it
+    * `time`: seconds spent generating it, or null if it was not generated
+      during the last build
+    * `publish`: for static assets, the `ASSET_PUBLISH` method requested to
+      publish it
+    """
+    def __init__(self, output_root):
+        self.output_root = output_root
+        self.pathname = os.path.join(output_root, MANIFEST_NAME)
+
+        # Entries from the previous build
+        self.previous = {}
+
+        # Entries for this build
+        self.outputs = {}
+
+    def load(self):
+        """
+        Load the manifest of the previous build, if present
+        """
+        try:
+            with open(self.pathname, "rt") as fd:
+                self.previous = json.load(fd)["outputs"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            log.warn("%s: ignoring unreadable manifest", self.pathname)
+
+    def describe(self, relpath, page, elapsed=None):
+        """
+        Compute the manifest entry of an output file of page.
+
+        The hash is reused from the previous manifest if the file has the same
+        size and modification time.
+        """
+        abspath = os.path.join(self.output_root, relpath)
+        st = os.stat(abspath)
+        old = self.previous.get(relpath, None)
+        if old is not None and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+            digest = old["hash"]
+        else:
+            digest = file_sha256(abspath)
+        res = {
+            "hash": digest,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "src": page.src_relpath,
+            "type": page.TYPE,
+            "time": elapsed,
+        }
+        if page.TYPE == "asset":
+            res["publish"] = settings.ASSET_PUBLISH
+        return res
+
+    def carry_over(self, relpath, page):
+        """
+        Add to this build an output file that was not generated again
+        """
+        old = self.previous.get(relpath, None)
+        if old is not None:
+            self.outputs[relpath] = dict(old, time=None)
+        else:
+            self.outputs[relpath] = self.describe(relpath, page)
+
+    def save(self):
+        tmp = self.pathname + ".tmp"
+        with open(tmp, "wt") as out:
+            json.dump({"outputs": self.outputs}, out, sort_keys=True, separators=(",", ":"))
+        os.replace(tmp, self.pathname)
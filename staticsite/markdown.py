@@ -1,19 +1,31 @@
 # coding: utf-8
 
-from .core import Archetype, Page, RenderedString, settings
+from .core import Archetype, Page, RenderedTemplate, intern_meta, settings
 import re
 import os
 import io
 import pytz
 import datetime
+import hashlib
+import threading
+import collections
+import contextlib
 import markdown
+import markdown.extensions.codehilite
+import markdown.extensions.fenced_code
 import dateutil.parser
 from urllib.parse import urlparse, urlunparse
-from .utils import parse_front_matter
+from .utils import parse_front_matter, fix_toml_timezones
+from . import profile
 import logging
 
 log = logging.getLogger()
 
+# Version of the way MarkdownPages renders html, which is part of the key of
+# the html in the "markdown" cache: increase it when changing the rendering,
+# so that html rendered by previous versions is not reused
+RENDER_FORMAT = 1
+
 class LinkResolver(markdown.treeprocessors.Treeprocessor):
     def run(self, root):
         for a in root.iter("a"):
@@ -57,6 +69,7 @@ class LinkResolver(markdown.treeprocessors.Treeprocessor):
                 dest = self.page.resolve_link(parsed.path[:-3])
         if dest is None:
             log.warn("%s: internal link %r does not resolve to any site page", self.page.src_relpath, url)
+            self.unresolved.append(url)
             return None
 
         return urlunparse(
@@ -77,21 +90,243 @@ class StaticSiteExtension(markdown.extensions.Extension):
     def set_page(self, page):
         self.page = page
         self.link_resolver.page = page
+        # Internal links that could not be resolved
+        self.link_resolver.unresolved = []
 
 
-class MarkdownPages:
-    def __init__(self, site):
-        self.site = site
+class MarkdownConverter:
+    """
+    A markdown.Markdown instance with its own StaticSiteExtension, to convert
+    one page at a time
+    """
+    def __init__(self, extensions):
         self.md_staticsite = StaticSiteExtension()
         self.markdown = markdown.Markdown(
-            extensions=[
-                "markdown.extensions.extra",
-                "markdown.extensions.codehilite",
-                "markdown.extensions.fenced_code",
-                self.md_staticsite,
-            ],
+            extensions=extensions + [self.md_staticsite],
             output_format="html5",
         )
+        if profile.profiler.enabled:
+            profile.profiler.instrument_markdown(self.markdown)
+
+    def convert(self, page, text):
+        """
+        Convert the markdown text of page to html, resolving its internal
+        links.
+
+        Returns the html and the list of internal links that could not be
+        resolved.
+        """
+        self.md_staticsite.set_page(page)
+        self.markdown.reset()
+        return self.markdown.convert(text), self.md_staticsite.link_resolver.unresolved
+
+
+class ConverterPool:
+    """
+    Markdown converters, checked out for each conversion so that pages can be
+    converted in parallel by different threads.
+
+    Converters are created on demand, and reused once they are returned to the
+    pool.
+    """
+    def __init__(self, extensions):
+        self.extensions = extensions
+        self.lock = threading.Lock()
+        self.free = []
+
+    @contextlib.contextmanager
+    def converter(self):
+        """
+        Check out a MarkdownConverter for the duration of the context
+        """
+        with self.lock:
+            conv = self.free.pop() if self.free else None
+        if conv is None:
+            conv = MarkdownConverter(self.extensions)
+        try:
+            yield conv
+        finally:
+            with self.lock:
+                self.free.append(conv)
+
+
+class HighlightCache:
+    """
+    Cache of code blocks highlighted by codehilite, which is also used by
+    fenced_code, kept in memory and in the "highlight" site cache.
+
+    Blocks are identified by their language, the codehilite options, and a
+    hash of their code. Finding the pygments lexer and formatter is a
+    significant part of the highlighting time, and is skipped too.
+
+    Markdown converters use it through codehilite_class, a CodeHilite
+    subclass installed by HighlightCacheExtension.
+    """
+    def __init__(self, site, memory_size=1024):
+        self.site = site
+        # Highlighted code by key, least recently used first
+        self.memory = collections.OrderedDict()
+        self.memory_size = memory_size
+        # Converters can highlight in parallel
+        self.lock = threading.Lock()
+
+        cache = self
+
+        class CachedCodeHilite(CodeHilite):
+            def hilite(self, *args, **kw):
+                return cache.hilite(self, *args, **kw)
+
+        self.codehilite_class = CachedCodeHilite
+
+    def key(self, codehilite, args, kw):
+        try:
+            import pygments
+            version = pygments.__version__
+        except ImportError:
+            version = None
+        options = sorted((k, v) for k, v in vars(codehilite).items() if k != "src")
+        h = hashlib.sha1(repr((version, options, args, sorted(kw.items()))).encode("utf-8"))
+        h.update(codehilite.src.encode("utf-8"))
+        return h.hexdigest()
+
+    def hilite(self, codehilite, *args, **kw):
+        """
+        Return the result of codehilite.hilite(*args, **kw), using the cache
+        """
+        key = self.key(codehilite, args, kw)
+        with self.lock:
+            res = self.memory.get(key, None)
+            if res is not None:
+                self.memory.move_to_end(key)
+                return res
+
+        cache = self.site.caches.get("highlight")
+        res = cache.get(key, None)
+        if res is None:
+            res = CodeHilite.hilite(codehilite, *args, **kw)
+            cache.put(key, res)
+
+        with self.lock:
+            self.memory[key] = res
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+        return res
+
+
+class CachedHiliteTreeprocessor(markdown.extensions.codehilite.HiliteTreeprocessor):
+    """
+    HiliteTreeprocessor that highlights code with a CodeHilite subclass
+    """
+    def __init__(self, md, config, codehilite_class):
+        super().__init__(md)
+        self.config = config
+        self.codehilite_class = codehilite_class
+
+    def run(self, root):
+        # Same as HiliteTreeprocessor.run in python-markdown 2.6
+        for block in root.iter("pre"):
+            if len(block) == 1 and block[0].tag == "code":
+                code = self.codehilite_class(
+                    block[0].text,
+                    linenums=self.config["linenums"],
+                    guess_lang=self.config["guess_lang"],
+                    css_class=self.config["css_class"],
+                    style=self.config["pygments_style"],
+                    noclasses=self.config["noclasses"],
+                    tab_length=self.markdown.tab_length,
+                    use_pygments=self.config["use_pygments"],
+                )
+                placeholder = self.markdown.htmlStash.store(code.hilite(), safe=True)
+                # Replace the code block with a placeholder paragraph, later
+                # removed when inserting the raw html
+                block.clear()
+                block.tag = "p"
+                block.text = placeholder
+
+
+class CachedFencedBlockPreprocessor(markdown.extensions.fenced_code.FencedBlockPreprocessor):
+    """
+    FencedBlockPreprocessor that highlights code with a CodeHilite subclass
+    """
+    def __init__(self, md, codehilite_class):
+        super().__init__(md)
+        self.codehilite_class = codehilite_class
+
+    def run(self, lines):
+        # Same as FencedBlockPreprocessor.run in python-markdown 2.6
+        if not self.checked_for_codehilite:
+            for ext in self.markdown.registeredExtensions:
+                if isinstance(ext, markdown.extensions.codehilite.CodeHiliteExtension):
+                    self.codehilite_conf = ext.config
+                    break
+            self.checked_for_codehilite = True
+
+        text = "\n".join(lines)
+        while True:
+            m = self.FENCED_BLOCK_RE.search(text)
+            if not m: break
+            if self.codehilite_conf:
+                code = self.codehilite_class(
+                    m.group("code"),
+                    linenums=self.codehilite_conf["linenums"][0],
+                    guess_lang=self.codehilite_conf["guess_lang"][0],
+                    css_class=self.codehilite_conf["css_class"][0],
+                    style=self.codehilite_conf["pygments_style"][0],
+                    use_pygments=self.codehilite_conf["use_pygments"][0],
+                    lang=(m.group("lang") or None),
+                    noclasses=self.codehilite_conf["noclasses"][0],
+                    hl_lines=markdown.extensions.fenced_code.parse_hl_lines(m.group("hl_lines")),
+                ).hilite()
+            else:
+                lang = self.LANG_TAG % m.group("lang") if m.group("lang") else ""
+                code = self.CODE_WRAP % (lang, self._escape(m.group("code")))
+            placeholder = self.markdown.htmlStash.store(code, safe=True)
+            text = "{}\n{}\n{}".format(text[:m.start()], placeholder, text[m.end():])
+        return text.split("\n")
+
+
+class HighlightCacheExtension(markdown.extensions.Extension):
+    """
+    Replace the codehilite and fenced_code processors of a markdown converter
+    with versions that highlight code through a HighlightCache.
+
+    This needs to come after the codehilite and fenced_code extensions.
+    """
+    def __init__(self, highlight_cache):
+        super().__init__()
+        self.highlight_cache = highlight_cache
+
+    def extendMarkdown(self, md, md_globals):
+        cls = self.highlight_cache.codehilite_class
+        processor = md.treeprocessors["hilite"] if "hilite" in md.treeprocessors else None
+        if type(processor) is markdown.extensions.codehilite.HiliteTreeprocessor:
+            md.treeprocessors["hilite"] = CachedHiliteTreeprocessor(md, processor.config, cls)
+        processor = md.preprocessors["fenced_code_block"] if "fenced_code_block" in md.preprocessors else None
+        if type(processor) is markdown.extensions.fenced_code.FencedBlockPreprocessor:
+            md.preprocessors["fenced_code_block"] = CachedFencedBlockPreprocessor(md, cls)
+
+
+CodeHilite = markdown.extensions.codehilite.CodeHilite
+
+
+class MarkdownPages:
+    def __init__(self, site):
+        self.site = site
+        self.highlight_cache = HighlightCache(site)
+        extensions = [
+            "markdown.extensions.extra",
+            "markdown.extensions.codehilite",
+            "markdown.extensions.fenced_code",
+        ]
+        self.converters = ConverterPool(extensions + [HighlightCacheExtension(self.highlight_cache)])
+        # Identify what, besides the markdown text, affects the html that is
+        # generated, for the render cache
+        try:
+            import pygments
+            pygments_version = pygments.__version__
+        except ImportError:
+            pygments_version = None
+        self.render_config = repr((RENDER_FORMAT, markdown.version, pygments_version, extensions, "html5"))
         # Cached templates
         self._page_template = None
         self._redirect_template = None
@@ -108,14 +343,60 @@ class MarkdownPages:
             self._redirect_template = self.site.theme.jinja2.get_template("redirect.html")
         return self._redirect_template
 
+    def reload_templates(self):
+        self._page_template = None
+        self._redirect_template = None
+
     def render(self, page):
-        self.md_staticsite.set_page(page)
-        self.markdown.reset()
-        return self.markdown.convert(page.get_content())
+        """
+        Render the markdown of a page into html.
+
+        The html is kept in the persistent "markdown" cache, one entry per
+        page, together with a hash of its markdown text and of the
+        configuration of the markdown converter. It is reused as long as the
+        hash is the same and its internal links resolve to the same pages.
+        """
+        with profile.profiler.timer("markdown", page.src_relpath):
+            text = page.get_content()
+            h = hashlib.sha1(self.render_config.encode("utf-8"))
+            h.update(text.encode("utf-8"))
+            digest = h.hexdigest()
+
+            # Links are resolved relative to the page, so the same text can
+            # render differently in different pages: storing the html by page
+            # also replaces what was cached for older versions of the page
+            cache = self.site.caches.get("markdown")
+            cached = cache.get(page.src_relpath, None)
+            if cached is not None and cached[0] == digest:
+                cached_digest, links, unresolved, html = cached
+                if all(self.link_destination(root, target) == dest for (root, target), dest in links.items()):
+                    # Record what would have been recorded by converting
+                    for root, target in links.keys():
+                        self.site.record_dependency("link", root, target)
+                    for url in unresolved:
+                        log.warn("%s: internal link %r does not resolve to any site page", page.src_relpath, url)
+                    return html
+
+            with self.converters.converter() as conv:
+                with self.site.track_dependencies() as deps:
+                    html, unresolved = conv.convert(page, text)
+
+            # Link resolution is all that markdown conversion depends on
+            links = {(dep[1], dep[2]): self.link_destination(dep[1], dep[2]) for dep in deps if dep[0] == "link"}
+            cache.put(page.src_relpath, (digest, links, unresolved, html))
+            return html
+
+    def link_destination(self, root, target):
+        """
+        Return the dst_link of the page that a link resolves to, or None if it
+        does not resolve to a page
+        """
+        dest = self.site.resolve_link(root, target)
+        return dest.dst_link if dest is not None else None
 
-    def try_load_page(self, root_abspath, relpath):
+    def try_load_page(self, root_abspath, relpath, st=None):
         if not relpath.endswith(".md"): return None
-        return MarkdownPage(self, root_abspath, relpath)
+        return MarkdownPage(self, root_abspath, relpath, st)
 
     def try_load_archetype(self, archetypes, relpath, name):
         if not relpath.endswith(".md"): return None
@@ -158,6 +439,96 @@ def parse_markdown_with_front_matter(fd):
     return front_matter, body
 
 
+def read_markdown_front_matter(fd):
+    """
+    Read the front matter of markdown with front matter, and the first line of
+    its body if it is a title, without reading the rest of the body.
+
+    fd is a file opened in text mode.
+
+    Returns a tuple with:
+
+    * the lines of front matter
+    * the title found in the first line of the body if it is a `# title`
+      heading, else None
+    * the position in fd where the body starts, skipping leading empty lines
+    * the position in fd where the body starts, also skipping the title
+      heading and the empty lines following it
+
+    The positions can be passed to fd.seek() to read the body later.
+    """
+    front_matter = []
+
+    def skip_empty(pos, line):
+        while line and not line.rstrip():
+            pos = fd.tell()
+            line = fd.readline()
+        return pos, line
+
+    pos = 0
+    line = fd.readline()
+    first = line.rstrip()
+    if first in ("{", "---", "+++"):
+        front_matter_end = "}" if first == "{" else first
+        front_matter.append(first)
+        while True:
+            line = fd.readline()
+            if not line: break
+            line = line.rstrip()
+            front_matter.append(line)
+            if line == front_matter_end: break
+        pos = fd.tell()
+        line = fd.readline()
+
+    body_start, line = skip_empty(pos, line)
+
+    title = None
+    content_start = body_start
+    if line.rstrip().startswith("# "):
+        title = line.rstrip()[2:].strip()
+        content_start, line = skip_empty(fd.tell(), fd.readline())
+
+    return front_matter, title, body_start, content_start
+
+
+def read_markdown_body(abspath, offset):
+    """
+    Read the markdown body of a file, starting at the given offset, as
+    returned by read_markdown_front_matter
+    """
+    with open(abspath, "rt") as fd:
+        fd.seek(offset)
+        return "\n".join(line.rstrip() for line in fd)
+
+
+def read_markdown_metadata(abspath):
+    """
+    Read and parse the front matter of a markdown file.
+
+    Returns a tuple with the metadata dict (None if the front matter could not
+    be parsed), an error message if there were problems parsing it, and title,
+    body start and content start as returned by read_markdown_front_matter
+    """
+    with open(abspath, "rt") as fd:
+        front_matter, title, body_start, content_start = read_markdown_front_matter(fd)
+
+    try:
+        style, meta = parse_front_matter(front_matter)
+    except Exception as e:
+        return None, str(e), title, body_start, content_start
+
+    error = None
+    date = meta.get("date", None)
+    if date is not None and not isinstance(date, datetime.datetime):
+        try:
+            meta["date"] = dateutil.parser.parse(date)
+        except Exception as e:
+            error = "cannot parse date {!r}: {}".format(date, e)
+            del meta["date"]
+
+    return fix_toml_timezones(meta), error, title, body_start, content_start
+
+
 class MarkdownArchetype(Archetype):
     def __init__(self, mdenv, archetypes, relpath):
         super().__init__(mdenv.site, relpath)
@@ -172,7 +543,7 @@ class MarkdownArchetype(Archetype):
         # Render the archetype with jinja2
         abspath = os.path.join(self.archetypes.root, self.relpath)
         with open(abspath, "rt") as fd:
-            template = self.site.theme.jinja2.from_string(fd.read())
+            template = self.site.theme.template_from_string(fd.read())
 
         rendered = template.render(**kw)
 
@@ -189,11 +560,13 @@ class MarkdownArchetype(Archetype):
 
 
 class MarkdownPage(Page):
+    __slots__ = ("mdenv", "body_offset", "md_html", "md_dependencies", "md_lock")
+
     TYPE = "markdown"
 
     FINDABLE = True
 
-    def __init__(self, mdenv, root_abspath, relpath):
+    def __init__(self, mdenv, root_abspath, relpath, st=None):
         dirname, basename = os.path.split(relpath)
         if basename == "index.md":
             linkpath = dirname
@@ -204,83 +577,112 @@ class MarkdownPage(Page):
             root_abspath=root_abspath,
             src_relpath=relpath,
             src_linkpath=linkpath,
-            dst_relpath=os.path.join(linkpath, "index.html"),
-            dst_link=os.path.join(settings.SITE_ROOT, linkpath))
+            src_stat=st)
 
         # Shared markdown environment
         self.mdenv = mdenv
 
-        # Sequence of lines found in the front matter
-        self.front_matter = []
-
-        # Sequence of lines found in the body
-        self.body = []
+        # Position in the source file of the markdown body, after front
+        # matter and title. The body is only read when it needs rendering
+        self.body_offset = 0
 
         # Markdown content of the page rendered into html
         self.md_html = None
 
+        # Dependencies recorded while rendering md_html
+        self.md_dependencies = ()
+
+        # Keeps md_html and md_dependencies consistent when pages are rendered
+        # by more than one thread
+        self.md_lock = threading.Lock()
+
+    @property
+    def dst_relpath(self):
+        return os.path.join(self.src_linkpath, "index.html")
+
     def get_content(self):
-        return "\n".join(self.body)
+        return read_markdown_body(self.src_abspath, self.body_offset)
 
     def read_metadata(self):
-        # Read the contents
-        src = self.src_abspath
         if self.meta.get("date", None) is None:
-            self.meta["date"] = pytz.utc.localize(datetime.datetime.utcfromtimestamp(os.path.getmtime(src)))
+            self.meta["date"] = pytz.utc.localize(datetime.datetime.utcfromtimestamp(self.src_stat.st_mtime))
 
-        # Parse separating front matter and markdown content
-        with open(src, "rt") as fd:
-            self.front_matter, self.body = parse_markdown_with_front_matter(fd)
-
-        try:
-            style, meta = parse_front_matter(self.front_matter)
-            self.meta.update(**meta)
-        except:
-            log.exception("%s: failed to parse front matter", self.src_relpath)
-
-        # Remove leading empty lines
-        while self.body and not self.body[0]:
-            self.body.pop(0)
+        # Read the front matter and the title, leaving the body on disk
+        meta, error, title, body_start, content_start = self.load_front_matter(read_markdown_metadata)
+        if error is not None:
+            log.error("%s: failed to parse front matter: %s", self.src_relpath, error)
+        if meta is not None:
+            self.meta.update(**intern_meta(meta))
 
         # Read title from first # title if not specified in metadata
-        if not self.meta.get("title", ""):
-            if self.body and self.body[0].startswith("# "):
-                self.meta["title"] = self.body.pop(0)[2:].strip()
-
-                # Remove leading empty lines again
-                while self.body and not self.body[0]:
-                    self.body.pop(0)
-
-        date = self.meta.get("date", None)
-        if date is not None and not isinstance(date, datetime.datetime):
-            self.meta["date"] = dateutil.parser.parse(date)
+        if not self.meta.get("title", "") and title is not None:
+            self.meta["title"] = title
+            self.body_offset = content_start
+        else:
+            self.body_offset = body_start
 
     def check(self, checker):
         self.mdenv.render(self)
 
+    def clear_content(self):
+        """
+        Forget the rendered markdown, so that it is rendered again when needed
+        """
+        with self.md_lock:
+            self.md_html = None
+            self.md_dependencies = ()
+
     @property
     def content(self):
-        if self.md_html is None:
-            self.md_html = self.mdenv.render(self)
-        return self.md_html
+        with self.md_lock:
+            if self.md_html is None:
+                with self.site.track_dependencies() as deps:
+                    html = self.mdenv.render(self)
+                self.md_dependencies = deps
+                self.md_html = html
+            else:
+                # Whatever uses the cached content also depends on what was
+                # used to render it
+                for dep in self.md_dependencies:
+                    self.site.record_dependency(*dep)
+            return self.md_html
 
     def render(self):
-        res = {}
+        try:
+            yield self.dst_relpath, self.render_page()
 
-        html = self.mdenv.page_template.render(
+            for relpath in self.meta.get("aliases", ()):
+                yield os.path.join(relpath, "index.html"), self.render_redirect()
+        finally:
+            # Once the outputs are written, the html does not need to stay in
+            # memory: other pages showing the content of this one get it again
+            # from the markdown cache
+            self.clear_content()
+
+    def render_target(self, relpath):
+        try:
+            if relpath == self.dst_relpath:
+                return self.render_page()
+            for alias in self.meta.get("aliases", ()):
+                if relpath == os.path.join(alias, "index.html"):
+                    return self.render_redirect()
+            return None
+        finally:
+            self.clear_content()
+
+    def render_page(self):
+        return RenderedTemplate(
+            self.mdenv.page_template,
             page=self,
             content=self.content,
             **self.meta
         )
-        res[self.dst_relpath] = RenderedString(html)
-
-        for relpath in self.meta.get("aliases", ()):
-            html = self.mdenv.redirect_template.render(
-                page=self,
-            )
-            res[os.path.join(relpath, "index.html")] = RenderedString(html)
 
-        return res
+    def render_redirect(self):
+        return RenderedTemplate(
+            self.mdenv.redirect_template,
+            page=self,
+        )
 
     def target_relpaths(self):
         res = [self.dst_relpath]
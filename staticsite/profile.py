@@ -0,0 +1,145 @@
+# coding: utf-8
+import time
+import contextlib
+import functools
+from collections import defaultdict
+import logging
+
+log = logging.getLogger()
+
+
+class NullProfiler:
+    """
+    Profiler that does nothing, used when profiling is not enabled
+    """
+    enabled = False
+
+    @contextlib.contextmanager
+    def timer(self, kind, name):
+        yield
+
+    def iterate(self, kind, name, iterable):
+        return iterable
+
+
+class Profiler:
+    """
+    Collect wall clock and CPU time spent rendering the site.
+
+    Times are grouped by kind ("page", "output", "template", ...) and name
+    (page path, output path, template name, ...). Timers can be nested, and the
+    time of a timer includes the time of the timers nested in it.
+    """
+    enabled = True
+
+    def __init__(self):
+        # Map kind to name to [count, wall time, cpu time]
+        self.stats = defaultdict(lambda: defaultdict(lambda: [0, 0.0, 0.0]))
+
+    def add(self, kind, name, wall, cpu):
+        entry = self.stats[kind][name]
+        entry[0] += 1
+        entry[1] += wall
+        entry[2] += cpu
+
+    @contextlib.contextmanager
+    def timer(self, kind, name):
+        """
+        Time the code run in the context manager
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(kind, name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def iterate(self, kind, name, iterable):
+        """
+        Generate the elements of iterable, timing only the time spent
+        producing them
+        """
+        wall = 0.0
+        cpu = 0.0
+        it = iter(iterable)
+        while True:
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            try:
+                value = next(it)
+            except StopIteration:
+                break
+            finally:
+                wall += time.perf_counter() - wall_start
+                cpu += time.process_time() - cpu_start
+            yield value
+        self.add(kind, name, wall, cpu)
+
+    def instrument_markdown(self, md):
+        """
+        Time separately all the processors of a markdown.Markdown instance
+        """
+        registries = [
+            ("preprocessor", md.preprocessors),
+            ("blockprocessor", md.parser.blockprocessors),
+            ("treeprocessor", md.treeprocessors),
+            ("postprocessor", md.postprocessors),
+        ]
+        for kind, registry in registries:
+            if hasattr(registry, "items"):
+                # OrderedDict in python-markdown 2.x
+                items = list(registry.items())
+            else:
+                # Registry in python-markdown 3.x
+                items = list(registry._data.items())
+            for name, processor in items:
+                module = type(processor).__module__
+                for prefix in ("markdown.extensions.", "markdown."):
+                    if module.startswith(prefix):
+                        module = module[len(prefix):]
+                        break
+                label = "{} {}.{}".format(kind, module, name)
+                processor.run = self._timed(label, processor.run)
+
+    def _timed(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            with self.timer("markdown processor", name):
+                return func(*args, **kw)
+        return wrapper
+
+    def report(self, file, top=20):
+        """
+        Print the profiling results
+        """
+        def print_table(title, kind, sort_key):
+            stats = self.stats.get(kind, None)
+            if not stats: return
+            rows = sorted(stats.items(), key=sort_key, reverse=True)
+            print(file=file)
+            print("{} ({} total, {:.3f}s wall, {:.3f}s cpu):".format(
+                title, len(rows), sum(x[1][1] for x in rows), sum(x[1][2] for x in rows)), file=file)
+            print("{:>8} {:>10} {:>10}  {}".format("count", "wall", "cpu", "name"), file=file)
+            for name, (count, wall, cpu) in rows[:top]:
+                print("{:8d} {:10.4f} {:10.4f}  {}".format(count, wall, cpu, name), file=file)
+
+        by_wall = lambda x: x[1][1]
+        print_table("Slowest pages", "page", by_wall)
+        print_table("Slowest outputs", "output", by_wall)
+        print_table("Templates, including what they extend and include", "template", by_wall)
+        print_table("Markdown conversion", "markdown", by_wall)
+        print_table("Markdown processors", "markdown processor", by_wall)
+        print_table("Writing output files", "write", by_wall)
+
+
+# Profiler used by the whole process
+profiler = NullProfiler()
+
+
+def enable():
+    """
+    Enable profiling for the whole process, returning the Profiler
+    """
+    global profiler
+    profiler = Profiler()
+    return profiler
@@ -0,0 +1,143 @@
+# coding: utf-8
+import re
+import heapq
+import bisect
+import fnmatch
+import logging
+import threading
+
+log = logging.getLogger()
+
+
+def glob_prefix(pattern):
+    """
+    Return the part of a file glob before its first wildcard
+    """
+    for idx, c in enumerate(pattern):
+        if c in "*?[":
+            return pattern[:idx]
+    return pattern
+
+
+class PageQuery:
+    """
+    Indices over the findable pages of a site, used to answer site_pages()
+    queries without scanning and sorting all the pages every time.
+
+    Indices are built on demand, and need to be reset with clear() when the
+    pages of the site or their metadata change.
+    """
+    def __init__(self, site):
+        self.site = site
+        # Serializes building the relpath indices across threads
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # Findable pages, in site order
+            self._pages = None
+            # Position of each page in self._pages
+            self._positions = None
+            # Findable pages sorted by src_relpath, and the list of their
+            # src_relpath, for prefix lookups
+            self._by_relpath = None
+            self._relpaths = None
+        # Compiled glob patterns
+        self._patterns = {}
+        # Map (field, reverse) to the findable pages that have field, sorted
+        # by it
+        self._orderings = {}
+        # Memoized results by (path, limit, sort)
+        self._results = {}
+
+    @property
+    def pages(self):
+        if self._pages is None:
+            self._pages = [p for p in self.site.pages.values() if p.FINDABLE]
+        return self._pages
+
+    def pages_matching(self, path):
+        """
+        Return the findable pages whose src_relpath matches the file glob
+        path, in site order
+        """
+        with self._lock:
+            if self._by_relpath is None:
+                # Build the indices before publishing them, so that other
+                # threads never see them partially built
+                pages = self.pages
+                positions = {page: idx for idx, page in enumerate(pages)}
+                by_relpath = sorted(pages, key=lambda p: p.src_relpath)
+                self._positions, self._by_relpath, self._relpaths = (
+                        positions, by_relpath, [p.src_relpath for p in by_relpath])
+            positions, by_relpath, relpaths = self._positions, self._by_relpath, self._relpaths
+
+        re_path = self._patterns.get(path, None)
+        if re_path is None:
+            re_path = self._patterns[path] = re.compile(fnmatch.translate(path))
+
+        # Only look at the pages whose path starts with the part of the glob
+        # that has no wildcards
+        prefix = glob_prefix(path)
+        res = []
+        for idx in range(bisect.bisect_left(relpaths, prefix), len(relpaths)):
+            relpath = relpaths[idx]
+            if not relpath.startswith(prefix): break
+            if re_path.match(relpath):
+                res.append(by_relpath[idx])
+        res.sort(key=lambda p: positions[p])
+        return res
+
+    def ordering(self, field, reverse):
+        """
+        Return the findable pages that have the metadata field, sorted by it
+        """
+        res = self._orderings.get((field, reverse), None)
+        if res is None:
+            res = [p for p in self.pages if field in p.meta]
+            res.sort(key=lambda p: p.meta[field], reverse=reverse)
+            self._orderings[(field, reverse)] = res
+        return res
+
+    def find(self, path=None, limit=None, sort="-date"):
+        """
+        Return the findable pages whose source matches the file glob `path`,
+        sorted by the metadata field `sort` (reversed if it starts with "-"),
+        and truncated to `limit` elements
+        """
+        key = (path, limit, sort)
+        res = self._results.get(key, None)
+        if res is None:
+            res = self._results[key] = self._find(path, limit, sort)
+        return list(res)
+
+    def _find(self, path, limit, sort):
+        if sort is not None:
+            if sort.startswith("-"):
+                sort = sort[1:]
+                sort_reverse = True
+            else:
+                sort_reverse = False
+
+        if path is None:
+            if sort is None:
+                pages = self.pages
+            else:
+                pages = self.ordering(sort, sort_reverse)
+            return pages[:limit] if limit is not None else list(pages)
+
+        pages = self.pages_matching(path)
+        if sort is None:
+            return pages[:limit] if limit is not None else pages
+
+        pages = [p for p in pages if sort in p.meta]
+        key = lambda p: p.meta[sort]
+        if limit is not None and 0 <= limit < len(pages):
+            # Select the top pages without sorting all of them
+            if sort_reverse:
+                return heapq.nlargest(limit, pages, key=key)
+            else:
+                return heapq.nsmallest(limit, pages, key=key)
+        pages.sort(key=key, reverse=sort_reverse)
+        return pages
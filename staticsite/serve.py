@@ -5,10 +5,32 @@ from staticsite.core import settings, PageFS
 import os
 import mimetypes
 import gc
+import time
 import logging
 
 log = logging.getLogger()
 
+
+def source_changes(old, new):
+    """
+    Compare two results of Serve.scan_sources(), returning the lists of keys
+    that were added, removed and modified
+    """
+    added = []
+    removed = []
+    modified = []
+    for key, st in new.items():
+        prev = old.get(key, None)
+        if prev is None:
+            added.append(key)
+        elif (prev.st_size, prev.st_mtime_ns, prev.st_ino) != (st.st_size, st.st_mtime_ns, st.st_ino):
+            modified.append(key)
+    for key in old.keys():
+        if key not in new:
+            removed.append(key)
+    return added, removed, modified
+
+
 class Serve(SiteCommand):
     "serve the site over HTTP, building it in memory on demand"
 
@@ -17,10 +39,16 @@ class Serve(SiteCommand):
 
         self.reload()
 
+        if self.args.asyncio:
+            import asyncio
+            from .asyncserver import AsyncServer
+            asyncio.run(AsyncServer(self).serve_forever())
+            return
+
         from livereload import Server
         server = Server(self.application)
-        server.watch(self.content_root, self.reload)
-        server.watch(self.theme_root, self.reload)
+        server.watch(self.content_root, self.update)
+        server.watch(self.theme_root, self.update)
         server.serve(port=8000, host="localhost")
 
     def application(self, environ, start_response):
@@ -36,10 +64,155 @@ class Serve(SiteCommand):
         start_response("404 not found", [("Content-Type", "text/plain")])
         return [b"Not found"]
 
+    @classmethod
+    def make_subparser(cls, subparsers):
+        parser = super().make_subparser(subparsers)
+        parser.add_argument("--asyncio", action="store_true", help="serve requests concurrently with asyncio, reloading the site in the background, instead of using livereload")
+        return parser
+
     def reload(self):
+        """
+        Load the whole site again.
+
+        The new site replaces the one being served only once it is fully
+        loaded.
+        """
         log.info("Loading site")
-        self.site = self.load_site()
+        site = self.load_site()
+        sources = self.scan_sources(site)
+        pages = PageFS()
+        pages.add_site(site)
+
+        self.site, self.pages, self.sources = site, pages, sources
         gc.collect()
 
-        self.pages = PageFS()
-        self.pages.add_site(self.site)
+    def update(self, sources=None):
+        """
+        Apply the changes in the source files with refresh(), loading the whole
+        site again if that fails
+        """
+        try:
+            self.refresh(sources)
+        except Exception:
+            log.exception("cannot apply changes to the site: reloading it")
+            self.reload()
+
+    def scan_sources(self, site=None):
+        """
+        Return a dict mapping (tree, relpath) to the stat of all the source
+        files of the site, where tree is "content", "static" or "theme"
+        """
+        if site is None:
+            site = self.site
+        res = {}
+        for relpath, st in site.scan_tree(self.content_root):
+            res[("content", relpath)] = st
+        for relpath, st in site.scan_tree(self.theme_root):
+            if relpath.startswith("static/"):
+                res[("static", relpath[7:])] = st
+            else:
+                res[("theme", relpath)] = st
+        return res
+
+    def refresh(self, sources=None):
+        """
+        Apply the changes in the source files to the site loaded in memory.
+
+        Only the pages whose sources changed are loaded again, and the
+        directory indices and taxonomies are regenerated from the metadata
+        already in memory.
+
+        The files served are updated in a copy of the PageFS, which replaces
+        the one being served once it is complete.
+
+        sources is the result of scan_sources(), if it has already been
+        computed.
+        """
+        start = time.perf_counter()
+
+        if sources is None:
+            sources = self.scan_sources()
+        added, removed, modified = source_changes(self.sources, sources)
+
+        if not added and not removed and not modified:
+            return
+
+        site = self.site
+        roots = {
+            "content": self.content_root,
+            "static": os.path.join(self.theme_root, "static"),
+        }
+
+        templates_changed = any(tree == "theme" for tree, relpath in added + removed + modified)
+        if templates_changed:
+            log.info("Reloading templates")
+            site.reload_templates()
+
+        # Map source files to the pages loaded from them
+        by_source = {}
+        for page in site.pages.values():
+            if page.src_relpath is not None:
+                by_source[(page.root_abspath, page.src_relpath)] = page
+
+        # Adding or removing pages can change where links point to: remember
+        # where links of rendered markdown pages pointed
+        links = {}
+        if added or removed:
+            for page in site.pages.values():
+                for dep in getattr(page, "md_dependencies", ()):
+                    if dep[0] != "link" or dep in links: continue
+                    dest = site.resolve_link(dep[1], dep[2])
+                    links[dep] = dest.dst_link if dest is not None else None
+
+        before = dict(site.pages)
+        changed = []
+        gone = []
+        unlinked = []
+        for tree, relpath in removed:
+            if tree == "theme": continue
+            page = by_source.get((roots[tree], relpath), None)
+            if page is not None:
+                unlinked.append(page)
+                gone.append(page)
+        for tree, relpath in added + modified:
+            if tree == "theme": continue
+            old = by_source.get((roots[tree], relpath), None)
+            page = site.load_file(roots[tree], relpath, sources[(tree, relpath)], assets_only=tree == "static")
+            if old is not None and (page is None or page.src_linkpath != old.src_linkpath):
+                unlinked.append(old)
+            if old is not None:
+                gone.append(old)
+            if page is not None:
+                # A page with the same link path as the old one replaces it
+                # keeping its position in the site
+                changed.append(page)
+        site.remove_pages(unlinked)
+        site.add_pages(changed)
+
+        site.reanalyze(changed, gone)
+
+        # Render again the markdown pages whose links changed destination
+        for page in site.pages.values():
+            for dep in getattr(page, "md_dependencies", ()):
+                if dep in links:
+                    dest = site.resolve_link(dep[1], dep[2])
+                    if links[dep] != (dest.dst_link if dest is not None else None):
+                        page.clear_content()
+                        break
+
+        # Update the paths served, removing the old pages first, since their
+        # files may now be generated by another page
+        pages = self.pages.copy()
+        for linkpath, page in before.items():
+            if site.pages.get(linkpath, None) is not page:
+                pages.remove_page(page)
+        for linkpath, page in site.pages.items():
+            if before.get(linkpath, None) is not page:
+                pages.add_targets(page)
+        pages.invalidate(templates=templates_changed)
+        # Only remember the new sources once their changes are applied, so
+        # that if something fails they are tried again
+        self.pages, self.sources = pages, sources
+
+        log.info("Reloaded %d added, %d removed, %d modified files in %.3fs",
+                 len(added), len(removed), len(modified), time.perf_counter() - start)
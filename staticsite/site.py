@@ -1,8 +1,12 @@
 # coding: utf-8
 import os
 import re
+import stat
 import pytz
 import datetime
+import contextlib
+import itertools
+import threading
 from collections import defaultdict
 from .core import settings
 import logging
@@ -26,23 +30,53 @@ class Site:
         # Taxonomies found in the site
         self.taxonomies = []
 
+        # Map taxonomy names to the values found in the site pages, and each
+        # value to the list of pages that have it. Built by analyze()
+        self.meta_index = {}
+
         # Theme used to render pages
         self.theme = None
 
-        # Map input file patterns to resource handlers
+        # Indices used to query the site pages
+        from .query import PageQuery
+        self.query = PageQuery(self)
+
+        # Memoized results of resolve_link, by (root, target)
+        self.link_cache = {}
+
+        # Persistent caches
+        from .cache import Caches
+        self.caches = Caches()
+
+        # Dependencies are tracked separately by each thread that renders
+        self.tracking = threading.local()
+
+        # Map file extensions to resource handlers, in order of precedence
         from .markdown import MarkdownPages
         from .j2 import J2Pages
         from .taxonomy import TaxonomyPages
-        self.page_handlers = [
-            MarkdownPages(self),
-            J2Pages(self),
-            TaxonomyPages(self),
-        ]
+        self.page_handlers = {
+            ".md": MarkdownPages(self),
+            ".j2": J2Pages(self),
+            ".taxonomy": TaxonomyPages(self),
+        }
 
-    def load_theme(self, theme_root):
+    def load_cache(self, cache_root):
+        """
+        Use the given directory to store persistent caches.
+
+        This needs to be called before load_theme() to be effective.
+        """
+        from .cache import Caches
+        self.caches = Caches(cache_root)
+
+    def load_theme(self, theme_root, compiled_root=None):
         """
         Load a theme from the given directory.
 
+        If compiled_root is given, it is the directory where `ssite
+        compile-theme` compiled the theme templates.
+
         This needs to be called once (and only once) before analyze() is
         called.
         """
@@ -50,7 +84,7 @@ class Site:
             raise RuntimeError("cannot load theme from {} because it was already loaded from {}".format(theme_root, self.theme.root))
 
         from .theme import Theme
-        self.theme = Theme(self, theme_root)
+        self.theme = Theme(self, theme_root, compiled_root)
 
         theme_static = os.path.join(theme_root, "static")
         if os.path.isdir(theme_static):
@@ -60,52 +94,231 @@ class Site:
         self.read_contents_tree(content_root)
 
     def add_page(self, page):
-        self.pages[page.src_linkpath] = page
+        self.add_pages((page,))
 
-    def read_contents_tree(self, tree_root):
+    def add_pages(self, pages):
         """
-        Read static assets and pages from a directory and all its subdirectories
+        Add pages to the site, replacing those with the same link paths.
+
+        Memoized queries are invalidated once for the whole batch.
+        """
+        for page in pages:
+            self.pages[page.src_linkpath] = page
+        self.clear_indices()
+
+    def remove_page(self, page):
+        """
+        Remove a page from the site
+        """
+        self.remove_pages((page,))
+
+    def remove_pages(self, pages):
+        """
+        Remove pages from the site, invalidating memoized queries once for the
+        whole batch
+        """
+        for page in pages:
+            if self.pages.get(page.src_linkpath, None) is page:
+                del self.pages[page.src_linkpath]
+        self.clear_indices()
+
+    def reload_templates(self):
+        """
+        Forget all the templates loaded from the theme, so that changes to
+        them are picked up.
+
+        Taxonomies load their templates when analyzed: reanalyze() needs to be
+        called after this.
+        """
+        self.theme.reload_templates()
+        for handler in self.page_handlers.values():
+            reload_templates = getattr(handler, "reload_templates", None)
+            if reload_templates is not None:
+                reload_templates()
+
+    def clear_indices(self):
+        """
+        Forget the memoized queries and link resolutions, after pages have
+        been added, moved, or their metadata changed
+        """
+        self.query.clear()
+        self.link_cache.clear()
+
+    def scan_tree(self, tree_root):
+        """
+        Generate (relpath, stat) for all the files in a directory and all its
+        subdirectories, skipping hidden files.
+
+        Directories are scanned with os.scandir, and each file is stat-ed only
+        once. Symbolic links to directories are not followed.
+        """
+        pending = [""]
+        while pending:
+            dir_relpath = pending.pop()
+            subdirs = []
+            prefix = dir_relpath + "/" if dir_relpath else ""
+            with os.scandir(os.path.join(tree_root, dir_relpath)) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(prefix + entry.name)
+                        continue
+                    if entry.name.startswith("."): continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        log.debug("%s: skipping broken symlink", prefix + entry.name)
+                        continue
+                    yield prefix + entry.name, st
+            # Visit subdirectories in the order os.walk would
+            pending.extend(reversed(subdirs))
+
+    def handlers_for(self, relpath):
+        """
+        Generate the page handlers that can load a file, in order of
+        precedence.
+
+        Handlers are tried if their extension appears anywhere in the file
+        name, like .md in page.md or .j2 in page.j2.html: each of them then
+        checks if it can load the file. If none of them does, the file is a
+        static asset.
+        """
+        exts = os.path.basename(relpath).split(".")[1:]
+        if len(exts) == 1:
+            # Most files have only one extension, which can be looked up
+            handler = self.page_handlers.get("." + exts[0], None)
+            if handler is not None:
+                yield handler
+        elif exts:
+            exts = set("." + ext for ext in exts)
+            for ext, handler in self.page_handlers.items():
+                if ext in exts:
+                    yield handler
+
+    def load_file(self, tree_root, relpath, st, assets_only=False):
+        """
+        Create the page for the file relpath found in tree_root, with the
+        given stat result.
+
+        If assets_only is True, the file is always loaded as a static asset.
+
+        Returns None if the file does not become a page.
         """
         from .asset import Asset
 
-        log.info("Loading pages from %s", tree_root)
+        if not assets_only:
+            for handler in self.handlers_for(relpath):
+                p = handler.try_load_page(tree_root, relpath, st)
+                if p is not None:
+                    return p
 
-        for root, dnames, fnames in os.walk(tree_root):
-            for f in fnames:
-                if f.startswith("."): continue
+        if stat.S_ISREG(st.st_mode):
+            log.debug("Loading static file %s", relpath)
+            return Asset(self, tree_root, relpath, st)
 
-                page_abspath = os.path.join(root, f)
-                page_relpath = os.path.relpath(page_abspath, tree_root)
+        return None
 
-                for handler in self.page_handlers:
-                    p = handler.try_load_page(tree_root, page_relpath)
-                    if p is not None:
-                        self.add_page(p)
-                        break
-                else:
-                    if os.path.isfile(page_abspath):
-                        log.debug("Loading static file %s", page_relpath)
-                        p = Asset(self, tree_root, page_relpath)
-                        self.add_page(p)
+    def read_contents_tree(self, tree_root):
+        """
+        Read static assets and pages from a directory and all its subdirectories
+        """
+        log.info("Loading pages from %s", tree_root)
+
+        pages = []
+        for page_relpath, st in self.scan_tree(tree_root):
+            p = self.load_file(tree_root, page_relpath, st)
+            if p is not None:
+                pages.append(p)
+        self.add_pages(pages)
 
     def read_asset_tree(self, tree_root):
         """
         Read static assets from a directory and all its subdirectories
         """
-        from .asset import Asset
-
         log.info("Loading assets from %s", tree_root)
 
-        for root, dnames, fnames in os.walk(tree_root):
-            for f in fnames:
-                if f.startswith("."): continue
+        pages = []
+        for page_relpath, st in self.scan_tree(tree_root):
+            p = self.load_file(tree_root, page_relpath, st, assets_only=True)
+            if p is not None:
+                pages.append(p)
+        self.add_pages(pages)
+
+    def resolve_link(self, root, target):
+        """
+        Resolve a link to a page, looking for target in the directory `root`
+        and, if not found, in all its parent directories.
+
+        Returns None if target could not be found.
+
+        Results are memoized until clear_indices() is called.
+        """
+        key = (root, target)
+        try:
+            return self.link_cache[key]
+        except KeyError:
+            pass
+        res = self.link_cache[key] = self._resolve_link(root, target)
+        return res
+
+    def _resolve_link(self, root, target):
+        dirname, basename = os.path.split(target)
+        if basename == "index.html":
+            target = dirname
+
+        # Absolute URLs are resolved as is
+        if target.startswith("/"):
+            if target == "/":
+                target_relpath = ""
+            else:
+                target_relpath = os.path.normpath(target.lstrip("/"))
+            return self.pages.get(target_relpath, None)
+
+        while True:
+            target_relpath = os.path.normpath(os.path.join(root, target))
+            res = self.pages.get(target_relpath, None)
+            if res is not None: return res
+            if not root or root == "/":
+                return None
+            root = os.path.dirname(root)
+
+    @property
+    def dependencies(self):
+        """
+        Set of dependencies recorded while rendering in the current thread, or
+        None if dependencies are not being tracked
+        """
+        return getattr(self.tracking, "dependencies", None)
+
+    @dependencies.setter
+    def dependencies(self, value):
+        self.tracking.dependencies = value
+
+    @contextlib.contextmanager
+    def track_dependencies(self):
+        """
+        Collect the dependencies recorded with record_dependency() into a set.
 
-                page_abspath = os.path.join(root, f)
-                if os.path.isfile(page_abspath):
-                    page_relpath = os.path.relpath(page_abspath, tree_root)
-                    log.debug("Loading static file %s", page_relpath)
-                    p = Asset(self, tree_root, page_relpath)
-                    self.add_page(p)
+        Dependencies collected in nested tracking are also added to the outer
+        set.
+        """
+        outer = self.dependencies
+        deps = self.dependencies = set()
+        try:
+            yield deps
+        finally:
+            self.dependencies = outer
+            if outer is not None:
+                outer.update(deps)
+
+    def record_dependency(self, *key):
+        """
+        Record that what is currently being rendered depends on the site
+        information identified by key. See staticsite.buildcache for the
+        possible keys.
+        """
+        if self.dependencies is not None:
+            self.dependencies.add(key)
 
     def relocate(self, page, dest_relpath):
         log.info("Relocating %s to %s", page.relpath, dest_relpath)
@@ -115,9 +328,74 @@ class Site:
         self.pages[dest_relpath] = page
         page.aliases.append(page.relpath)
         page.relpath = dest_relpath
+        self.clear_indices()
+
+    def build_meta_index(self, pages):
+        """
+        Index the pages by the values of the metadata fields used by
+        taxonomies, in a single pass over the pages
+        """
+        self.meta_index = {t.name: {} for t in self.taxonomies}
+        fields = list(self.meta_index.items())
+        for page in pages:
+            meta = page.meta
+            for name, values in fields:
+                vals = meta.get(name, None)
+                if vals is None: continue
+                for v in vals:
+                    indexed = values.get(v, None)
+                    if indexed is None:
+                        values[v] = [page]
+                    else:
+                        indexed.append(page)
+
+    def pages_with(self, name, value):
+        """
+        Return the pages that have value in the metadata field name, which
+        needs to be the name of a taxonomy
+        """
+        return self.meta_index.get(name, {}).get(value, [])
+
+    def reanalyze(self, changed, removed=()):
+        """
+        Analyze the site again after the pages in `changed` have been added or
+        replaced with add_pages(), and the pages in `removed` have been removed
+        with remove_pages().
+
+        Metadata is only read again for the changed pages. Taxonomies are
+        generated again from scratch, and directory indices are generated
+        again for the directories containing changed or removed pages.
+        """
+        dirty = set()
+        for page in itertools.chain(changed, removed):
+            relpath = page.src_relpath
+            while relpath:
+                relpath = os.path.dirname(relpath)
+                if relpath in dirty: break
+                dirty.add(relpath)
+
+        for linkpath, page in list(self.pages.items()):
+            if page.TYPE == "dir":
+                if page.src_relpath in dirty:
+                    del self.pages[linkpath]
+            elif page.TYPE == "taxonomy":
+                handler = self.page_handlers[".taxonomy"]
+                self.pages[linkpath] = handler.try_load_page(page.root_abspath, page.src_relpath)
+        self.analyze(only=changed)
+
+    def analyze(self, only=None):
+        """
+        Analyze the site contents, reading the metadata of all pages and
+        generating directory indices and taxonomies.
+
+        If only is not None, the metadata of the pages analyzed in the first
+        pass is read only for the pages in it: see reanalyze().
+        """
+        if only is not None:
+            only = set(only)
 
-    def analyze(self):
         self.taxonomies = []
+        self.meta_index = {}
 
         by_dir = defaultdict(list)
         by_pass = defaultdict(list)
@@ -130,10 +408,14 @@ class Site:
             # Harvest content for directory indices
             if page.FINDABLE and page.src_relpath:
                 dir_relpath = os.path.dirname(page.src_relpath)
+                # If this directory has been seen already, so have all its
+                # parents
+                seen = dir_relpath in by_dir
                 by_dir[dir_relpath].append(page)
-                while True:
+                while not seen:
                     if not dir_relpath: break
                     dir_relpath = os.path.dirname(dir_relpath)
+                    seen = dir_relpath in by_dir
                     # Do a lookup to make sure an entry exists for this
                     # directory level, even though without pages
                     by_dir[dir_relpath]
@@ -157,7 +439,17 @@ class Site:
         # Read metadata
         for passnum, pages in sorted(by_pass.items(), key=lambda x:x[0]):
             for page in pages:
+                if only is not None and passnum == 1 and page not in only: continue
                 page.read_metadata()
+            if passnum == 1:
+                # Taxonomies are analyzed after this pass, and use the index
+                self.build_meta_index(pages)
+
+        # Metadata changed, and directory indices were added
+        self.clear_indices()
+
+        # Save what was cached while reading metadata
+        self.caches.commit()
 
 
     def slugify(self, text):
@@ -1,6 +1,6 @@
 # coding: utf-8
 
-from .core import Page, settings, RenderedString
+from .core import Page, settings, RenderedTemplate
 import os
 import re
 from collections import defaultdict
@@ -13,28 +13,62 @@ class TaxonomyPages:
     def __init__(self, site):
         self.site = site
 
-    def try_load_page(self, root_abspath, relpath):
+    def try_load_page(self, root_abspath, relpath, st=None):
         if not relpath.endswith(".taxonomy"): return None
-        return TaxonomyPage(self, root_abspath, relpath)
+        return TaxonomyPage(self, root_abspath, relpath, st)
+
+
+def read_taxonomy_metadata(abspath):
+    """
+    Read and parse a .taxonomy file.
+
+    Returns a tuple with the metadata dict, or None if it could not be
+    parsed, and the error message in that case
+    """
+    from .utils import parse_front_matter, fix_toml_timezones
+    with open(abspath, "rt") as fd:
+        lines = [x.rstrip() for x in fd]
+    try:
+        style, meta = parse_front_matter(lines)
+    except Exception as e:
+        return None, str(e)
+    return fix_toml_timezones(meta), None
 
 
 class TaxonomyItem:
-    def __init__(self, page, name):
+    __slots__ = ("page", "name", "slug", "pages", "_pages_by_date")
+
+    def __init__(self, page, name, pages):
         self.page = page
         self.name = name
         self.slug = self.page.site.slugify(name)
-        self.pages = []
+        self.pages = pages
+        self._pages_by_date = None
+
+    @property
+    def pages_by_date(self):
+        """
+        Pages with this item, newest first.
+
+        The list is sorted once and shared by all the outputs of the item.
+        """
+        if self._pages_by_date is None:
+            self._pages_by_date = sorted(self.pages, key=lambda x:x.meta["date"], reverse=True)
+        return self._pages_by_date
 
     def __str__(self):
         return self.name
 
 
 class TaxonomyPage(Page):
+    __slots__ = ("name", "items", "template_index", "template_item", "template_rss",
+                 "template_atom", "template_archive", "_outputs")
+
     TYPE = "taxonomy"
     ANALYZE_PASS = 2
     RENDER_PREFERRED_ORDER = 2
 
-    def __init__(self, tenv, root_abspath, relpath):
+    def __init__(self, tenv, root_abspath, relpath, st=None):
         linkpath = os.path.splitext(relpath)[0]
 
         super().__init__(
@@ -42,8 +76,7 @@ class TaxonomyPage(Page):
             root_abspath=root_abspath,
             src_relpath=relpath,
             src_linkpath=linkpath,
-            dst_relpath=linkpath,
-            dst_link=os.path.join(settings.SITE_ROOT, linkpath))
+            src_stat=st)
 
         # Taxonomy name (e.g. "tags")
         self.name = os.path.basename(linkpath)
@@ -54,9 +87,14 @@ class TaxonomyPage(Page):
 
         self.template_index = None
         self.template_item = None
-        self.template_feed = None
+        self.template_rss = None
+        self.template_atom = None
         self.template_archive = None
 
+        # List of (relpath, type, item) for all the outputs, computed on
+        # demand by outputs()
+        self._outputs = None
+
         self.meta["output_index"] = ""
         self.meta["output_item"] = "{slug}/"
         self.meta["output_rss"] = "{slug}/index.rss"
@@ -72,6 +110,9 @@ class TaxonomyPage(Page):
         #        info["output_dir"] = self.enforce_relpath(output_dir)
         #    self.taxonomies[name] = Taxonomy(**info)
 
+    @property
+    def dst_relpath(self):
+        return self.src_linkpath
 
     def link_value(self, context, output_item, value):
         if isinstance(value, str):
@@ -119,17 +160,12 @@ class TaxonomyPage(Page):
             return None
 
     def read_metadata(self):
-        from .utils import parse_front_matter
-
         # Read taxonomy information
-        src = self.src_abspath
-        with open(src, "rt") as fd:
-            lines = [x.rstrip() for x in fd]
-        try:
-            style, meta = parse_front_matter(lines)
+        meta, error = self.load_front_matter(read_taxonomy_metadata)
+        if meta is None:
+            log.error("%s: cannot parse taxonomy information: %s", self.src_relpath, error)
+        else:
             self.meta.update(**meta)
-        except:
-            log.exception("%s.taxonomy: cannot parse taxonomy information", self.src_relpath)
 
         single_name = self.meta.get("item_name", self.name)
 
@@ -148,72 +184,71 @@ class TaxonomyPage(Page):
         self.site.theme.jinja2.globals["url_for_" + single_name + "_archive"] = self.link_archive
 
         # Collect the pages annotated with this taxonomy
-        for page in self.site.pages.values():
-            if page.ANALYZE_PASS > 1 : continue
-            vals = page.meta.get(self.name, None)
-            if vals is None: continue
-            for v in vals:
-                item = self.items.get(v, None)
-                if item is None:
-                    item = TaxonomyItem(self, v)
-                    self.items[v] = item
-                item.pages.append(page)
+        for v, pages in self.site.meta_index.get(self.name, {}).items():
+            self.items[v] = TaxonomyItem(self, v, pages)
+
+    def outputs(self):
+        """
+        Return a list of (relpath, type, item) for all the files generated by
+        this taxonomy, where type is "index" or the type of item output, and
+        item is None for the index
+        """
+        if self._outputs is None:
+            res = []
+
+            if self.template_index is not None:
+                dest = os.path.join(self.dst_relpath, self.meta["output_index"])
+                if dest.endswith("/"):
+                    dest += "index.html"
+                res.append((dest, "index", None))
 
-    def render(self):
-        res = {}
+            for item in self.items.values():
+                for type in ("item", "rss", "atom", "archive"):
+                    template = getattr(self, "template_" + type, None)
+                    if template is None: continue
 
-        single_name = self.meta.get("item_name", self.name)
+                    dest = self.meta["output_" + type].format(slug=item.slug)
+                    if dest.endswith("/"):
+                        dest += "index.html"
+
+                    res.append((os.path.join(self.dst_relpath, dest), type, item))
 
-        if self.template_index is not None:
-            dest = os.path.join(self.dst_relpath, self.meta["output_index"])
-            if dest.endswith("/"):
-                dest += "index.html"
+            self._outputs = res
+        return self._outputs
+
+    def render(self):
+        for relpath, type, item in self.outputs():
+            yield relpath, self.render_output(type, item)
+
+    def render_target(self, relpath):
+        for target_relpath, type, item in self.outputs():
+            if target_relpath == relpath:
+                return self.render_output(type, item)
+        return None
+
+    def render_output(self, type, item):
+        """
+        Return the rendered object for one of the outputs listed by outputs()
+        """
+        if item is None:
+            # The index lists all items
+            self.site.record_dependency("taxonomy", self.src_linkpath)
             kwargs = {
                 "page": self,
                 self.name: sorted(self.items.values(), key=lambda x: x.name),
             }
             kwargs.update(**self.meta)
-            body = self.template_index.render(**kwargs)
-            res[dest] = RenderedString(body)
-
-        for item in self.items.values():
-            for type in ("item", "rss", "atom", "archive"):
-                template = getattr(self, "template_" + type, None)
-                if template is None: continue
-
-                dest = self.meta["output_" + type].format(slug=item.slug)
-                if dest.endswith("/"):
-                    dest += "index.html"
-
-                kwargs = {
-                    "page": self,
-                    single_name: item,
-                    "pages": sorted(item.pages, key=lambda x:x.meta["date"], reverse=True),
-                }
-                kwargs.update(**self.meta)
-                body = template.render(**kwargs)
-                res[os.path.join(self.dst_relpath, dest)] = RenderedString(body)
-
-        return res
+            return RenderedTemplate(self.template_index, **kwargs)
+        else:
+            # Item outputs only change when the item pages change
+            self.site.record_dependency("taxonomy_item", self.src_linkpath, item.name)
+            kwargs = {
+                "page": self,
+                self.meta.get("item_name", self.name): item,
+                "pages": item.pages_by_date,
+            }
+            kwargs.update(**self.meta)
+            return RenderedTemplate(getattr(self, "template_" + type), **kwargs)
 
     def target_relpaths(self):
-        res = []
-
-        if self.template_index is not None:
-            dest = os.path.join(self.dst_relpath, self.meta["output_index"])
-            if dest.endswith("/"):
-                dest += "index.html"
-            res.append(dest)
-
-        for item in self.items.values():
-            for type in ("item", "rss", "atom", "archive"):
-                template = getattr(self, "template_" + type, None)
-                if template is None: continue
-
-                dest = self.meta["output_" + type].format(slug=item.slug)
-                if dest.endswith("/"):
-                    dest += "index.html"
-
-                res.append(os.path.join(self.dst_relpath, dest))
-
-        return res
+        return [relpath for relpath, type, item in self.outputs()]
@@ -2,28 +2,129 @@
 import jinja2
 import os
 import re
-import fnmatch
+import json
+import shutil
+import hashlib
 from .core import settings
 import logging
 
 log = logging.getLogger()
 
+
+class CacheBytecodeCache(jinja2.BytecodeCache):
+    """
+    Jinja2 bytecode cache stored in one of the site caches
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def load_bytecode(self, bucket):
+        data = self.cache.get(bucket.key, None)
+        if data is not None:
+            bucket.bytecode_from_string(data)
+
+    def dump_bytecode(self, bucket):
+        self.cache.put(bucket.key, bucket.bytecode_to_string())
+        # Templates are compiled while rendering, possibly by several
+        # processes at the same time: do not keep the database locked
+        self.cache.commit()
+
+    def clear(self):
+        self.cache.clear()
+        self.cache.commit()
+
+
+# Name of the file describing the templates compiled by compile_templates()
+COMPILED_MANIFEST = "templates.json"
+
+
+def fresh_compiled_templates(compiled_root, theme_root):
+    """
+    Return the set of names of the templates compiled in compiled_root by
+    Theme.compile_templates() that are still up to date with their sources in
+    theme_root.
+
+    A template is up to date if its source has the same size and modification
+    time as when it was compiled or, if only its modification time changed,
+    as happens with a fresh checkout, the same contents.
+    """
+    try:
+        with open(os.path.join(compiled_root, COMPILED_MANIFEST), "rt") as fd:
+            manifest = json.load(fd)
+    except FileNotFoundError:
+        return set()
+
+    if manifest.get("jinja2") != jinja2.__version__:
+        log.info("%s: templates compiled with a different version of jinja2: ignoring them", compiled_root)
+        return set()
+
+    res = set()
+    for name, info in manifest["templates"].items():
+        abspath = os.path.join(theme_root, name)
+        try:
+            st = os.stat(abspath)
+        except FileNotFoundError:
+            continue
+        if st.st_size != info["size"]:
+            continue
+        if st.st_mtime_ns != info["mtime_ns"]:
+            with open(abspath, "rb") as fd:
+                if hashlib.sha1(fd.read()).hexdigest() != info["sha1"]:
+                    continue
+        res.add(name)
+    return res
+
+
+class CompiledLoader(jinja2.ModuleLoader):
+    """
+    Load the templates compiled ahead of time by Theme.compile_templates(),
+    skipping the ones whose sources changed since
+    """
+    def __init__(self, compiled_root, theme_root):
+        super().__init__(compiled_root)
+        self.compiled_root = compiled_root
+        self.theme_root = theme_root
+        self.check()
+
+    def check(self):
+        """
+        Check again which compiled templates are up to date
+        """
+        self.fresh = fresh_compiled_templates(self.compiled_root, self.theme_root)
+
+    def load(self, environment, name, globals=None):
+        if name not in self.fresh:
+            raise jinja2.TemplateNotFound(name)
+        return super().load(environment, name, globals)
+
+
 class Theme:
-    def __init__(self, site, root):
+    def __init__(self, site, root, compiled_root=None):
         self.site = site
 
         # Absolute path to the root of the theme directory
         self.root = os.path.abspath(root)
 
+        # Loader of the templates compiled ahead of time, if available
+        self.compiled = None
+
         # Jinja2 template engine
-        from jinja2 import Environment, FileSystemLoader
+        from jinja2 import Environment, FileSystemLoader, ChoiceLoader
+        loader = FileSystemLoader([
+            self.root,
+        ])
+        if compiled_root is not None and os.path.isdir(compiled_root):
+            self.compiled = CompiledLoader(compiled_root, self.root)
+            loader = ChoiceLoader([self.compiled, loader])
         self.jinja2 = Environment(
-            loader=FileSystemLoader([
-                self.root,
-            ]),
+            loader=loader,
             autoescape=True,
+            bytecode_cache=CacheBytecodeCache(site.caches.get("jinja2")),
         )
 
+        # Templates compiled by template_from_string, by hash of their source
+        self.string_templates = {}
+
         # Add settings to jinja2 globals
         for x in dir(settings):
             if not x.isupper(): continue
@@ -34,6 +135,7 @@ class Theme:
             has_page=self.jinja2_has_page,
             url_for=self.jinja2_url_for,
             site_pages=self.jinja2_site_pages,
+            pages_with=self.jinja2_pages_with,
             now=self.site.generation_time,
             taxonomies=self.jinja2_taxonomies,
         )
@@ -42,7 +144,84 @@ class Theme:
 
         self.dir_template = self.jinja2.get_template("dir.html")
 
+    def reload_templates(self):
+        """
+        Forget the templates that have been loaded, so that they are loaded
+        again from disk
+        """
+        if self.jinja2.cache is not None:
+            self.jinja2.cache.clear()
+        if self.compiled is not None:
+            self.compiled.check()
+        self.dir_template = self.jinja2.get_template("dir.html")
+
+    def compile_templates(self, compiled_root):
+        """
+        Compile all the templates of the theme into python modules in
+        compiled_root, which can then be passed to Theme to load them without
+        parsing them.
+
+        Returns the number of templates compiled.
+        """
+        env = self.jinja2.overlay(loader=jinja2.FileSystemLoader([self.root]))
+        names = [name for name in env.list_templates() if not name.startswith("static/")]
+
+        # Describe the sources before compiling them, so that changes made
+        # while compiling are noticed
+        templates = {}
+        for name in names:
+            abspath = os.path.join(self.root, name)
+            st = os.stat(abspath)
+            with open(abspath, "rb") as fd:
+                sha1 = hashlib.sha1(fd.read()).hexdigest()
+            templates[name] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": sha1}
+
+        # Compile into a new directory, then replace the old one with it
+        tmp_root = compiled_root + ".tmp"
+        if os.path.isdir(tmp_root):
+            shutil.rmtree(tmp_root)
+        # Files that are not valid templates are skipped
+        env.compile_templates(tmp_root, filter_func=lambda name: name in templates,
+                              zip=None, log_function=log.debug)
+        for name in names:
+            if not os.path.exists(os.path.join(tmp_root, jinja2.ModuleLoader.get_module_filename(name))):
+                log.info("%s: cannot compile template, skipping it", name)
+                del templates[name]
+        with open(os.path.join(tmp_root, COMPILED_MANIFEST), "wt") as out:
+            json.dump({"jinja2": jinja2.__version__, "templates": templates}, out, indent=1, sort_keys=True)
+
+        if os.path.isdir(compiled_root):
+            old_root = compiled_root + ".old"
+            os.rename(compiled_root, old_root)
+            os.rename(tmp_root, compiled_root)
+            shutil.rmtree(old_root)
+        else:
+            os.rename(tmp_root, compiled_root)
+
+        return len(templates)
+
+    def template_from_string(self, source):
+        """
+        Compile a template from a string, like jinja2's from_string.
+
+        Templates are compiled only once for each different source, and their
+        bytecode is cached persistently
+        """
+        key = hashlib.sha1(source.encode("utf-8")).hexdigest()
+        template = self.string_templates.get(key, None)
+        if template is None:
+            env = self.jinja2
+            bucket = env.bytecode_cache.get_bucket(env, "string:" + key, None, source)
+            code = bucket.code
+            if code is None:
+                code = bucket.code = env.compile(source)
+                env.bytecode_cache.set_bucket(bucket)
+            template = env.template_class.from_code(env, code, env.make_globals(None))
+            self.string_templates[key] = template
+        return template
+
     def jinja2_taxonomies(self):
+        self.site.record_dependency("taxonomies")
         return self.site.taxonomies
 
     def jinja2_basename(self, val):
@@ -86,30 +265,17 @@ class Theme:
 
     @jinja2.contextfunction
     def jinja2_site_pages(self, context, path=None, limit=None, sort="-date"):
-        if path is not None:
-            re_path = re.compile(fnmatch.translate(path))
-        else:
-            re_path = None
-
-        if sort is not None:
-            if sort.startswith("-"):
-                sort = sort[1:]
-                sort_reverse = True
-            else:
-                sort_reverse = False
-
-        pages = []
-        for page in self.site.pages.values():
-            if not page.FINDABLE: continue
-            if re_path is not None and not re_path.match(page.src_relpath): continue
-            if sort is not None and sort not in page.meta: continue
-            pages.append(page)
-
-        if sort is not None:
-            pages.sort(key=lambda p: p.meta.get(sort, None), reverse=sort_reverse)
-
-        if limit is not None:
-            pages = pages[:limit]
+        self.site.record_dependency("site_pages", path, limit, sort)
+        return self.find_pages(path, limit, sort)
 
-        return pages
+    def jinja2_pages_with(self, name, value):
+        self.site.record_dependency("meta_index", name, value)
+        return self.site.pages_with(name, value)
 
+    def find_pages(self, path=None, limit=None, sort="-date"):
+        """
+        Return the findable pages in the site whose source matches the file
+        glob `path`, sorted by the metadata field `sort` (reversed if it starts
+        with "-"), and truncated to `limit` elements
+        """
+        return self.site.query.find(path, limit, sort)
@@ -2,6 +2,10 @@
 import pytz
 import contextlib
 import time
+import os
+import errno
+import stat
+import shutil
 import logging
 
 log = logging.getLogger()
@@ -29,6 +33,22 @@ def parse_front_matter(lines):
 
     return {}
 
+def fix_toml_timezones(meta):
+    """
+    Replace the timezones of datetimes parsed by toml with equivalent
+    datetime.timezone objects.
+
+    toml's timezones cannot be unpickled, and this makes metadata with them
+    possible to store in caches.
+    """
+    import datetime
+    for key, val in meta.items():
+        if not isinstance(val, datetime.datetime): continue
+        if val.tzinfo is None: continue
+        if not type(val.tzinfo).__module__.startswith("toml"): continue
+        meta[key] = val.replace(tzinfo=datetime.timezone(val.utcoffset()))
+    return meta
+
 def write_front_matter(meta, style="toml"):
     if style == "json":
         import json
@@ -86,3 +106,100 @@ def timings(fmtstr, *args, **kw):
     end = time.perf_counter()
     log.info(fmtstr, end - start, *args, extra=kw)
 
+
+# ioctl from linux/fs.h that makes a file share the data blocks of another
+FICLONE = 0x40049409
+
+def reflink_file(src, dst):
+    """
+    Copy src to dst sharing data blocks if the file system supports it, else
+    letting the kernel copy the data without passing it through user space.
+
+    Raises OSError if neither is possible.
+    """
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            try:
+                import fcntl
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (ImportError, OSError):
+                if not hasattr(os, "copy_file_range"):
+                    raise OSError(errno.EOPNOTSUPP, "reflink and copy_file_range are not supported", src)
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if count == 0: break
+                    copied += count
+    shutil.copystat(src, dst)
+
+def publish_file(src, dst, method="copy"):
+    """
+    Make the file src available as dst using the given method:
+
+    * "copy": copy data and metadata
+    * "hardlink": make dst another name for src
+    * "reflink": copy sharing data blocks, or with copy_file_range
+    * "symlink": make dst a symbolic link to src
+
+    Falls back to copying if the method cannot be used, for example because
+    src and dst are on different file systems. dst must not exist.
+
+    Returns the method that has been used.
+    """
+    if method == "hardlink":
+        try:
+            os.link(src, dst)
+            return method
+        except OSError as e:
+            log.debug("%s: cannot hardlink to %s (%s), trying reflink", src, dst, e)
+            method = "reflink"
+
+    if method == "reflink":
+        try:
+            reflink_file(src, dst)
+            return method
+        except OSError as e:
+            log.debug("%s: cannot reflink to %s (%s), copying", src, dst, e)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(dst)
+    elif method == "symlink":
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return method
+        except OSError as e:
+            log.debug("%s: cannot symlink to %s (%s), copying", src, dst, e)
+    elif method != "copy":
+        log.warn("unsupported publishing method %r: copying %s", method, src)
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+def is_published(src, dst, method="copy", published_with=None):
+    """
+    Check if dst is already an up to date publication of src done with
+    publish_file.
+
+    published_with is the method that was requested to publish dst, if known.
+    A copy is accepted as the publication of a link or a reflink only if that
+    same method was requested, since then the copy is what publish_file fell
+    back to when the method could not be used. Otherwise, the file is
+    published again with the new method.
+    """
+    try:
+        dst_st = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+
+    if stat.S_ISLNK(dst_st.st_mode):
+        return method == "symlink" and os.readlink(dst) == os.path.abspath(src)
+
+    st = os.stat(src)
+    if (st.st_dev, st.st_ino) == (dst_st.st_dev, dst_st.st_ino):
+        return method == "hardlink"
+
+    if method != "copy" and published_with != method:
+        return False
+
+    # Same size and modification time is what rsync considers unchanged
+    return dst_st.st_size == st.st_size and dst_st.st_mtime_ns == st.st_mtime_ns
@@ -0,0 +1,240 @@
+# coding: utf-8
+from unittest import TestCase, mock
+from staticsite.buildcache import BuildCache
+from staticsite.core import settings
+from staticsite.cache import Caches
+from .test_buildcache import BuildTestMixin
+from staticsite.manifest import file_sha256
+from .test_site import TestPage
+import datetime
+import errno
+import re
+import os
+
+
+def read_tree(root):
+    """
+    Return a dict mapping the relative paths of all the files under root to
+    their contents, skipping what contains the current time
+    """
+    res = {}
+    for dirpath, dnames, fnames in os.walk(root):
+        for f in fnames:
+            abspath = os.path.join(dirpath, f)
+            with open(abspath, "rb") as fd:
+                res[os.path.relpath(abspath, root)] = re.sub(rb"Generated with .+", b"", fd.read())
+    return res
+
+
+class TestBuild(BuildTestMixin, TestCase):
+    def write_content(self):
+        with open(os.path.join(self.content_root, "tags.taxonomy"), "wt") as fd:
+            fd.write('+++\nitem_name = "tag"\ntemplate_tags = "tags.html"\ntemplate_tag = "tag.html"\n+++\n')
+        for idx in range(12):
+            relpath = os.path.join(self.content_root, "blog", "d{}".format(idx % 3), "post{}.md".format(idx))
+            os.makedirs(os.path.dirname(relpath), exist_ok=True)
+            with open(relpath, "wt") as fd:
+                fd.write('+++\ndate = "2016-01-{:02d} 10:00:00+01:00"\ntags = [ "t{}", "all" ]\n+++\n'.format(idx + 1, idx % 4))
+                fd.write("# Post {}\n\n[next](post{}) text\n".format(idx, idx + 1))
+
+    def test_multi_process(self):
+        self.write_content()
+
+        build = self.make_build("--full")
+        build.write(build.load_site())
+        single_entries = build.build_cache.entries
+        single_manifest = build.manifest.outputs
+
+        output_multi = os.path.join(self.root, "web-multi")
+        build = self.make_build("--full", "--jobs", "2", "-o", output_multi)
+        build.write(build.load_site())
+        multi_entries = build.build_cache.entries
+        multi_manifest = build.manifest.outputs
+
+        # Same output
+        single_tree = read_tree(self.output_root)
+        multi_tree = read_tree(output_multi)
+        del single_tree[".staticsite-manifest.json"]
+        del multi_tree[".staticsite-manifest.json"]
+        self.assertEqual(single_tree, multi_tree)
+        self.assertIn("tags/all/index.html", multi_tree)
+
+        # Same manifest, except for what depends on the time of the build
+        def strip_times(entries):
+            return {k: dict(v, time=None, mtime_ns=None, hash=None, size=None) for k, v in entries.items()}
+        self.assertEqual(strip_times(multi_manifest), strip_times(single_manifest))
+        for relpath, entry in multi_manifest.items():
+            self.assertEqual(entry["hash"], file_sha256(os.path.join(output_multi, relpath)))
+
+        # Same build cache, with the timings of all pages merged from the
+        # children
+        self.assertEqual(strip_times(multi_entries), strip_times(single_entries))
+        self.assertTrue(all(entry["time"] is not None for entry in multi_entries.values()))
+
+    def test_full_clears_caches(self):
+        with open(os.path.join(self.content_root, "post.md"), "wt") as fd:
+            fd.write("# Post\n\ntext\n\n```python\nprint('hello')\n```\n")
+        build = self.make_build()
+        build.write(build.load_site())
+
+        # Tamper with what was cached
+        caches = Caches(build.cache_root)
+        markdown = caches.get("markdown")
+        for key, (digest, links, unresolved, html) in list(markdown.items()):
+            markdown.put(key, (digest, links, unresolved, "<p>cached</p>"))
+        highlight = caches.get("highlight")
+        self.assertTrue(list(highlight.items()))
+        caches.commit()
+
+        # A full build does not use it
+        build = self.make_build("--full")
+        build.write(build.load_site())
+        with open(os.path.join(self.output_root, "post", "index.html"), "rt") as fd:
+            html = fd.read()
+        self.assertIn("<p>text</p>", html)
+        self.assertNotIn("cached", html)
+        self.assertEqual(len(list(markdown.items())), 1)
+
+    def test_asset_publish(self):
+        asset = os.path.join(self.content_root, "style.css")
+        with open(asset, "wt") as fd:
+            fd.write("body { color: red }\n")
+        dst = os.path.join(self.output_root, "style.css")
+
+        def build(*args):
+            build = self.make_build(*args)
+            build.write(build.load_site())
+            return build
+
+        b = build()
+        self.assertEqual(os.stat(dst).st_nlink, 1)
+        self.assertEqual(b.manifest.outputs["style.css"]["publish"], "copy")
+
+        # Changing the publishing method publishes existing files again
+        settings.ASSET_PUBLISH = "hardlink"
+        b = build()
+        self.assertEqual(self.rendered(b), ["style.css"])
+        self.assertEqual(os.stat(dst).st_ino, os.stat(asset).st_ino)
+        self.assertEqual(b.manifest.outputs["style.css"]["publish"], "hardlink")
+
+        # Copies made because links could not be made are kept at the next
+        # build that renders them
+        os.unlink(dst)
+        with mock.patch("os.link", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+            build("--full")
+        self.assertNotEqual(os.stat(dst).st_ino, os.stat(asset).st_ino)
+        settings.SITE_NAME = "changed"
+        b = build()
+        self.assertEqual(self.rendered(b), ["style.css"])
+        self.assertNotEqual(os.stat(dst).st_ino, os.stat(asset).st_ino)
+        self.assertIsNotNone(b.manifest.outputs["style.css"]["time"])
+
+    def test_schedule_chunks(self):
+        build = self.make_build()
+        site = build.load_site()
+        for idx in range(10):
+            site.add_page(TestPage(site, "page{}".format(idx), datetime.datetime(2016, 1, 1)))
+        pages = [site.pages["page{}".format(idx)] for idx in range(10)]
+        build.build_cache = BuildCache(site, self.output_root)
+
+        def entry(cost):
+            return {"type": "test", "fingerprint": None, "outputs": {}, "time": cost}
+
+        # Pages that took no time are split by count, instead of each
+        # becoming a chunk
+        build.build_cache.previous = {page.src_linkpath: entry(0.0) for page in pages}
+        chunks = build.schedule_chunks(pages, 4)
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(sorted(x for chunk in chunks for x in chunk), sorted(p.src_linkpath for p in pages))
+
+        # The most expensive pages come first, in chunks of similar cost
+        build.build_cache.previous = {page.src_linkpath: entry(idx + 1.0) for idx, page in enumerate(pages)}
+        chunks = build.schedule_chunks(pages, 4)
+        self.assertEqual(chunks[0], ["page9", "page8"])
+        self.assertLessEqual(len(chunks), 5)
+        self.assertEqual(sorted(x for chunk in chunks for x in chunk), sorted(p.src_linkpath for p in pages))
+
+
+class FailingPage(TestPage):
+    def render(self):
+        raise RuntimeError("test")
+
+
+class TestStaged(BuildTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.content_root, "index.md"), "wt") as fd:
+            fd.write("# Test\n")
+
+    def build(self, *args):
+        build = self.make_build("--staged", *args)
+        build.write_staged(build.load_site())
+
+    def staging_dirs(self):
+        return sorted(x for x in os.listdir(self.root) if x.startswith("web.") and x != "web.orig")
+
+    def assertBuilt(self):
+        """
+        Check that the output directory is a symlink to the only staging
+        directory
+        """
+        staging = self.staging_dirs()
+        self.assertEqual(len(staging), 1)
+        self.assertEqual(os.readlink(self.output_root), staging[0])
+        self.assertTrue(os.path.exists(os.path.join(self.output_root, "index.html")))
+
+    def test_plain_dir(self):
+        # A plain output directory is replaced with a symlink, and kept with
+        # another name
+        os.makedirs(self.output_root)
+        with open(os.path.join(self.output_root, "stale.html"), "wt") as fd:
+            fd.write("stale")
+        self.build()
+        self.assertBuilt()
+        self.assertFalse(os.path.exists(os.path.join(self.output_root, "stale.html")))
+        with open(os.path.join(self.root, "web.orig", "stale.html"), "rt") as fd:
+            self.assertEqual(fd.read(), "stale")
+
+        # And it stays there in the next builds
+        self.build()
+        self.assertBuilt()
+        self.assertEqual(os.listdir(os.path.join(self.root, "web.orig")), ["stale.html"])
+
+    def test_rebuild(self):
+        self.build()
+        self.assertBuilt()
+        previous = os.readlink(self.output_root)
+
+        # The directory of the previous staged build is replaced
+        self.build()
+        self.assertBuilt()
+        self.assertNotEqual(os.readlink(self.output_root), previous)
+
+        self.build("--full")
+        self.assertBuilt()
+
+    def test_foreign_symlink(self):
+        # A directory that was not created by a staged build is left alone
+        keep = os.path.join(self.root, "keepme")
+        os.makedirs(keep)
+        with open(os.path.join(keep, "file.html"), "wt") as fd:
+            fd.write("keep")
+        os.symlink(keep, self.output_root)
+
+        self.build()
+        self.assertBuilt()
+        self.assertEqual(os.listdir(keep), ["file.html"])
+
+    def test_failure(self):
+        self.build()
+        previous = os.readlink(self.output_root)
+
+        # A failed build removes its staging directory, and leaves the output
+        # as it was
+        build = self.make_build("--staged")
+        site = build.load_site()
+        site.add_page(FailingPage(site, "fail", datetime.datetime(2016, 1, 1)))
+        with self.assertRaises(RuntimeError):
+            build.write_staged(site)
+        self.assertEqual(self.staging_dirs(), [previous])
+        self.assertEqual(os.readlink(self.output_root), previous)
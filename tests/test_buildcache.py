@@ -0,0 +1,158 @@
+# coding: utf-8
+from unittest import TestCase
+from staticsite.core import settings
+from staticsite.site import Site
+from staticsite.build import Build
+from .test_site import TestPage
+from . import datafile_abspath
+import argparse
+import tempfile
+import datetime
+import os
+
+
+class LinkingPage(TestPage):
+    """
+    Test page that resolves the links in its "links" metadata when rendered
+    """
+    def render(self):
+        for target in self.meta.get("links", ()):
+            self.resolve_link(target)
+        yield from super().render()
+
+
+class BuildTestMixin:
+    """
+    Run builds of a project in a temporary directory, using the test theme
+    """
+    def setUp(self):
+        self.orig_settings = dict(vars(settings))
+        self.workdir = tempfile.TemporaryDirectory()
+        self.root = self.workdir.name
+        self.content_root = os.path.join(self.root, "content")
+        self.output_root = os.path.join(self.root, "web")
+        os.makedirs(self.content_root)
+
+    def tearDown(self):
+        self.workdir.cleanup()
+        vars(settings).clear()
+        vars(settings).update(self.orig_settings)
+
+    def make_build(self, *args):
+        """
+        Create a Build command for the project, with the given command line
+        arguments
+        """
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(dest="command")
+        Build.make_subparser(subparsers)
+        return Build(parser.parse_args(
+            ["build", self.root, "--theme", datafile_abspath("theme"), "-o", self.output_root] + list(args)))
+
+    def rendered(self, build):
+        """
+        Return the relative paths of the output files rendered by the last
+        build
+        """
+        return sorted(relpath for relpath, entry in build.manifest.outputs.items() if entry["time"] is not None)
+
+
+class TestBuildCache(BuildTestMixin, TestCase):
+    def make_site(self, build, tags={}, links=(), pages=("page1", "dir1/page2")):
+        site = Site()
+        site.load_cache(build.cache_root)
+        site.load_theme(build.theme_root)
+        site.load_content(build.content_root)
+        for idx, relpath in enumerate(pages):
+            site.add_page(LinkingPage(
+                site, relpath, datetime.datetime(2016, idx + 1, 1), tags=tags.get(relpath, []), links=list(links)))
+        site.analyze()
+        return site
+
+    def build(self, *args, **kw):
+        """
+        Build the site with the given arguments to make_site, and return the
+        relative paths of the outputs that were rendered
+        """
+        build = self.make_build()
+        build.write(self.make_site(build, *args, **kw))
+        return self.rendered(build)
+
+    def test_incremental(self):
+        self.assertEqual(self.build(), ["dir1/index.html", "dir1/page2", "index.html", "page1"])
+
+        # Nothing changed, nothing is rendered, and the previous outputs are
+        # carried over in the manifest
+        build = self.make_build()
+        build.write(self.make_site(build))
+        self.assertEqual(self.rendered(build), [])
+        self.assertEqual(sorted(build.manifest.outputs), ["dir1/index.html", "dir1/page2", "index.html", "page1"])
+
+        # A missing output file is generated again
+        os.unlink(os.path.join(self.output_root, "page1"))
+        self.assertEqual(self.build(), ["page1"])
+
+        # A metadata change renders the page and the directory indices that
+        # list it
+        build = self.make_build()
+        site = self.make_site(build)
+        site.pages["dir1/page2"].meta["title"] = "changed"
+        build.write(site)
+        self.assertEqual(self.rendered(build), ["dir1/index.html", "dir1/page2"])
+        with open(os.path.join(self.output_root, "dir1/page2"), "rt") as fd:
+            self.assertEqual(fd.read(), "changed")
+
+        # The outputs of a page that is gone are removed
+        self.assertEqual(self.build(pages=("page1",)), ["index.html"])
+        self.assertFalse(os.path.exists(os.path.join(self.output_root, "dir1")))
+        self.assertTrue(os.path.exists(os.path.join(self.output_root, "page1")))
+
+        # A full build renders everything again
+        build = self.make_build("--full")
+        build.write(self.make_site(build))
+        self.assertEqual(self.rendered(build), ["dir1/index.html", "dir1/page2", "index.html", "page1"])
+
+    def test_subdir_order(self):
+        # Subdirectories not in the order in which indices list them do not
+        # cause the indices to be rendered at every build
+        pages = ("c/page", "a/page", "b/page")
+        self.assertEqual(self.build(pages=pages), [
+            "a/index.html", "a/page", "b/index.html", "b/page", "c/index.html", "c/page", "index.html"])
+        self.assertEqual(self.build(pages=pages), [])
+
+    def test_unknown_outputs(self):
+        # Without information about a previous build, files in the output
+        # directory that the build did not generate are removed
+        os.makedirs(os.path.join(self.output_root, "old"))
+        with open(os.path.join(self.output_root, "old", "stale.html"), "wt") as fd:
+            fd.write("stale")
+        self.assertEqual(self.build(), ["dir1/index.html", "dir1/page2", "index.html", "page1"])
+        self.assertEqual(sorted(os.listdir(self.output_root)), [".staticsite-manifest.json", "dir1", "index.html", "page1"])
+
+    def test_link_dependencies(self):
+        self.build(links=["page3"])
+        self.assertEqual(self.build(links=["page3"]), [])
+
+        # Adding a page that resolves a previously unresolved link renders
+        # again the pages that linked to it, and the directory indices
+        self.assertEqual(self.build(links=["page3"], pages=("page1", "dir1/page2", "page3")), [
+            "dir1/index.html", "dir1/page2", "index.html", "page1", "page3"])
+
+    def test_taxonomy_items(self):
+        with open(os.path.join(self.content_root, "tags.taxonomy"), "wt") as fd:
+            fd.write('+++\nitem_name = "tag"\ntemplate_tags = "tags.html"\ntemplate_tag = "tag.html"\n+++\n')
+
+        tags = {"page1": ["a"], "dir1/page2": ["b"]}
+        self.assertEqual(self.build(tags), [
+            "dir1/index.html", "dir1/page2", "index.html", "page1",
+            "tags/a/index.html", "tags/b/index.html", "tags/index.html"])
+
+        self.assertEqual(self.build(tags), [])
+
+        # Changing the tags of a page renders the outputs of the tags of that
+        # page, and the index of all tags, but not the outputs of the other
+        # tags
+        tags = {"page1": ["a"], "dir1/page2": ["b", "c"]}
+        self.assertEqual(self.build(tags), [
+            "dir1/index.html", "dir1/page2",
+            "tags/b/index.html", "tags/c/index.html", "tags/index.html"])
@@ -0,0 +1,82 @@
+# coding: utf-8
+from unittest import TestCase
+from staticsite.core import RenderedString, RenderedTemplate
+import jinja2
+import tempfile
+import os
+
+
+class TestRendered(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.dst = os.path.join(self.workdir.name, "index.html")
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def set_old_mtime(self):
+        """
+        Move the modification time of dst in the past, returning it
+        """
+        os.utime(self.dst, ns=(1000000000000000000, 1000000000000000000))
+        return os.stat(self.dst).st_mtime_ns
+
+    def assertWrites(self, make_rendered):
+        """
+        Check that the rendered objects created by make_rendered(text) only
+        write dst if its contents change
+        """
+        self.assertTrue(make_rendered("test").write(self.dst))
+        mtime = self.set_old_mtime()
+
+        # Unchanged contents are not written
+        self.assertFalse(make_rendered("test").write(self.dst))
+        self.assertEqual(os.stat(self.dst).st_mtime_ns, mtime)
+
+        # Changed contents are, also if they have the same size
+        self.assertTrue(make_rendered("TEST").write(self.dst))
+        self.assertNotEqual(os.stat(self.dst).st_mtime_ns, mtime)
+        with open(self.dst, "rt") as fd:
+            self.assertEqual(fd.read(), "TEST")
+        self.assertEqual(os.listdir(self.workdir.name), ["index.html"])
+
+    def test_string(self):
+        self.assertWrites(RenderedString)
+
+    def test_template(self):
+        template = jinja2.Template("{{text}}")
+        self.assertWrites(lambda text: RenderedTemplate(template, text=text))
+
+    def test_template_failure(self):
+        def fail():
+            raise RuntimeError("test")
+        template = jinja2.Template("start {{fail()}}")
+
+        RenderedTemplate(jinja2.Template("test"), text="test").write(self.dst)
+        with self.assertRaises(RuntimeError):
+            RenderedTemplate(template, fail=fail).write(self.dst)
+
+        # The previous contents are kept, and no temporary file is left behind
+        self.assertEqual(os.listdir(self.workdir.name), ["index.html"])
+        with open(self.dst, "rt") as fd:
+            self.assertEqual(fd.read(), "test")
+
+    def test_template_stream(self):
+        # Templates written in chunks give the same output as rendering them
+        # in one go
+        env = jinja2.Environment(loader=jinja2.DictLoader({
+            "base.html": "<html>{% block body %}{% endblock %}</html>\n",
+            "page.html": '{% extends "base.html" %}{% block body %}'
+                         '{% for item in items %}<p>{{item}} {% include "item.html" %}</p>\n{% endfor %}'
+                         '{% endblock %}',
+            "item.html": "{{item * 2}} ünicode",
+        }))
+        template = env.get_template("page.html")
+        rendered = RenderedTemplate(template, items=list(range(1000)))
+        self.assertGreater(len(list(template.generate(items=list(range(1000))))), 1000)
+
+        self.assertTrue(rendered.write(self.dst))
+        with open(self.dst, "rb") as fd:
+            written = fd.read()
+        self.assertEqual(written, template.render(items=list(range(1000))).encode("utf-8"))
+        self.assertEqual(written, rendered.content())
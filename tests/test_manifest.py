@@ -0,0 +1,103 @@
+# coding: utf-8
+from unittest import TestCase, mock
+from staticsite.manifest import Manifest, MANIFEST_NAME, file_sha256
+from staticsite.site import Site
+from .test_buildcache import BuildTestMixin
+from .test_site import TestPage
+import datetime
+import json
+import os
+
+
+class TestManifest(BuildTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        os.makedirs(self.output_root)
+        self.page = TestPage(Site(), "page", datetime.datetime(2016, 1, 1))
+
+    def write_output(self, relpath, text):
+        with open(os.path.join(self.output_root, relpath), "wt") as fd:
+            fd.write(text)
+
+    def test_save_load(self):
+        self.write_output("page", "test")
+        manifest = Manifest(self.output_root)
+        manifest.load()
+        self.assertEqual(manifest.previous, {})
+        manifest.outputs["page"] = manifest.describe("page", self.page, 0.5)
+        manifest.save()
+        self.assertEqual(sorted(os.listdir(self.output_root)), [MANIFEST_NAME, "page"])
+
+        st = os.stat(os.path.join(self.output_root, "page"))
+        with open(os.path.join(self.output_root, MANIFEST_NAME), "rt") as fd:
+            self.assertEqual(json.load(fd), {"outputs": {"page": {
+                "hash": file_sha256(os.path.join(self.output_root, "page")),
+                "size": 4,
+                "mtime_ns": st.st_mtime_ns,
+                "src": "page",
+                "type": "test",
+                "time": 0.5,
+            }}})
+
+        manifest = Manifest(self.output_root)
+        manifest.load()
+        self.assertEqual(manifest.previous["page"]["hash"], file_sha256(os.path.join(self.output_root, "page")))
+
+    def test_load_invalid(self):
+        self.write_output(MANIFEST_NAME, "{")
+        manifest = Manifest(self.output_root)
+        manifest.load()
+        self.assertEqual(manifest.previous, {})
+
+    def test_describe(self):
+        self.write_output("page", "test")
+        manifest = Manifest(self.output_root)
+        manifest.outputs["page"] = manifest.describe("page", self.page)
+        manifest.save()
+
+        # The hash of a file with the same size and mtime is not computed
+        # again
+        manifest = Manifest(self.output_root)
+        manifest.load()
+        with mock.patch("staticsite.manifest.file_sha256") as sha256:
+            entry = manifest.describe("page", self.page)
+        sha256.assert_not_called()
+        self.assertEqual(entry, manifest.previous["page"])
+
+        # It is, if the file changed
+        self.write_output("page", "TEST")
+        os.utime(os.path.join(self.output_root, "page"), ns=(1000000000000000000, 1000000000000000000))
+        entry = manifest.describe("page", self.page)
+        self.assertEqual(entry["hash"], file_sha256(os.path.join(self.output_root, "page")))
+        self.assertNotEqual(entry["hash"], manifest.previous["page"]["hash"])
+
+    def test_carry_over(self):
+        self.write_output("page", "test")
+        manifest = Manifest(self.output_root)
+        manifest.outputs["page"] = manifest.describe("page", self.page, 0.5)
+        manifest.save()
+
+        # Outputs that were not generated again keep their previous entry,
+        # without a generation time
+        manifest = Manifest(self.output_root)
+        manifest.load()
+        manifest.carry_over("page", self.page)
+        self.assertEqual(manifest.outputs["page"], dict(manifest.previous["page"], time=None))
+
+        # Outputs missing from the previous manifest are described
+        self.write_output("other", "other")
+        manifest.carry_over("other", self.page)
+        self.assertEqual(manifest.outputs["other"]["hash"], file_sha256(os.path.join(self.output_root, "other")))
+        self.assertIsNone(manifest.outputs["other"]["time"])
+
+    def test_remove_unknown_outputs(self):
+        self.write_output("page", "test")
+        self.write_output("stale", "stale")
+        self.write_output(MANIFEST_NAME, '{"outputs": {}}')
+
+        # The manifest is not a stale output file
+        build = self.make_build()
+        build.manifest = Manifest(self.output_root)
+        build.manifest.outputs["page"] = build.manifest.describe("page", self.page)
+        build.remove_unknown_outputs()
+        self.assertEqual(sorted(os.listdir(self.output_root)), [MANIFEST_NAME, "page"])
@@ -0,0 +1,272 @@
+# coding: utf-8
+from unittest import TestCase, mock
+from staticsite.markdown import read_markdown_front_matter, read_markdown_metadata, HighlightCache
+from staticsite.markdown import CachedHiliteTreeprocessor, CachedFencedBlockPreprocessor
+import markdown.extensions.codehilite
+from staticsite.site import Site
+from . import datafile_abspath
+import concurrent.futures
+import tempfile
+import io
+import os
+
+
+class TestMarkdown(TestCase):
+    def read(self, text):
+        with io.StringIO(text) as fd:
+            front_matter, title, body_start, content_start = read_markdown_front_matter(fd)
+            fd.seek(body_start)
+            body = fd.read()
+            fd.seek(content_start)
+            content = fd.read()
+        return front_matter, title, body, content
+
+    def test_front_matter(self):
+        front_matter, title, body, content = self.read("+++\ntitle = \"test\"\n+++\n\n\n# Title\n\ntext\n")
+        self.assertEqual(front_matter, ["+++", "title = \"test\"", "+++"])
+        self.assertEqual(title, "Title")
+        self.assertEqual(body, "# Title\n\ntext\n")
+        self.assertEqual(content, "text\n")
+
+    def test_no_front_matter(self):
+        front_matter, title, body, content = self.read("text\n# Title\n")
+        self.assertEqual(front_matter, [])
+        self.assertIsNone(title)
+        self.assertEqual(body, "text\n# Title\n")
+        self.assertEqual(content, "text\n# Title\n")
+
+    def test_only_front_matter(self):
+        front_matter, title, body, content = self.read("{\n\"title\": \"test\"\n}\n")
+        self.assertEqual(front_matter, ["{", "\"title\": \"test\"", "}"])
+        self.assertIsNone(title)
+        self.assertEqual(body, "")
+        self.assertEqual(content, "")
+
+    def test_highlight_cache(self):
+        text = "text\n\n```python\nprint('hello')\n```\n\n```sh\necho hello\n```\n"
+        with tempfile.TemporaryDirectory() as cache_root:
+            site = Site()
+            site.load_cache(cache_root)
+            mdpages = site.page_handlers[".md"]
+            with mdpages.converters.converter() as conv:
+                html = conv.markdown.convert(text)
+            self.assertIn('<span class="nb">print</span>', html)
+            self.assertEqual(len(mdpages.highlight_cache.memory), 2)
+            site.caches.commit()
+
+            # Highlighted code is reused by the next run
+            site = Site()
+            site.load_cache(cache_root)
+            self.assertEqual(len(list(site.caches.get("highlight").items())), 2)
+            mdpages = site.page_handlers[".md"]
+            with mdpages.converters.converter() as conv:
+                self.assertEqual(conv.markdown.convert(text), html)
+            self.assertEqual(len(mdpages.highlight_cache.memory), 2)
+
+            # Changing the language highlights again
+            with mdpages.converters.converter() as conv:
+                conv.markdown.reset()
+                conv.markdown.convert(text.replace("```sh", "```bash"))
+            self.assertEqual(len(mdpages.highlight_cache.memory), 3)
+
+    def test_highlight_cache_per_site(self):
+        text = "```python\nprint('hello')\n```\n"
+        hilite = markdown.extensions.codehilite.CodeHilite.hilite
+        with tempfile.TemporaryDirectory() as root1:
+            with tempfile.TemporaryDirectory() as root2:
+                site1 = Site()
+                site1.load_cache(root1)
+                site2 = Site()
+                site2.load_cache(root2)
+
+                # Each site highlights through its own cache, without changing
+                # CodeHilite for everyone else
+                for site in (site1, site2):
+                    with site.page_handlers[".md"].converters.converter() as conv:
+                        self.assertIn('<span class="nb">print</span>', conv.markdown.convert(text))
+                self.assertIs(markdown.extensions.codehilite.CodeHilite.hilite, hilite)
+                self.assertIn('<span class="nb">print</span>', markdown.markdown(text, extensions=["markdown.extensions.fenced_code", "markdown.extensions.codehilite"]))
+                for site in (site1, site2):
+                    self.assertEqual(len(site.page_handlers[".md"].highlight_cache.memory), 1)
+                    site.caches.commit()
+                    self.assertEqual(len(list(site.caches.get("highlight").items())), 1)
+
+    def test_highlight_processors(self):
+        # Replacing the processors is only supported with python-markdown 2.x
+        self.assertEqual(markdown.version_info[0], 2)
+
+        text = ("text\n\n    :::python\n    print('indented')\n\n"
+                "```python hl_lines=\"1\"\nprint('fenced')\n```\n\n"
+                "~~~\nno <language>\n~~~\n")
+        extensions = ["markdown.extensions.extra", "markdown.extensions.codehilite", "markdown.extensions.fenced_code"]
+        site = Site()
+        mdpages = site.page_handlers[".md"]
+        with mdpages.converters.converter() as conv:
+            self.assertIsInstance(conv.markdown.treeprocessors["hilite"], CachedHiliteTreeprocessor)
+            self.assertIsInstance(conv.markdown.preprocessors["fenced_code_block"], CachedFencedBlockPreprocessor)
+            html = conv.markdown.convert(text)
+
+        # Highlighting through the cache gives the same result as
+        # python-markdown
+        self.assertEqual(html, markdown.markdown(text, extensions=extensions, output_format="html5"))
+        self.assertEqual(len(mdpages.highlight_cache.memory), 3)
+
+    def test_highlight_cache_size(self):
+        site = Site()
+        cache = HighlightCache(site, memory_size=2)
+        for idx in range(3):
+            cache.codehilite_class("print({})".format(idx), lang="python").hilite()
+        self.assertEqual(len(cache.memory), 2)
+        # The least recently used block is dropped first
+        cache.codehilite_class("print(1)", lang="python").hilite()
+        cache.codehilite_class("print(3)", lang="python").hilite()
+        self.assertEqual(len(cache.memory), 2)
+        self.assertIn(cache.key(cache.codehilite_class("print(1)", lang="python"), (), {}), cache.memory)
+
+    def test_render_cache(self):
+        with tempfile.TemporaryDirectory() as root:
+            content = os.path.join(root, "content")
+            os.makedirs(os.path.join(content, "blog"))
+            with open(os.path.join(content, "blog", "post.md"), "wt") as out:
+                out.write("# Post\n\n[other](other) and [missing](missing)\n")
+
+            def render(cache_root):
+                site = Site()
+                site.load_cache(cache_root)
+                site.load_theme(datafile_abspath("theme"))
+                site.load_content(content)
+                site.analyze()
+                page = site.pages["blog/post"]
+                with site.track_dependencies() as deps:
+                    html = site.page_handlers[".md"].render(page)
+                site.caches.commit()
+                return site, html, deps
+
+            cache_root = os.path.join(root, "cache")
+            site, html, deps = render(cache_root)
+            self.assertIn('href="other"', html)
+            self.assertEqual(len(list(site.caches.get("markdown").items())), 1)
+
+            # The next run reuses the html, with the same dependencies
+            site, cached_html, cached_deps = render(cache_root)
+            self.assertEqual(cached_html, html)
+            self.assertEqual(cached_deps, deps)
+            self.assertIn(("link", "blog", "other"), deps)
+
+            # A link that now resolves differently renders the page again
+            with open(os.path.join(content, "blog", "other.md"), "wt") as out:
+                out.write("# Other\n")
+            site, html, deps = render(cache_root)
+            self.assertIn('href="/blog/other"', html)
+            self.assertEqual(render(cache_root)[1], html)
+            self.assertEqual(len(list(site.caches.get("markdown").items())), 1)
+
+            # Editing the page replaces its entry in the cache
+            with open(os.path.join(content, "blog", "post.md"), "wt") as out:
+                out.write("# Post\n\nchanged\n")
+            site, html, deps = render(cache_root)
+            self.assertIn("changed", html)
+            self.assertEqual([key for key, value in site.caches.get("markdown").items()], ["blog/post.md"])
+
+    def test_front_matter_cache(self):
+        with tempfile.TemporaryDirectory() as root:
+            content = os.path.join(root, "content")
+            cache_root = os.path.join(root, "cache")
+            abspath = os.path.join(content, "page.md")
+            os.makedirs(content)
+
+            def write(title):
+                tmp = abspath + ".tmp"
+                with open(tmp, "wt") as out:
+                    out.write("+++\ntitle = \"{}\"\n+++\n\ntext\n".format(title))
+                os.utime(tmp, ns=(1000000000000000000, 1000000000000000000))
+                os.replace(tmp, abspath)
+
+            def load(parse=read_markdown_metadata):
+                site = Site()
+                site.load_cache(cache_root)
+                with mock.patch("staticsite.markdown.read_markdown_metadata", side_effect=parse) as read:
+                    site.load_content(content)
+                    site.analyze()
+                site.caches.commit()
+                return site.pages["page"].meta["title"], read.call_count
+
+            write("first")
+            self.assertEqual(load(), ("first", 1))
+
+            # Unchanged files are not parsed again
+            self.assertEqual(load(), ("first", 0))
+
+            # Files that changed size are
+            write("second")
+            self.assertEqual(load(), ("second", 1))
+            self.assertEqual(load(), ("second", 0))
+
+            # And so are files replaced with one of the same size and
+            # modification time
+            ino = os.stat(abspath).st_ino
+            write("third!")
+            self.assertNotEqual(os.stat(abspath).st_ino, ino)
+            self.assertEqual(load(), ("third!", 1))
+
+    def test_content_released(self):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, "page.md"), "wt") as out:
+                out.write("+++\naliases = [\"old\"]\n+++\n# Page\n\ntext\n")
+            site = Site()
+            site.load_theme(datafile_abspath("theme"))
+            site.load_content(root)
+            site.analyze()
+            page = site.pages["page"]
+
+            # The html is memoized while the page is used
+            self.assertIn("<p>text</p>", page.content)
+            self.assertIsNotNone(page.md_html)
+
+            # And it is released after the outputs of the page are generated
+            outputs = {relpath: rendered.content() for relpath, rendered in page.render()}
+            self.assertEqual(sorted(outputs), ["old/index.html", "page/index.html"])
+            self.assertIn(b"<p>text</p>", outputs["page/index.html"])
+            self.assertIsNone(page.md_html)
+
+            self.assertIn(b"<p>text</p>", page.render_target("page/index.html").content())
+            self.assertIsNone(page.md_html)
+
+    def test_converter_pool(self):
+        with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as cache_root:
+            for idx in range(20):
+                os.makedirs(os.path.join(root, "dir{}".format(idx)))
+                with open(os.path.join(root, "dir{}".format(idx), "page.md"), "wt") as out:
+                    out.write("# Page {}\n\n[next](/dir{}/page) [self](page)\n".format(idx, (idx + 1) % 20))
+                    out.write("\n```python\nprint({})\n```\n".format(idx))
+            site = Site()
+            site.load_cache(cache_root)
+            site.load_theme(datafile_abspath("theme"))
+            site.load_content(root)
+            site.analyze()
+            mdpages = site.page_handlers[".md"]
+            pages = [site.pages["dir{}/page".format(idx)] for idx in range(20)]
+
+            def render(page):
+                with site.track_dependencies() as deps:
+                    html = mdpages.render(page)
+                return html, deps
+
+            expected = [render(page) for page in pages]
+            self.assertIn('href="/dir1/page"', expected[0][0])
+            self.assertIn(("link", "dir0", "page"), expected[0][1])
+
+            # Pages converted in parallel get their own links resolved, and
+            # their own dependencies
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                for i in range(5):
+                    self.assertEqual(list(executor.map(render, pages)), expected)
+                    # Also using the persistent caches from several threads
+                    site.caches.get("markdown").clear()
+                    site.caches.get("highlight").clear()
+                    mdpages.highlight_cache.memory.clear()
+                    self.assertEqual(list(executor.map(render, pages)), expected)
+                    site.caches.commit()
+            self.assertLessEqual(len(mdpages.converters.free), 4)
+            self.assertEqual(len(list(site.caches.get("markdown").items())), 20)
+            self.assertEqual(len(list(site.caches.get("highlight").items())), 20)
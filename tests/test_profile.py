@@ -0,0 +1,129 @@
+# coding: utf-8
+from unittest import TestCase, mock
+from staticsite.core import settings
+from staticsite.build import Build
+from staticsite import profile
+import argparse
+import tempfile
+import pstats
+import shutil
+import io
+import os
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example")
+
+
+class TestProfiler(TestCase):
+    def test_timer(self):
+        profiler = profile.Profiler()
+        for i in range(3):
+            with profiler.timer("page", "a"):
+                with profiler.timer("output", "a/index.html"):
+                    pass
+        with self.assertRaises(RuntimeError):
+            with profiler.timer("page", "b"):
+                raise RuntimeError("failed")
+
+        self.assertEqual(profiler.stats["page"]["a"][0], 3)
+        self.assertEqual(profiler.stats["output"]["a/index.html"][0], 3)
+        # Failed timers are counted too
+        self.assertEqual(profiler.stats["page"]["b"][0], 1)
+        # Nested timers are included in the outer ones
+        self.assertGreaterEqual(profiler.stats["page"]["a"][1], profiler.stats["output"]["a/index.html"][1])
+
+    def test_iterate(self):
+        profiler = profile.Profiler()
+        self.assertEqual(list(profiler.iterate("template", "base.html", iter([b"a", b"b"]))), [b"a", b"b"])
+        self.assertEqual(profiler.stats["template"]["base.html"][0], 1)
+
+    def test_report(self):
+        profiler = profile.Profiler()
+        for idx in range(5):
+            profiler.add("page", "page{}".format(idx), idx, idx / 2)
+        profiler.add("write", "assets", 1.0, 0.5)
+
+        out = io.StringIO()
+        profiler.report(out, top=2)
+        lines = out.getvalue().splitlines()
+
+        # Only the slowest entries are shown, slowest first
+        start = lines.index("Slowest pages (5 total, 10.000s wall, 5.000s cpu):")
+        self.assertEqual([line.split()[-1] for line in lines[start + 2:start + 4]], ["page4", "page3"])
+        self.assertEqual(lines[start + 4], "")
+        self.assertIn("Writing output files (1 total, 1.000s wall, 0.500s cpu):", lines)
+        # Kinds without entries are not shown
+        self.assertNotIn("Slowest outputs", out.getvalue())
+
+    def test_disabled(self):
+        self.assertIsInstance(profile.profiler, profile.NullProfiler)
+        self.assertFalse(profile.profiler.enabled)
+        with profile.profiler.timer("page", "a"):
+            pass
+        items = iter([1, 2])
+        self.assertIs(profile.profiler.iterate("template", "base.html", items), items)
+        self.assertFalse(hasattr(profile.profiler, "stats"))
+
+
+class TestProfileBuild(TestCase):
+    def setUp(self):
+        self.orig_settings = dict(vars(settings))
+        self.workdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.workdir.name, "example")
+        self.output_root = os.path.join(self.workdir.name, "web")
+        shutil.copytree(EXAMPLE, self.root, ignore=shutil.ignore_patterns(".staticsite-cache", "__pycache__"))
+
+    def tearDown(self):
+        profile.profiler = profile.NullProfiler()
+        self.workdir.cleanup()
+        vars(settings).clear()
+        vars(settings).update(self.orig_settings)
+
+    def build(self, *args):
+        """
+        Build the example site with the given command line arguments,
+        returning what it printed
+        """
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(dest="command")
+        Build.make_subparser(subparsers)
+        build = Build(parser.parse_args(["build", self.root, "-o", self.output_root] + list(args)))
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            build.run()
+        return stdout.getvalue()
+
+    def test_profile(self):
+        dump = os.path.join(self.workdir.name, "build.pstats")
+        out = self.build("--profile", "3", "--profile-dump", dump)
+
+        stats = profile.profiler.stats
+        self.assertIn("blog/2016/example", stats["page"])
+        self.assertIn("blog/2016/example/index.html", stats["output"])
+        self.assertIn("page.html", stats["template"])
+        self.assertIn("blog/2016/example.md", stats["markdown"])
+        self.assertTrue(any(name.startswith("treeprocessor ") for name in stats["markdown processor"]))
+        self.assertIn("assets", stats["write"])
+        self.assertIn("templates", stats["write"])
+
+        # The report shows the 3 slowest entries of each group
+        for title in ("Slowest pages", "Slowest outputs", "Templates, including what they extend and include",
+                      "Markdown conversion", "Markdown processors", "Writing output files"):
+            self.assertIn("\n" + title + " (", out)
+        sections = out.strip().split("\n\n")
+        self.assertEqual(len(sections), 6)
+        for section in sections:
+            rows = section.splitlines()[2:]
+            self.assertLessEqual(len(rows), 3)
+        pages = sections[0].splitlines()[2:]
+        self.assertEqual(len(pages), 3)
+        walls = [float(row.split()[1]) for row in pages]
+        self.assertEqual(walls, sorted(walls, reverse=True))
+
+        # cProfile statistics are saved, and cover the build
+        dumped = pstats.Stats(dump)
+        self.assertTrue(any(func[2] == "write_pages" for func in dumped.stats))
+
+    def test_not_enabled(self):
+        out = self.build()
+        self.assertEqual(out, "")
+        self.assertIsInstance(profile.profiler, profile.NullProfiler)
+        self.assertTrue(os.path.exists(os.path.join(self.output_root, "blog/2016/example/index.html")))
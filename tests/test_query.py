@@ -0,0 +1,76 @@
+# coding: utf-8
+from unittest import TestCase
+from staticsite.site import Site
+from .test_site import TestPage
+from . import datafile_abspath
+import concurrent.futures
+import datetime
+import fnmatch
+import re
+
+
+def find_pages_by_scanning(site, path=None, limit=None, sort="-date"):
+    """
+    Reference implementation of site_pages(), scanning all the pages
+    """
+    re_path = re.compile(fnmatch.translate(path)) if path is not None else None
+    sort_reverse = False
+    if sort is not None and sort.startswith("-"):
+        sort = sort[1:]
+        sort_reverse = True
+
+    pages = []
+    for page in site.pages.values():
+        if not page.FINDABLE: continue
+        if re_path is not None and not re_path.match(page.src_relpath): continue
+        if sort is not None and sort not in page.meta: continue
+        pages.append(page)
+
+    if sort is not None:
+        pages.sort(key=lambda p: p.meta.get(sort, None), reverse=sort_reverse)
+
+    if limit is not None:
+        pages = pages[:limit]
+
+    return pages
+
+
+class TestQuery(TestCase):
+    def test_find(self):
+        site = Site()
+        for idx in range(40):
+            relpath = "{}/{}/page{}".format(("blog", "news", "blogroll")[idx % 3], idx % 4, idx)
+            # Use few distinct dates, to check that ties are sorted as before
+            meta = {"order": idx % 5} if idx % 2 else {}
+            site.add_page(TestPage(site, relpath, datetime.datetime(2016, 1, 1 + idx % 7), **meta))
+        site.load_theme(datafile_abspath("theme"))
+        site.analyze()
+
+        for path in (None, "blog/*", "blog*", "news/1/*", "*/2/*", "*page1?", "missing/*"):
+            for sort in ("-date", "date", "order", "-order", None):
+                for limit in (None, 0, 3, 100):
+                    self.assertEqual(
+                        site.query.find(path, limit, sort),
+                        find_pages_by_scanning(site, path, limit, sort),
+                        "path={!r} sort={!r} limit={!r}".format(path, sort, limit))
+
+        # Results are memoized, but each call returns a new list
+        res = site.query.find("blog/*", 3)
+        res.append(None)
+        self.assertEqual(site.query.find("blog/*", 3), find_pages_by_scanning(site, "blog/*", 3))
+
+    def test_threads(self):
+        site = Site()
+        for idx in range(200):
+            relpath = "{}/page{}".format(("blog", "news")[idx % 2], idx)
+            site.add_page(TestPage(site, relpath, datetime.datetime(2016, 1, 1 + idx % 7)))
+        site.load_theme(datafile_abspath("theme"))
+        site.analyze()
+        expected = site.query.pages_matching("blog/*")
+
+        # Threads that find the indices missing all see them fully built
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            for i in range(20):
+                site.query.clear()
+                for res in pool.map(lambda x: site.query.pages_matching("blog/*"), range(8)):
+                    self.assertEqual(res, expected)
@@ -0,0 +1,355 @@
+# coding: utf-8
+from unittest import TestCase, mock
+from staticsite.core import settings
+from staticsite.serve import Serve
+from staticsite.asyncserver import AsyncServer
+import argparse
+import asyncio
+import threading
+import tempfile
+import shutil
+import time
+import re
+import os
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example")
+
+
+class TestServe(TestCase):
+    def setUp(self):
+        self.orig_settings = dict(vars(settings))
+        self.workdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.workdir.name, "example")
+        shutil.copytree(EXAMPLE, self.root, ignore=shutil.ignore_patterns(".staticsite-cache", "__pycache__"))
+
+    def tearDown(self):
+        self.workdir.cleanup()
+        vars(settings).clear()
+        vars(settings).update(self.orig_settings)
+
+    def serve(self):
+        args = argparse.Namespace(
+            project=self.root, theme=None, content=None, archetypes=None, output=None, verbose=False, debug=False)
+        serve = Serve(args)
+        serve.reload()
+        return serve
+
+    def served(self, serve):
+        """
+        Render all the files served, skipping what contains the current time
+        """
+        res = {}
+        for relpath in serve.pages.paths:
+            content = b"".join(serve.application({"PATH_INFO": "/" + relpath}, lambda status, headers: None))
+            res[relpath] = re.sub(rb"Generated with .+|<pubDate>.+|<updated>.+", b"", content)
+        return res
+
+    def write(self, relpath, content):
+        abspath = os.path.join(self.root, relpath)
+        os.makedirs(os.path.dirname(abspath), exist_ok=True)
+        with open(abspath, "wt") as out:
+            out.write(content)
+        # Make sure the change is noticed even with coarse timestamps
+        st = os.stat(abspath)
+        os.utime(abspath, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+    def test_refresh(self):
+        serve = self.serve()
+        # Render everything, so that cached markdown is used after the refresh
+        self.served(serve)
+
+        example = os.path.join(self.root, "content/blog/2016/example.md")
+        with open(example, "rt") as fd:
+            text = fd.read()
+
+        # Modify a page, add pages and a new tag, and link to a new page
+        self.write("content/blog/2016/example.md", text.replace('tags = [ "example" ]', 'tags = [ "example", "new" ]')
+                   .replace("This is an example blog post", "This is a [modified](new) blog post"))
+        self.write("content/blog/2016/new.md", '+++\ndate = "2016-03-01 10:00:00+01:00"\ntags = [ "new" ]\n+++\n# New post\n\ntext\n')
+        self.write("content/blog/2017/other.md", '+++\ndate = "2017-03-01 10:00:00+01:00"\n+++\n# Other post\n\ntext\n')
+        # Remove a static asset and change a template
+        os.unlink(os.path.join(self.root, "theme/static/css/site.css"))
+        with open(os.path.join(self.root, "theme/base.html"), "rt") as fd:
+            base = fd.read()
+        self.write("theme/base.html", base.replace("<body", "<body data-refreshed"))
+
+        serve.refresh()
+        self.assertEqual(self.served(serve), self.served(self.serve()))
+        self.assertIn("blog/2016/new/index.html", serve.pages.paths)
+        self.assertIn("tags/new/index.html", serve.pages.paths)
+        self.assertNotIn("css/site.css", serve.pages.paths)
+
+        # Remove a page that other pages link to
+        os.unlink(os.path.join(self.root, "content/blog/2016/new.md"))
+        serve.refresh()
+        self.assertEqual(self.served(serve), self.served(self.serve()))
+        self.assertNotIn("blog/2016/new/index.html", serve.pages.paths)
+
+        # Nothing changed
+        serve.refresh()
+        self.assertEqual(self.served(serve), self.served(self.serve()))
+
+    def test_etag(self):
+        serve = self.serve()
+        responses = []
+
+        def start_response(status, headers):
+            responses.append((status, dict(headers)))
+
+        content = serve.application({"PATH_INFO": "/blog/2016/example/"}, start_response)[0]
+        status, headers = responses.pop()
+        self.assertEqual(status, "200 OK")
+        etag = headers["ETag"]
+
+        # Rendered files are kept in memory
+        self.assertIs(serve.application({"PATH_INFO": "/blog/2016/example/"}, start_response)[0], content)
+        self.assertEqual(responses.pop()[1]["ETag"], etag)
+
+        # Clients that have the file get a 304
+        self.assertEqual(serve.application({"PATH_INFO": "/blog/2016/example/", "HTTP_IF_NONE_MATCH": etag}, start_response), [b""])
+        self.assertEqual(responses.pop()[0], "304 Not Modified")
+        serve.application({"PATH_INFO": "/blog/2016/example/", "HTTP_IF_NONE_MATCH": '"other"'}, start_response)
+        self.assertEqual(responses.pop()[0], "200 OK")
+
+        # Changing the page renders it again
+        self.write("content/blog/2016/example.md", "# Example\n\n[link](/other/page)\n")
+        serve.refresh()
+        self.assertNotIn("blog/2016/example/index.html", serve.pages.rendered)
+
+        # Adding a page that it does not use keeps the rendered file, adding a
+        # page that it links to does not
+        serve.application({"PATH_INFO": "/blog/2016/example/"}, start_response)
+        self.write("content/other/unrelated.md", "# Unrelated\n\ntext\n")
+        serve.refresh()
+        self.assertIn("blog/2016/example/index.html", serve.pages.rendered)
+        self.write("content/other/page.md", "# Page\n\ntext\n")
+        serve.refresh()
+        self.assertNotIn("blog/2016/example/index.html", serve.pages.rendered)
+        self.assertIn('href="/other/page"', serve.application({"PATH_INFO": "/blog/2016/example/"}, start_response)[0].decode())
+
+        # Static assets are served from disk, with an ETag that changes with
+        # the file
+        css = os.path.join(self.root, "theme/static/css/site.css")
+        with open(css, "rb") as fd:
+            self.assertEqual(b"".join(serve.application({"PATH_INFO": "/css/site.css"}, start_response)), fd.read())
+        status, headers = responses.pop()
+        self.assertEqual(headers["Content-Length"], str(os.path.getsize(css)))
+        etag = headers["ETag"]
+        self.assertNotIn("css/site.css", serve.pages.rendered)
+        self.assertEqual(serve.application({"PATH_INFO": "/css/site.css", "HTTP_IF_NONE_MATCH": etag}, start_response), [b""])
+        self.assertEqual(responses.pop()[0], "304 Not Modified")
+        self.write("theme/static/css/site.css", "body { color: red }\n")
+        self.assertEqual(b"".join(serve.application({"PATH_INFO": "/css/site.css", "HTTP_IF_NONE_MATCH": etag}, start_response)),
+                         b"body { color: red }\n")
+        status, headers = responses.pop()
+        self.assertEqual(status, "200 OK")
+        self.assertNotEqual(headers["ETag"], etag)
+
+        # Changing a template forgets all rendered files
+        with open(os.path.join(self.root, "theme/base.html"), "rt") as fd:
+            base = fd.read()
+        self.write("theme/base.html", base.replace("<body", "<body data-refreshed"))
+        serve.refresh()
+        self.assertEqual(serve.pages.rendered, {})
+
+    def test_refresh_swaps(self):
+        serve = self.serve()
+        serve.application({"PATH_INFO": "/blog/2016/example/"}, lambda status, headers: None)
+        old = serve.pages
+        old_paths = dict(old.paths)
+        old_rendered = dict(old.rendered)
+
+        # Refreshing builds a new PageFS, leaving the one that may still be
+        # in use as it was
+        self.write("content/blog/2016/new.md", "# New post\n\ntext\n")
+        self.write("content/blog/2016/example.md", "# Example\n\nchanged\n")
+        serve.refresh()
+        self.assertIsNot(serve.pages, old)
+        self.assertEqual(old.paths, old_paths)
+        self.assertEqual(old.rendered, old_rendered)
+        self.assertIs(old.cached("/blog/2016/example/")[1], old_rendered["blog/2016/example/index.html"])
+        self.assertIn("blog/2016/new/index.html", serve.pages.paths)
+        self.assertNotIn("blog/2016/new/index.html", old.paths)
+        self.assertNotIn("blog/2016/example/index.html", serve.pages.rendered)
+
+    def test_update(self):
+        serve = self.serve()
+        sources = serve.sources
+        self.write("content/blog/2016/new.md", "# New post\n\ntext\n")
+
+        # A failed refresh does not remember the new sources, so that their
+        # changes are applied again
+        with mock.patch.object(serve.site, "load_file", side_effect=RuntimeError("load failed")):
+            with self.assertRaises(RuntimeError):
+                serve.refresh()
+        self.assertIs(serve.sources, sources)
+
+        # update() falls back to loading the whole site again
+        site = serve.site
+        with mock.patch.object(serve.site, "load_file", side_effect=RuntimeError("load failed")):
+            with self.assertLogs(level="ERROR"):
+                serve.update()
+        self.assertIsNot(serve.site, site)
+        self.assertIn(("content", "blog/2016/new.md"), serve.sources)
+        self.assertIn("blog/2016/new/index.html", serve.pages.paths)
+
+    def test_asyncio(self):
+        serve = self.serve()
+
+        async def request(reader, writer, path, headers="", method="GET", body=""):
+            writer.write("{} {} HTTP/1.1\r\nHost: localhost\r\n{}\r\n{}".format(method, path, headers, body).encode())
+            status = (await reader.readline()).decode().strip()
+            response_headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line: break
+                name, value = line.split(": ", 1)
+                response_headers[name] = value
+            body = await reader.readexactly(int(response_headers.get("Content-Length", "0")))
+            return status, response_headers, body
+
+        async def run():
+            server = AsyncServer(serve, port=0, poll_interval=0.05, debounce=0.05)
+            await server.start()
+            try:
+                port = server.server.sockets[0].getsockname()[1]
+                reader, writer = await asyncio.open_connection("localhost", port)
+
+                # Requests on the same connection
+                status, headers, body = await request(reader, writer, "/blog/2016/example/")
+                self.assertEqual(status, "HTTP/1.1 200 OK")
+                self.assertIn(b"Example blog post", body)
+                status, headers, body = await request(reader, writer, "/blog/2016/example/", "If-None-Match: {}\r\n".format(headers["ETag"]))
+                self.assertEqual(status, "HTTP/1.1 304 Not Modified")
+                self.assertNotIn("Content-Length", headers)
+                status, headers, body = await request(reader, writer, "/nope")
+                self.assertEqual(status, "HTTP/1.1 404 not found")
+
+                # Assets larger than a chunk are sent in full
+                with open(os.path.join(self.root, "theme/static/css/site.css"), "rb") as fd:
+                    css = fd.read()
+                self.write("theme/static/css/site.css", (css.decode() + "\n") * (200 * 1024 // len(css) + 1))
+                with open(os.path.join(self.root, "theme/static/css/site.css"), "rb") as fd:
+                    css = fd.read()
+                status, headers, body = await request(reader, writer, "/css/site.css")
+                self.assertEqual(status, "HTTP/1.1 200 OK")
+                self.assertEqual(body, css)
+
+                # Request bodies are skipped, and the connection stays usable
+                status, headers, body = await request(
+                    reader, writer, "/blog/2016/example/", "Content-Length: 9\r\n", method="POST", body="GET / x\r\n")
+                self.assertEqual(status, "HTTP/1.1 405 Method Not Allowed")
+                status, headers, body = await request(reader, writer, "/blog/2016/example/")
+                self.assertEqual(status, "HTTP/1.1 200 OK")
+
+                # Changes are picked up in the background
+                self.write("content/blog/2016/new.md", "# New post\n\ntext\n")
+                for i in range(100):
+                    await asyncio.sleep(0.05)
+                    if "blog/2016/new/index.html" in serve.pages.paths: break
+                status, headers, body = await request(reader, writer, "/blog/2016/new/")
+                self.assertEqual(status, "HTTP/1.1 200 OK")
+                self.assertIn(b"New post", body)
+
+                writer.close()
+
+                # Chunked request bodies are not supported
+                reader, writer = await asyncio.open_connection("localhost", port)
+                status, headers, body = await request(
+                    reader, writer, "/", "Transfer-Encoding: chunked\r\n", method="POST", body="0\r\n\r\n")
+                self.assertEqual(status, "HTTP/1.1 501 Not Implemented")
+                self.assertEqual(headers["Connection"], "close")
+                self.assertEqual(await reader.read(), b"")
+                writer.close()
+            finally:
+                await server.stop()
+
+        asyncio.run(run())
+
+    def test_asyncio_watch_errors(self):
+        serve = self.serve()
+        scan_sources = serve.scan_sources
+        failures = []
+
+        def failing_scan_sources():
+            if len(failures) < 2:
+                failures.append(True)
+                raise OSError("scan failed")
+            return scan_sources()
+
+        serve.scan_sources = failing_scan_sources
+
+        async def run():
+            server = AsyncServer(serve, port=0, poll_interval=0.05, debounce=0.05)
+            await server.start()
+            try:
+                # The watcher keeps polling after an error
+                self.write("content/blog/2016/new.md", "# New post\n\ntext\n")
+                for i in range(100):
+                    await asyncio.sleep(0.05)
+                    if "blog/2016/new/index.html" in serve.pages.paths: break
+                self.assertEqual(len(failures), 2)
+                self.assertIn("blog/2016/new/index.html", serve.pages.paths)
+                self.assertFalse(server.watcher.done())
+            finally:
+                await server.stop()
+
+        with self.assertLogs(level="ERROR"):
+            asyncio.run(run())
+
+    def test_asyncio_workers(self):
+        serve = self.serve()
+        application = serve.application
+        events = []
+        barrier = threading.Barrier(2, timeout=5)
+        release = threading.Event()
+
+        def render(environ, start_response):
+            if environ["PATH_INFO"] == "/slow/":
+                events.append("render start")
+                release.wait(5)
+                events.append("render end")
+            else:
+                # Only passes if two pages render at the same time
+                barrier.wait()
+            return application(environ, start_response)
+
+        def refresh(sources=None):
+            events.append("refresh")
+
+        serve.application = render
+        serve.refresh = refresh
+
+        async def get(port, path):
+            reader, writer = await asyncio.open_connection("localhost", port)
+            writer.write("GET {} HTTP/1.0\r\n\r\n".format(path).encode())
+            status = (await reader.readline()).decode().strip()
+            await reader.read()
+            writer.close()
+            return status
+
+        async def run():
+            server = AsyncServer(serve, port=0, poll_interval=60, workers=4)
+            await server.start()
+            try:
+                port = server.server.sockets[0].getsockname()[1]
+
+                # Pages are rendered in parallel
+                self.assertEqual(
+                    await asyncio.gather(get(port, "/blog/2016/example/"), get(port, "/tags/")),
+                    ["HTTP/1.1 200 OK", "HTTP/1.1 200 OK"])
+
+                # Changes are applied once running renders are done
+                slow = asyncio.ensure_future(get(port, "/slow/"))
+                while not events:
+                    await asyncio.sleep(0.01)
+                apply = asyncio.ensure_future(server.apply(serve.sources))
+                await asyncio.sleep(0.1)
+                self.assertEqual(events, ["render start"])
+                release.set()
+                await asyncio.gather(slow, apply)
+                self.assertEqual(events, ["render start", "render end", "refresh"])
+            finally:
+                await server.stop()
+
+        asyncio.run(run())
@@ -1,16 +1,20 @@
 # coding: utf-8
-from unittest import TestCase
+from unittest import TestCase, mock
 from staticsite.site import Site
-from staticsite.core import Page
+from staticsite.core import Page, RenderedString
+from staticsite.taxonomy import TaxonomyPage
+from staticsite.dir import DirPage
 from . import datafile_abspath
 import os
+import re
 import datetime
+import tempfile
 
 class TestPage(Page):
     TYPE = "test"
     FINDABLE = True
 
-    def __init__(self, site, relpath, dt):
+    def __init__(self, site, relpath, dt, **meta):
         super().__init__(
             site=site,
             root_abspath="/",
@@ -19,9 +23,14 @@ class TestPage(Page):
             dst_relpath=relpath,
             dst_link=relpath)
         self.dt = dt
+        self.extra_meta = meta
 
     def read_metadata(self):
         self.meta["date"] = self.dt
+        self.meta.update(self.extra_meta)
+
+    def render(self):
+        yield self.dst_relpath, RenderedString(self.meta.get("title", self.src_relpath))
 
 
 class TestSite(TestCase):
@@ -58,3 +67,184 @@ class TestSite(TestCase):
         self.assertEquals(dir_dir2.subdirs, [dir_dir3])
         self.assertEquals(dir_dir3.pages, [page_sub3])
         self.assertEquals(dir_dir3.subdirs, [])
+
+    def test_meta_index(self):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, "tags.taxonomy"), "wt") as fd:
+                fd.write('+++\nitem_name = "tag"\n+++\n')
+
+            site = Site()
+            site.load_theme(datafile_abspath("theme"))
+            site.load_content(root)
+            page1 = TestPage(site, "page1", datetime.datetime(2016, 1, 1), tags=["a", "b"])
+            page2 = TestPage(site, "page2", datetime.datetime(2016, 2, 1), tags=["b"])
+            page3 = TestPage(site, "page3", datetime.datetime(2016, 3, 1))
+            site.add_page(page1)
+            site.add_page(page2)
+            site.add_page(page3)
+            site.analyze()
+
+            self.assertEquals(site.pages_with("tags", "a"), [page1])
+            self.assertEquals(site.pages_with("tags", "b"), [page1, page2])
+            self.assertEquals(site.pages_with("tags", "c"), [])
+            self.assertEquals(site.pages_with("categories", "a"), [])
+
+            tags = site.pages["tags"]
+            self.assertEquals(list(tags.items.keys()), ["a", "b"])
+            self.assertEquals(tags.items["b"].pages, [page1, page2])
+
+    def test_resolve_link(self):
+        site = Site()
+        page_root = TestPage(site, "page_root", datetime.datetime(2016, 1, 1))
+        page_sub = TestPage(site, "dir1/page_sub", datetime.datetime(2016, 2, 1))
+        site.add_page(page_root)
+        site.add_page(page_sub)
+        site.load_theme(datafile_abspath("theme"))
+        site.analyze()
+
+        self.assertIs(site.resolve_link("dir1/dir2", "page_root"), page_root)
+        self.assertIs(site.resolve_link("dir1/dir2", "page_sub"), page_sub)
+        self.assertIs(site.resolve_link("dir1/dir2", "missing"), None)
+        self.assertIs(site.resolve_link("", "dir1/page_sub"), page_sub)
+        self.assertIs(site.resolve_link("dir1", "/page_root"), page_root)
+        self.assertIs(site.resolve_link("dir1", "/"), site.pages[""])
+
+        # Adding a page invalidates the memoized results
+        page_sub2 = TestPage(site, "dir1/dir2/page_sub", datetime.datetime(2016, 3, 1))
+        site.add_page(page_sub2)
+        self.assertIs(site.resolve_link("dir1/dir2", "page_sub"), page_sub2)
+
+    def test_handlers_for(self):
+        site = Site()
+        md = site.page_handlers[".md"]
+        j2 = site.page_handlers[".j2"]
+        taxonomy = site.page_handlers[".taxonomy"]
+
+        def handlers(relpath):
+            return list(site.handlers_for(relpath))
+
+        self.assertEqual(handlers("blog/post.md"), [md])
+        self.assertEqual(handlers("tags.taxonomy"), [taxonomy])
+        self.assertEqual(handlers("index.j2.html"), [j2])
+        self.assertEqual(handlers("x.j2.foo.html"), [j2])
+        self.assertEqual(handlers("x.j2.md"), [md, j2])
+        self.assertEqual(handlers("style.css"), [])
+        self.assertEqual(handlers("README"), [])
+        self.assertEqual(handlers("dir.md/README"), [])
+
+    def test_load_content(self):
+        with tempfile.TemporaryDirectory() as root:
+            files = {
+                "index.j2.html": "{% extends 'base.html' %}",
+                "x.j2.foo.html": "{% extends 'base.html' %}",
+                "blog/post.md": "# Post\n",
+                "blog/.hidden.md": "# Hidden\n",
+                "blog/x.md.html": "text",
+                ".hidden/style.css": "body {}",
+                "static/style.css": "body {}",
+            }
+            for relpath, text in files.items():
+                abspath = os.path.join(root, relpath)
+                os.makedirs(os.path.dirname(abspath), exist_ok=True)
+                with open(abspath, "wt") as fd:
+                    fd.write(text)
+
+            # Symlinks to directories are not followed
+            os.symlink(os.path.join(root, "static"), os.path.join(root, "linked"))
+            os.symlink("missing", os.path.join(root, "broken.css"))
+
+            site = Site()
+            scanned = dict(site.scan_tree(root))
+            self.assertEqual(sorted(scanned), [
+                ".hidden/style.css", "blog/post.md", "blog/x.md.html", "index.j2.html",
+                "static/style.css", "x.j2.foo.html"])
+            self.assertEqual(scanned["blog/post.md"].st_ino, os.stat(os.path.join(root, "blog/post.md")).st_ino)
+            self.assertEqual(scanned["blog/post.md"].st_size, 7)
+
+            site.load_theme(datafile_abspath("theme"))
+            site.load_content(root)
+            types = {page.src_relpath: page.TYPE for page in site.pages.values() if page.root_abspath == root}
+            self.assertEqual(types["index.j2.html"], "jinja2")
+            self.assertEqual(types["x.j2.foo.html"], "jinja2")
+            self.assertEqual(types["blog/post.md"], "markdown")
+            self.assertEqual(types["blog/x.md.html"], "asset")
+            self.assertEqual(types["static/style.css"], "asset")
+            self.assertNotIn("blog/.hidden.md", types)
+            self.assertNotIn("linked/style.css", types)
+
+    def test_add_pages(self):
+        site = Site()
+        site.load_theme(datafile_abspath("theme"))
+        page1 = TestPage(site, "page1", datetime.datetime(2016, 1, 1))
+        site.add_page(page1)
+        site.analyze()
+        self.assertIs(site.resolve_link("", "page1"), page1)
+        self.assertIsNone(site.resolve_link("", "page2"))
+
+        # Memoized queries are invalidated once for a batch of pages
+        page2 = TestPage(site, "page2", datetime.datetime(2016, 1, 1))
+        page3 = TestPage(site, "page3", datetime.datetime(2016, 1, 1))
+        with mock.patch.object(site, "clear_indices", wraps=site.clear_indices) as clear_indices:
+            site.add_pages([page2, page3])
+        clear_indices.assert_called_once_with()
+        self.assertIs(site.resolve_link("", "page2"), page2)
+
+        with mock.patch.object(site, "clear_indices", wraps=site.clear_indices) as clear_indices:
+            site.remove_pages([page1, page2])
+        clear_indices.assert_called_once_with()
+        self.assertIsNone(site.resolve_link("", "page1"))
+        self.assertIs(site.resolve_link("", "page3"), page3)
+
+        # Including when loading a whole directory tree
+        with tempfile.TemporaryDirectory() as root:
+            for idx in range(3):
+                with open(os.path.join(root, "file{}.txt".format(idx)), "wt") as fd:
+                    fd.write("test")
+            with mock.patch.object(site, "clear_indices", wraps=site.clear_indices) as clear_indices:
+                site.load_content(root)
+            clear_indices.assert_called_once_with()
+            self.assertIn("file2.txt", site.pages)
+
+    def test_render_target(self):
+        with tempfile.TemporaryDirectory() as root:
+            files = {
+                "tags.taxonomy": '+++\nitem_name = "tag"\ntemplate_tags = "tags.html"\ntemplate_tag = "tag.html"\n'
+                                 'template_rss = "tag.rss"\ntemplate_atom = "tag.atom"\n'
+                                 'template_archive = "tag-archive.html"\n+++\n',
+                "blog/a/post1.md": '+++\ndate = "2016-01-01 10:00:00+01:00"\ntags = [ "t1", "all" ]\n+++\n# Post 1\n',
+                "blog/b/post2.md": '+++\ndate = "2016-01-02 10:00:00+01:00"\ntags = [ "t2", "all" ]\n+++\n# Post 2\n',
+            }
+            for relpath, text in files.items():
+                abspath = os.path.join(root, relpath)
+                os.makedirs(os.path.dirname(abspath), exist_ok=True)
+                with open(abspath, "wt") as fd:
+                    fd.write(text)
+
+            site = Site()
+            site.load_theme(datafile_abspath("theme"))
+            site.load_content(root)
+            site.analyze()
+
+            def content(rendered):
+                # Skip what contains the current time
+                return re.sub(rb"Generated with .+|<pubDate>.+|<updated>.+", b"", rendered.content())
+
+            rendered_paths = []
+            for page, cls, method in (
+                    (site.pages["tags"], TaxonomyPage, "render_output"),
+                    (site.pages["blog"], DirPage, "render_index"),
+                    (site.pages["blog/a"], DirPage, "render_index")):
+                outputs = {relpath: content(rendered) for relpath, rendered in page.render()}
+                rendered_paths.extend(outputs)
+                for relpath, expected in outputs.items():
+                    # Only the output asked for is prepared
+                    with mock.patch.object(cls, method, autospec=True, side_effect=getattr(cls, method)) as prepare:
+                        rendered = page.render_target(relpath)
+                    prepare.assert_called_once()
+                    self.assertEqual(content(rendered), expected, relpath)
+                self.assertIsNone(page.render_target("missing/index.html"))
+
+            # All kinds of outputs have been checked
+            for relpath in ("tags/index.html", "tags/all/index.html", "tags/all/index.rss", "tags/all/index.atom",
+                            "tags/all/archive.html", "blog/index.html", "blog/a/index.html"):
+                self.assertIn(relpath, rendered_paths)
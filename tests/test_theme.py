@@ -0,0 +1,62 @@
+# coding: utf-8
+from unittest import TestCase
+from staticsite.site import Site
+from . import datafile_abspath
+import tempfile
+import shutil
+import os
+
+
+class TestTheme(TestCase):
+    def test_template_from_string(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            site = Site()
+            site.load_cache(cache_root)
+            site.load_theme(datafile_abspath("theme"))
+
+            template = site.theme.template_from_string("Hello {{name}}")
+            self.assertEqual(template.render(name="world"), "Hello world")
+            # Templates are compiled once for each source
+            self.assertIs(site.theme.template_from_string("Hello {{name}}"), template)
+            self.assertIsNot(site.theme.template_from_string("Hi {{name}}"), template)
+
+            # Their bytecode is reused by the next run
+            cache = site.caches.get("jinja2")
+            keys = set(key for key, value in cache.items())
+            self.assertEqual(len(keys), 2 + len(site.theme.jinja2.cache))
+
+            site = Site()
+            site.load_cache(cache_root)
+            site.load_theme(datafile_abspath("theme"))
+            self.assertEqual(site.theme.template_from_string("Hello {{name}}").render(name="world"), "Hello world")
+            self.assertEqual(set(key for key, value in site.caches.get("jinja2").items()), keys)
+
+    def test_compile_templates(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            theme_root = os.path.join(workdir, "theme")
+            compiled_root = os.path.join(workdir, "compiled")
+            shutil.copytree(datafile_abspath("theme"), theme_root)
+
+            site = Site()
+            site.load_theme(theme_root)
+            count = site.theme.compile_templates(compiled_root)
+            self.assertEqual(count, len(os.listdir(theme_root)))
+
+            site = Site()
+            site.load_theme(theme_root, compiled_root)
+            self.assertIn("page.html", site.theme.compiled.fresh)
+            page = site.theme.jinja2.get_template("page.html")
+            self.assertTrue(page.filename.startswith(compiled_root))
+
+            # Templates whose sources are only touched are still fresh,
+            # templates whose sources changed are loaded from the sources
+            abspath = os.path.join(theme_root, "page.html")
+            st = os.stat(abspath)
+            os.utime(os.path.join(theme_root, "dir.html"), ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+            with open(abspath, "at") as out:
+                out.write("\n")
+            site.theme.reload_templates()
+            self.assertIn("dir.html", site.theme.compiled.fresh)
+            self.assertNotIn("page.html", site.theme.compiled.fresh)
+            page = site.theme.jinja2.get_template("page.html")
+            self.assertEqual(page.filename, abspath)
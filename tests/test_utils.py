@@ -0,0 +1,86 @@
+# coding: utf-8
+from unittest import TestCase, mock
+from staticsite.utils import reflink_file, publish_file, is_published
+import tempfile
+import errno
+import os
+
+
+class TestPublish(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.workdir.name, "src.css")
+        with open(self.src, "wt") as fd:
+            fd.write("body { color: red }\n")
+        os.utime(self.src, ns=(1000000000000000000, 1000000000000000000))
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def dst(self, name):
+        return os.path.join(self.workdir.name, name)
+
+    def assertCopied(self, dst):
+        with open(dst, "rt") as fd:
+            self.assertEqual(fd.read(), "body { color: red }\n")
+        self.assertNotEqual(os.stat(dst).st_ino, os.stat(self.src).st_ino)
+        self.assertEqual(os.stat(dst).st_mtime_ns, os.stat(self.src).st_mtime_ns)
+
+    def test_reflink_file(self):
+        reflink_file(self.src, self.dst("dst.css"))
+        self.assertCopied(self.dst("dst.css"))
+
+    def test_publish_file(self):
+        self.assertEqual(publish_file(self.src, self.dst("copy.css"), "copy"), "copy")
+        self.assertCopied(self.dst("copy.css"))
+
+        self.assertEqual(publish_file(self.src, self.dst("reflink.css"), "reflink"), "reflink")
+        self.assertCopied(self.dst("reflink.css"))
+
+        self.assertEqual(publish_file(self.src, self.dst("hardlink.css"), "hardlink"), "hardlink")
+        self.assertEqual(os.stat(self.dst("hardlink.css")).st_ino, os.stat(self.src).st_ino)
+
+        self.assertEqual(publish_file(self.src, self.dst("symlink.css"), "symlink"), "symlink")
+        self.assertEqual(os.readlink(self.dst("symlink.css")), os.path.abspath(self.src))
+
+        for method in ("copy", "reflink", "hardlink", "symlink"):
+            dst = self.dst(method + ".css")
+            self.assertTrue(is_published(self.src, dst, method, method))
+
+        # Files published with another method are published again
+        self.assertFalse(is_published(self.src, self.dst("hardlink.css"), "copy"))
+        self.assertFalse(is_published(self.src, self.dst("symlink.css"), "copy"))
+        self.assertFalse(is_published(self.src, self.dst("missing.css"), "copy"))
+
+        # Copies are published again when the source changes
+        os.utime(self.src)
+        self.assertFalse(is_published(self.src, self.dst("copy.css"), "copy"))
+        self.assertTrue(is_published(self.src, self.dst("hardlink.css"), "hardlink"))
+        self.assertTrue(is_published(self.src, self.dst("symlink.css"), "symlink"))
+
+    def test_fallback(self):
+        # Hardlinks across file systems fall back to reflink or copy
+        with mock.patch("os.link", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+            self.assertIn(publish_file(self.src, self.dst("dst.css"), "hardlink"), ("reflink", "copy"))
+        self.assertCopied(self.dst("dst.css"))
+
+        # The fallback copy is up to date, and it is not published again at
+        # each build
+        self.assertTrue(is_published(self.src, self.dst("dst.css"), "hardlink", "hardlink"))
+        os.utime(self.src)
+        self.assertFalse(is_published(self.src, self.dst("dst.css"), "hardlink", "hardlink"))
+
+        # The same for symlinks
+        with mock.patch("os.symlink", side_effect=OSError(errno.EPERM, "Operation not permitted")):
+            self.assertEqual(publish_file(self.src, self.dst("sym.css"), "symlink"), "copy")
+        self.assertCopied(self.dst("sym.css"))
+        self.assertTrue(is_published(self.src, self.dst("sym.css"), "symlink", "symlink"))
+
+    def test_change_method(self):
+        # A copy is published again when switching to another method, also if
+        # it is up to date
+        publish_file(self.src, self.dst("dst.css"), "copy")
+        self.assertTrue(is_published(self.src, self.dst("dst.css"), "copy", "copy"))
+        for method in ("hardlink", "symlink", "reflink"):
+            self.assertFalse(is_published(self.src, self.dst("dst.css"), method, "copy"))
+            self.assertFalse(is_published(self.src, self.dst("dst.css"), method))